@@ -0,0 +1,625 @@
+"""Benchmarks for the parse -> render -> paint pipeline and for fetching.
+
+    python3 bench.py                          # 1 KB .. 1 MB corpora, results to bench-results.json
+    python3 bench.py --max-size 50M           # the whole 1 KB .. 50 MB range (takes a while)
+    python3 bench.py --baseline old.json      # compare with an earlier run, exit 1 on regressions
+    python3 bench.py --only startup --baseline old.json   # just the start-up time check
+    python3 bench.py --only backend           # parser backends: conformance check and speed
+    python3 bench.py --only page-memory       # memory per page, segment list vs compact document
+    python3 bench.py --only idle              # input loop wake-ups while the browser sits idle
+    python3 bench.py --only find              # in-page find: search and n/N jumps
+    python3 bench.py --only render-memo       # a revisit: rendered page loaded from the render cache
+
+Every benchmark reports ops/sec (how often the operation ran per second of wall time) and the
+peak memory one run of it allocated, measured separately under tracemalloc. The start-up
+benchmarks report the median of several runs instead: the import time of browser.py from
+-X importtime and the time until the browser has painted its first screen in a pseudo-terminal.
+Before the parser backends are timed, every installed backend must render CONFORMANCE_CASES and the
+generated corpora exactly like commonmark; a mismatch fails the run. Finally the memory of every
+corpus page is reported twice: as the segment list render_ast returns and as the compact document
+the browser keeps, and the browser is left idle on a page to count how often its input loop woke up
+for nothing; any such wake-up fails the run.
+"""
+import argparse
+import functools
+import statistics
+import http.server
+import json
+import os
+import platform
+import select
+import signal
+import subprocess
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+# Keep the benchmarks away from the user's real cache (the browser reads this at import time)
+BENCH_CACHE = tempfile.mkdtemp(prefix='alterlynx-bench-')
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+os.environ['XDG_CACHE_HOME'] = BENCH_CACHE
+
+import commonmark  # noqa: E402
+import browser  # noqa: E402
+
+# Размеры синтетических документов
+SIZES = [('1K', 1024), ('16K', 16 * 1024), ('256K', 256 * 1024), ('1M', 1024 * 1024),
+         ('10M', 10 * 1024 * 1024), ('50M', 50 * 1024 * 1024)]
+VARIANTS = ('mixed', 'links', 'images', 'lists', 'code')
+
+# Edge cases every parser backend must render exactly like commonmark (with the generated corpora)
+CONFORMANCE_CASES = [
+    "",
+    "plain text without newline",
+    "# ATX heading\n\nSetext heading\n==============\n\nSub\n---\n\n###### six ######\n",
+    "*em* **strong** ***both*** _under_ __dunder__ *nested **strong** em*\n",
+    "[link](page.md) [spaces](my page.md) [angle](<my page.md>) [paren](a(b)c.md) [title](p.md \"Title\")\n",
+    "[unicode](страница.md) [entity](a&amp;b.md) [escaped](a\\_b.md) [query](p.md?x=1&y=2#frag)\n",
+    "<http://example.com/auto> and <mail@example.com>\n",
+    "[ref][id] and [collapsed][] and [id]\n\n[id]: /target.md \"T\"\n[collapsed]: other.md\n",
+    "![alt text](pic.png) ![](empty.png) ![with *emph*](p.jpg \"t\") [![img in link](i.png)](l.md)\n",
+    "- a\n- b\n  - nested\n  - nested2\n- c\n\n1. one\n2. two\n\n3) three\n",
+    "- loose\n\n- list\n\n  second para\n",
+    "- item with `code` and [link](x.md)\n- ```\n  fenced in item\n  ```\n",
+    "> quote\n> > nested quote\n>\n> - list in quote\n",
+    "```python\nprint('hi')\n```\n\n~~~\ntilde\n~~~\n\n    indented code\n",
+    "inline `code` and ``double `tick` code``\n",
+    "<div>\nblock html\n</div>\n\ninline <span>html</span> here <!-- comment -->\n",
+    "hard  \nbreak and back\\\nslash break\nsoft break\n",
+    "***\n---\n___\n",
+    "&copy; &#169; &#xA9; \\*not em\\* \\[not link\\]\n",
+    "Текст по-русски с *курсивом* и [ссылкой](страница.md).\n",
+    "*[link in em](a.md)* **[link in strong](b.md)** [*em in link*](c.md)\n",
+    "Trailing spaces   \n\n\n\nmany blank lines\n",
+    "1. a\n\n   para in item\n\n       code in item\n2. b\n",
+]
+
+WORDS = ("alter net lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+         "incididunt ut labore et dolore magna aliqua").split()
+
+
+def sentence(rng, words=12):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def generate_block(rng, variant, n):
+    """Returns one top-level markdown block of the given corpus variant."""
+    if variant == 'links':
+        return ' '.join(f"[{rng.choice(WORDS)} {n}-{i}](page{n}-{i}.md)" for i in range(8)) + "\n\n"
+    if variant == 'images':
+        return ' '.join(f"![{rng.choice(WORDS)}](img/{n}-{i}.png) {sentence(rng, 3)}" for i in range(4)) + "\n\n"
+    if variant == 'lists':
+        return ''.join(f"- {sentence(rng, 6)} *{rng.choice(WORDS)}*\n" for _ in range(6)) + "\n"
+    if variant == 'code':
+        lines = '\n'.join(f"    x{i} = compute({i}, '{rng.choice(WORDS)}')  # {sentence(rng, 3)}" for i in range(8))
+        return f"```python\n{lines}\n```\n\n"
+    # mixed: roughly what real AlterNet pages look like
+    kind = n % 6
+    if kind == 0:
+        return f"## {sentence(rng, 4)}\n\n"
+    if kind == 1:
+        return f"{sentence(rng)} *{sentence(rng, 2)}* **{sentence(rng, 2)}** [{rng.choice(WORDS)}](p{n}.md).\n\n"
+    if kind == 2:
+        return ''.join(f"- [{sentence(rng, 3)}](item{n}-{i}.md)\n" for i in range(4)) + "\n"
+    if kind == 3:
+        return f"![{rng.choice(WORDS)}](img/{n}.png)\n{sentence(rng, 20)}\n\n"
+    if kind == 4:
+        return f"> {sentence(rng, 15)}\n\n"
+    return f"```\n{sentence(rng, 8)}\n{sentence(rng, 8)}\n```\n\n"
+
+
+@functools.lru_cache(maxsize=None)
+def generate_markdown(size, variant):
+    """Deterministic synthetic markdown document of about size bytes."""
+    rng = random.Random(f"{variant}-{size}")
+    blocks = []
+    total = 0
+    n = 0
+    while total < size:
+        block = generate_block(rng, variant, n)
+        blocks.append(block)
+        total += len(block)
+        n += 1
+    return ''.join(blocks)
+
+
+class FakeScreen:
+    """In-memory stand-in for a curses window: keeps the cells, counts what would be sent."""
+
+    def __init__(self, rows=50, cols=160):
+        self.rows = rows
+        self.cols = cols
+        self.cells = [[' '] * cols for _ in range(rows)]
+        self.y = self.x = 0
+        self.chars = 0
+        self.region = (0, rows - 1)
+
+    def getmaxyx(self):
+        return self.rows, self.cols
+
+    def clear(self):
+        for row in self.cells:
+            row[:] = [' '] * self.cols
+
+    def addstr(self, y, x, text, attr=0):
+        row = self.cells[y]
+        row[x:x + len(text)] = text
+        del row[self.cols:]
+        self.chars += len(text)
+        self.y, self.x = y, x + len(text)
+
+    def move(self, y, x):
+        self.y, self.x = y, x
+
+    def clrtoeol(self):
+        self.cells[self.y][self.x:] = [' '] * (self.cols - self.x)
+
+    def scrollok(self, flag):
+        pass
+
+    def setscrreg(self, top, bottom):
+        self.region = (top, bottom)
+
+    def scroll(self, lines):
+        top, bottom = self.region
+        block = self.cells[top:bottom + 1]
+        blank = [[' '] * self.cols for _ in range(abs(lines))]
+        block = block[lines:] + blank if lines > 0 else blank + block[:lines]
+        self.cells[top:bottom + 1] = block
+
+    def noutrefresh(self):
+        pass
+
+
+def make_browser(simple_mode=True):
+    """A browser that renders without a terminal: plain ints instead of curses attributes."""
+    b = browser.AlternetBrowser()
+    b.simple_mode = simple_mode
+    b.color_default, b.color_bold, b.color_italic, b.color_link = 0, 1, 2, 3
+    b.color_image, b.color_status, b.color_header = 4, 5, 6
+    return b
+
+
+def measure(op, setup=None, min_time=0.5, max_ops=10000):
+    """Runs op (after an untimed setup() each time) until min_time passes. Returns (ops, seconds)."""
+    ops = 0
+    elapsed = 0.0
+    while ops == 0 or (elapsed < min_time and ops < max_ops):
+        arg = setup() if setup is not None else None
+        started = time.perf_counter()
+        op(arg)
+        elapsed += time.perf_counter() - started
+        ops += 1
+    return ops, elapsed
+
+
+def peak_memory(op, setup=None):
+    """Peak bytes allocated by one run of op."""
+    arg = setup() if setup is not None else None
+    tracemalloc.start()
+    try:
+        op(arg)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(directory):
+    """Serves directory on a free localhost port in a background thread. Returns (server, base URL)."""
+    handler = functools.partial(QuietHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def pipeline_benchmarks(sizes, variants):
+    """Yields (name, size, setup, op) for parsing, rendering and painting."""
+    for size_name, size in sizes:
+        for variant in variants:
+            text = generate_markdown(size, variant)
+            base = f"{size_name}/{variant}"
+            yield f"parse/{base}", len(text), None, lambda _, text=text: commonmark.Parser().parse(text)
+            for simple_mode in (True, False):
+                b = make_browser(simple_mode)
+                mode = 'simple' if simple_mode else 'normal'
+                yield (f"render-{mode}/{base}", len(text), None,
+                       lambda _, b=b, text=text: b.render_markdown_to_curses(text, 'http://bench.invalid/'))
+            # A revisit: the rendered page is read back from the render cache's file, not parsed
+            cache = browser.RenderCache(BENCH_CACHE, max_bytes=1 << 40, memory_bytes=0)
+            key = cache.key(text, 'http://bench.invalid/', True)
+            cache.put(key, make_browser().render_markdown_to_curses(text, 'http://bench.invalid/'))
+            yield f"render-memo/{base}", len(text), None, lambda _, cache=cache, key=key: cache.get(key)
+        # Painting depends on the amount of laid out text, not on the markup: mixed only
+        yield from paint_benchmarks(size_name, generate_markdown(size, 'mixed'))
+
+
+def paint_benchmarks(size_name, text):
+    b = make_browser()
+    document = b.render_markdown_to_curses(text, 'http://bench.invalid/')
+    screen = FakeScreen()
+    # There is no terminal to flush to: the painter's doupdate() becomes a no-op
+    browser.curses.doupdate = lambda: None
+    b.stdscr = screen
+    b.painter = browser.ScreenPainter(screen)
+    layout = browser.Layout(document, screen.cols)
+    layout.finish()
+    page = screen.rows - 4
+    max_pos = max(0, layout.row_count - page)
+
+    def paint_frames(step):
+        def op(_):
+            # One screenful of frames, scrolling by step rows each
+            pos = 0
+            for _ in range(page):
+                b.display_content(layout, pos)
+                pos = pos + step if pos + step <= max_pos else 0
+        return op
+
+    def full_repaint(_):
+        b.painter.invalidate()
+        b.display_content(layout, 0)
+
+    yield f"layout/{size_name}/mixed", len(text), None, \
+        lambda _: browser.Layout(document, screen.cols).finish()
+    yield f"paint-scroll-line/{size_name}/mixed", len(text), None, paint_frames(1)
+    yield f"paint-scroll-page/{size_name}/mixed", len(text), None, paint_frames(page)
+    yield f"paint-full/{size_name}/mixed", len(text), None, full_repaint
+    yield from find_benchmarks(size_name, len(text), document, layout, page)
+
+
+def find_benchmarks(size_name, size, document, layout, page):
+    """In-page find: searching (lowercase index included) and one screenful of n presses."""
+    def find(query, regex=False):
+        return lambda _: browser.PageFind().search(document, query, regex)
+
+    finder = browser.PageFind()
+    finder.search(document, 'e')
+
+    def find_next(_):
+        for _ in range(page):
+            layout.row_for_offset(finder.starts[finder.step(0, 0)])
+
+    yield f"find-letter/{size_name}/mixed", size, None, find('e')
+    yield f"find-word/{size_name}/mixed", size, None, find('Dolore')
+    yield f"find-regex/{size_name}/mixed", size, None, find(r'\bdolor\w*')
+    yield f"find-next/{size_name}/mixed", size, None, find_next
+
+
+def page_memory(sizes, variants):
+    """Memory of each corpus page as render_ast's segment list and as the CompactDocument kept instead."""
+    print("\nPage memory (segment list -> compact document)")
+    pages = {}
+    for size_name, size in sizes:
+        for variant in variants:
+            rendered = browser.render_ast(browser.parse_markdown(generate_markdown(size, variant)),
+                                          'http://bench.invalid/')
+            segments = rendered.nbytes()
+            compact = browser.CompactDocument(rendered).nbytes()
+            name = f"page-memory/{size_name}/{variant}"
+            pages[name] = {'segment_bytes': segments, 'compact_bytes': compact}
+            print(f"  {name:34} {segments / 1024:10.1f} KB -> {compact / 1024:10.1f} KB"
+                  f"  ({segments / compact:4.1f}x)")
+    return pages
+
+
+def fetch_benchmarks(sizes):
+    """Yields fetch_markdown benchmarks against a local http.server: cold and 304 revalidation."""
+    site = tempfile.mkdtemp(prefix='site-', dir=BENCH_CACHE)
+    server, base_url = start_server(site)
+    b = make_browser()
+    try:
+        yield from fetch_pairs(b, site, base_url, sizes)
+    finally:
+        server.shutdown()
+
+
+def fetch_pairs(b, site, base_url, sizes):
+    for size_name, size in sizes:
+        name = f"doc-{size_name}.md"
+        with open(os.path.join(site, name), 'w', encoding='utf-8') as f:
+            f.write(generate_markdown(size, 'mixed'))
+        url = base_url + name
+
+        def cold_setup(b=b):
+            b.http_cache = browser.HttpCache(tempfile.mkdtemp(prefix='http-', dir=BENCH_CACHE))
+
+        yield f"fetch-cold/{size_name}", size, cold_setup, lambda _, b=b, url=url: b.fetch_markdown(url)
+        yield f"fetch-304/{size_name}", size, None, \
+            lambda _, b=b, url=url: b.fetch_markdown(url, revalidate=True)
+
+
+def installed_backends():
+    return [backend() for backend in browser.PARSER_BACKENDS.values() if backend().available()]
+
+
+def check_conformance(backends):
+    """Renders the conformance corpus with every backend. Returns {backend name: True if identical}."""
+    reference = browser.CommonmarkParser()
+    corpus = CONFORMANCE_CASES + [generate_markdown(16 * 1024, variant) for variant in VARIANTS]
+    conforming = {}
+    for backend in backends:
+        failures = 0
+        for n, text in enumerate(corpus):
+            for simple_mode in (True, False):
+                expected = browser.render_ast(reference.parse(text), 'http://bench.invalid/', simple_mode)
+                got = browser.render_ast(backend.parse(text), 'http://bench.invalid/', simple_mode)
+                if (got.segments, got.links, got.images) != (expected.segments, expected.links, expected.images):
+                    failures += 1
+                    print(f"conformance: {backend.name} differs on document {n} (simple_mode={simple_mode})")
+                    print(f"    expected {expected.segments[:8]} {expected.links[:4]}")
+                    print(f"    got      {got.segments[:8]} {got.links[:4]}")
+        conforming[backend.name] = failures == 0
+        print(f"conformance: {backend.name:12} {'OK' if not failures else f'{failures} MISMATCHES'} "
+              f"({len(corpus)} documents, both modes)", flush=True)
+    return conforming
+
+
+def backend_benchmarks(backends, sizes, variants):
+    """Yields parse + render_ast benchmarks for every backend."""
+    for size_name, size in sizes:
+        for variant in variants:
+            text = generate_markdown(size, variant)
+            for backend in backends:
+                yield (f"backend-{backend.name}/{size_name}/{variant}", len(text), None,
+                       lambda _, backend=backend, text=text:
+                       browser.render_ast(backend.parse(text), 'http://bench.invalid/'))
+
+
+def run(benchmarks, results, min_time, memory):
+    for name, size, setup, op in benchmarks:
+        ops, elapsed = measure(op, setup, min_time)
+        entry = {'ops': ops, 'seconds': round(elapsed, 6), 'ops_per_sec': ops / elapsed,
+                 'bytes': size, 'mb_per_sec': size * ops / elapsed / (1024 * 1024)}
+        if memory:
+            entry['peak_bytes'] = peak_memory(op, setup)
+        results[name] = entry
+        peak = f"{entry['peak_bytes'] / (1024 * 1024):9.2f} MB peak" if memory else ""
+        print(f"{name:40} {entry['ops_per_sec']:12.2f} ops/s {entry['mb_per_sec']:9.2f} MB/s {peak}", flush=True)
+
+
+def import_time():
+    """Milliseconds python -X importtime reports for importing browser.py, and the slowest imports."""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import browser'], cwd=REPO_DIR,
+                          capture_output=True, text=True, check=True)
+    total = None
+    modules = []
+    children = []
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package; children come before their parent
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].strip()
+        cumulative = int(parts[1]) / 1000
+        depth = (len(parts[2]) - len(parts[2].lstrip()) - 1) // 2
+        if depth == 1:
+            children.append((cumulative, name))
+        elif depth == 0:
+            if name == 'browser':
+                total = cumulative
+                modules = children  # Imported directly by browser.py
+            children = []
+    modules.sort(reverse=True)
+    return total, [(name, round(ms, 2)) for ms, name in modules[:5]]
+
+
+def first_paint_time(url, timeout=10.0):
+    """Milliseconds from starting browser.py on url in a pseudo-terminal until its first screen is drawn."""
+    import pty
+    started = time.perf_counter()
+    pid, fd = pty.fork()
+    if pid == 0:
+        env = dict(os.environ, TERM='xterm', LINES='30', COLUMNS='100')
+        os.execve(sys.executable, [sys.executable, os.path.join(REPO_DIR, 'browser.py'), url], env)
+    output = b''
+    try:
+        # The URL header is the first row of every painted frame
+        while b'URL:' not in output:
+            remaining = timeout - (time.perf_counter() - started)
+            if remaining <= 0:
+                raise RuntimeError(f"no screen painted within {timeout} s")
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if ready:
+                try:
+                    output += os.read(fd, 65536)
+                except OSError:
+                    raise RuntimeError("browser exited before painting: " + output.decode(errors='replace'))
+        return (time.perf_counter() - started) * 1000
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        os.close(fd)
+
+
+def idle_wakeups(url, seconds=2.0, timeout=10.0):
+    """Input loop wake-ups of browser.py left alone on url for seconds once the page is painted.
+
+    The window starts when the trace shows the page's paint; every loop iteration in it is a
+    wake-up without a key (nothing is typed), counted from the trace's 'wakeup' events.
+    """
+    import pty
+    trace = os.path.join(BENCH_CACHE, 'idle-trace.jsonl')
+    started = time.perf_counter()
+    pid, fd = pty.fork()
+    if pid == 0:
+        env = dict(os.environ, TERM='xterm', LINES='30', COLUMNS='100')
+        os.execve(sys.executable, [sys.executable, os.path.join(REPO_DIR, 'browser.py'), url, '--trace', trace],
+                  env)
+
+    def events(name):
+        try:
+            with open(trace, encoding='utf-8') as f:
+                lines = [line for line in f if line.endswith('\n')]  # The last one may be half written
+        except OSError:
+            return []
+        return [event for event in map(json.loads, lines) if event.get('event') == name]
+
+    idle_from = idle_until = None
+    try:
+        while idle_until is None or time.time() < idle_until:
+            if idle_until is None and events('paint'):
+                idle_from = time.time()
+                idle_until = idle_from + seconds
+            elif idle_until is None and time.perf_counter() - started > timeout:
+                raise RuntimeError(f"page not painted within {timeout} s")
+            ready, _, _ = select.select([fd], [], [], 0.05)
+            if ready:
+                os.read(fd, 65536)  # Keep the terminal drained so the browser never blocks on output
+        os.write(fd, b'q')
+        while True:
+            try:
+                if not os.read(fd, 65536):
+                    break
+            except OSError:
+                break  # The browser quit and closed the terminal
+    finally:
+        os.waitpid(pid, 0)
+        os.close(fd)
+    sessions = events('session')
+    if not sessions:
+        raise RuntimeError("the browser wrote no session event to its trace")
+    wakeups = [event for event in events('wakeup') if idle_from <= event['ts'] <= idle_until]
+    return {'seconds': seconds, 'iterations': sessions[-1]['iterations'], 'idle_wakeups': len(wakeups)}
+
+
+def run_startup(results, runs, only=None):
+    """Start-up benchmarks: median import and first-paint times over runs runs."""
+    page = os.path.join(BENCH_CACHE, 'startup.md')
+    with open(page, 'w', encoding='utf-8') as f:
+        f.write(generate_markdown(16 * 1024, 'mixed'))
+    checks = [('startup/import', lambda: import_time()[0]),
+              ('startup/first-paint', lambda: first_paint_time('file://' + page))]
+    for name, sample in checks:
+        if only and not name.startswith(only):
+            continue
+        times = [sample() for _ in range(runs)]
+        ms = statistics.median(times)
+        entry = {'ops': runs, 'seconds': round(sum(times) / 1000, 6), 'ops_per_sec': 1000 / ms, 'ms': ms}
+        if name == 'startup/import':
+            entry['slowest_imports'] = import_time()[1]
+        results[name] = entry
+        print(f"{name:40} {entry['ops_per_sec']:12.2f} ops/s {ms:9.1f} ms median", flush=True)
+        for module, module_ms in entry.get('slowest_imports', []):
+            print(f"    {module:36} {module_ms:9.1f} ms")
+
+
+def compare(results, baseline, threshold):
+    """Prints the change against a baseline run. Returns the names that got slower than threshold."""
+    regressions = []
+    print(f"\nCompared with the baseline (regression threshold {threshold:.0%}):")
+    for name, entry in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        change = entry['ops_per_sec'] / old['ops_per_sec'] - 1
+        mark = ""
+        if change < -threshold:
+            mark = "  REGRESSION"
+            regressions.append(name)
+        line = f"{name:40} {change:+8.1%}"
+        if 'peak_bytes' in entry and 'peak_bytes' in old and old['peak_bytes']:
+            line += f"  memory {entry['peak_bytes'] / old['peak_bytes'] - 1:+8.1%}"
+        print(line + mark)
+    return regressions
+
+
+def parse_size(text):
+    for name, size in SIZES:
+        if name.lower() == text.lower():
+            return size
+    raise argparse.ArgumentTypeError(f"size must be one of {', '.join(name for name, _ in SIZES)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AlterLynx pipeline benchmarks")
+    parser.add_argument('--max-size', type=parse_size, default=1024 * 1024, metavar='SIZE',
+                        help="largest corpus: " + ', '.join(name for name, _ in SIZES) + " (default: 1M)")
+    parser.add_argument('--variants', default=','.join(VARIANTS),
+                        help=f"corpus variants to run (default: {','.join(VARIANTS)})")
+    parser.add_argument('--only', metavar='PREFIX', help="run only benchmarks whose name starts with PREFIX")
+    parser.add_argument('--min-time', type=float, default=0.5, metavar='SEC',
+                        help="minimum time to repeat each benchmark for (default: 0.5)")
+    parser.add_argument('--no-memory', action='store_true', help="skip the tracemalloc peak memory runs")
+    parser.add_argument('--startup-runs', type=int, default=5, metavar='N',
+                        help="runs of each start-up benchmark, the median counts (default: 5)")
+    parser.add_argument('-o', '--output', default='bench-results.json', help="where to write the JSON results")
+    parser.add_argument('--baseline', metavar='FILE', help="earlier results to compare with")
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help="slowdown counted as a regression (default: 0.10)")
+    args = parser.parse_args()
+
+    sizes = [(name, size) for name, size in SIZES if size <= args.max_size]
+    variants = [v for v in args.variants.split(',') if v]
+    for variant in variants:
+        if variant not in VARIANTS:
+            parser.error(f"unknown variant {variant!r}")
+    benchmarks = [pipeline_benchmarks(sizes, variants), fetch_benchmarks(sizes)]
+
+    results = {}
+    conformance = {}
+    memory = {}
+    idle = {}
+    if not args.only or 'backend'.startswith(args.only[:7]):
+        backends = installed_backends()
+        print("Parser backends installed: " + ', '.join(backend.name for backend in backends))
+        conformance = check_conformance(backends)
+        benchmarks.append(backend_benchmarks(backends, sizes, variants))
+    try:
+        for group in benchmarks:
+            if args.only:
+                group = (b for b in group if b[0].startswith(args.only))
+            run(group, results, args.min_time, not args.no_memory)
+        if not args.only or 'page-memory'.startswith(args.only[:11]):
+            memory = page_memory(sizes, variants)
+        run_startup(results, max(1, args.startup_runs), args.only)
+        if not args.only or 'idle'.startswith(args.only[:4]):
+            page = os.path.join(BENCH_CACHE, 'idle.md')
+            with open(page, 'w', encoding='utf-8') as f:
+                f.write(generate_markdown(16 * 1024, 'mixed'))
+            idle = idle_wakeups('file://' + page)
+            print(f"{'idle/wakeups':40} {idle['idle_wakeups']:12d} in {idle['seconds']:.0f} s idle "
+                  f"({idle['iterations']} loop iterations in all)", flush=True)
+    finally:
+        shutil.rmtree(BENCH_CACHE, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'min_time': args.min_time,
+        },
+        'results': results,
+        'conformance': conformance,
+        'memory': memory,
+        'idle': idle,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+    if not all(conformance.values()):
+        print("Parser backends that render differently: "
+              + ', '.join(name for name, ok in conformance.items() if not ok))
+        sys.exit(1)
+    if idle.get('idle_wakeups'):
+        print("The input loop woke up while the browser was idle")
+        sys.exit(1)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
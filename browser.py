@@ -1,13 +1,2807 @@
-import requests
-import commonmark
 import os
-import tempfile
-from urllib.parse import urljoin, urlparse
-import mimetypes
-from PIL import Image
+from urllib.parse import urljoin, urlparse, urldefrag, unquote, quote, parse_qs
 import curses
-import time  # Для небольшой задержки при чтении второй цифры
+import time
 import sys  # Для получения аргументов командной строки
+from collections import OrderedDict, deque
+import threading
+import hashlib
+import json
+import marshal
+import argparse
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import queue
+from bisect import bisect_left, bisect_right
+from array import array
+from itertools import accumulate
+import posixpath
+import importlib
+import importlib.util
+import codecs
+import re
+import sqlite3
+import random
+import selectors
+import signal
+# requests, commonmark and PIL take most of the start-up time: they are imported where they are
+# used, and preload_modules() loads the first two in the background while the first screen shows.
+
+# Модули, которые загружаются в фоне после первой отрисовки (плюс модуль парсера)
+PRELOAD_MODULES = ('requests',)
+
+
+def preload_modules():
+    """Imports PRELOAD_MODULES and the markdown parser on a background thread.
+
+    The first fetch and parse then don't wait for them.
+    """
+    def load():
+        for name in PRELOAD_MODULES:
+            try:
+                __import__(name)
+            except ImportError:
+                pass  # Reported by the code that needs it
+        try:
+            select_parser(markdown_parser_name).load()
+        except (ImportError, ValueError):
+            pass
+
+    threading.Thread(target=load, name='preload', daemon=True).start()
+
+
+def wrap_span(text, start, end, width):
+    """Word-wraps text[start:end], one logical line, to width. Yields (start, end) offsets per screen row."""
+    if end - start <= width:
+        yield start, end
+        return
+    while start < end:
+        row_end = start + width
+        if row_end >= end:
+            yield start, end
+            return
+        cut = text.rfind(' ', start + 1, row_end + 1)
+        if cut > start:
+            yield start, cut
+            start = cut + 1  # Swallow the space we broke at
+        else:
+            yield start, row_end  # No space: hard break inside the word
+            start = row_end
+
+
+class LinkRecord:
+    """A link or image of a rendered page: its absolute URL and where its label sits in the text."""
+
+    __slots__ = ('url', 'start', 'end')
+
+    def __init__(self, url, start, end):
+        self.url = url
+        self.start = start
+        self.end = end
+
+
+class LinkTable:
+    """The links (or images) of a CompactDocument, indexed from 0 in numbering order.
+
+    URLs are kept joined in one string and offsets in arrays; indexing builds a LinkRecord.
+    """
+
+    __slots__ = ('urls', 'url_ends', 'starts', 'ends')
+
+    def __init__(self):
+        self.urls = ''
+        self.url_ends = array('I')
+        self.starts = array('I')  # Offsets of the labels in the document text
+        self.ends = array('I')
+
+    def extend(self, records):
+        """Adds (url, start, end) tuples."""
+        added = []
+        end = len(self.urls)
+        for url, start, label_end in records:
+            added.append(url)
+            end += len(url)
+            self.url_ends.append(end)
+            self.starts.append(start)
+            self.ends.append(label_end)
+        self.urls += ''.join(added)
+
+    def __len__(self):
+        return len(self.url_ends)
+
+    def state(self):
+        """The table as a tuple of str and bytes, for marshal (see from_state)."""
+        return self.urls, self.url_ends.tobytes(), self.starts.tobytes(), self.ends.tobytes()
+
+    @classmethod
+    def from_state(cls, state):
+        table = cls()
+        table.urls, url_ends, starts, ends = state
+        table.url_ends.frombytes(url_ends)
+        table.starts.frombytes(starts)
+        table.ends.frombytes(ends)
+        return table
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.url_ends)
+        if not 0 <= index < len(self.url_ends):
+            raise IndexError(index)
+        url_start = self.url_ends[index - 1] if index else 0
+        return LinkRecord(self.urls[url_start:self.url_ends[index]], self.starts[index], self.ends[index])
+
+    def nbytes(self):
+        return sys.getsizeof(self.urls) + sum(sys.getsizeof(table) for table in
+                                              (self.url_ends, self.starts, self.ends))
+
+
+class CompactDocument:
+    """A rendered page packed into one text buffer plus array tables.
+
+    text holds every segment joined. A styled run starts at each run_starts offset (with the style
+    ID in run_styles) and lasts until the next one; line_starts holds the offset of every logical
+    line, so a line or row is found by index instead of by splitting the text again.
+    """
+
+    __slots__ = ('text', 'run_starts', 'run_styles', 'line_starts', 'links', 'images')
+
+    def __init__(self, rendered=None):
+        self.text = ''
+        self.run_starts = array('I')
+        self.run_styles = array('B')
+        self.line_starts = array('I', [0])
+        self.links = LinkTable()
+        self.images = LinkTable()
+        if rendered is not None:
+            self.append(rendered)
+
+    def append(self, rendered):
+        """Adds a RenderedDocument at the end (progressive loading). It starts on a new line."""
+        base = len(self.text)
+        parts = []
+        if self.text and not self.text.endswith('\n'):
+            parts.append('\n')  # Its blocks were rendered separately from ours
+        offset = base + len(parts)
+        links = []
+        images = []
+        for part, style in rendered.segments:
+            # render_ast emits exactly one segment per link / image label, in order
+            if style == STYLE_LINK:
+                links.append((rendered.links[len(links)], offset, offset + len(part)))
+            elif style == STYLE_IMAGE:
+                images.append((rendered.images[len(images)], offset, offset + len(part)))
+            if not part:
+                continue
+            if not self.run_styles or self.run_styles[-1] != style:
+                self.run_starts.append(offset)
+                self.run_styles.append(style)
+            parts.append(part)
+            offset += len(part)
+        added = ''.join(parts)
+        self.line_starts.extend(base + end for end in accumulate(len(line) + 1 for line in added.split('\n')[:-1]))
+        self.text += added
+        self.links.extend(links)
+        self.images.extend(images)
+
+    @property
+    def line_count(self):
+        # A line start at the very end is the empty remainder after a final newline
+        if self.line_starts[-1] == len(self.text):
+            return len(self.line_starts) - 1
+        return len(self.line_starts)
+
+    def line_span(self, line_idx):
+        """(start, end) offsets of logical line line_idx, without its newline."""
+        start = self.line_starts[line_idx]
+        if line_idx + 1 < len(self.line_starts):
+            return start, self.line_starts[line_idx + 1] - 1
+        return start, len(self.text)
+
+    def runs(self, start, end, attrs):
+        """The (text, attr) runs covering text[start:end]; attrs maps style IDs to attributes."""
+        runs = []
+        run_starts = self.run_starts
+        count = len(run_starts)
+        if not count:
+            return runs
+        text = self.text
+        i = bisect_right(run_starts, start) - 1
+        lo = start
+        while i < count and lo < end:
+            hi = run_starts[i + 1] if i + 1 < count else len(text)
+            if hi > end:
+                hi = end
+            if hi > lo:
+                runs.append((text[lo:hi], attrs[self.run_styles[i]]))
+                lo = hi
+            i += 1
+        return runs
+
+    def dumps(self):
+        """The document as bytes: style IDs and offsets, nothing tied to a terminal (see loads)."""
+        return marshal.dumps((self.run_starts.itemsize, self.text, self.run_starts.tobytes(),
+                              self.run_styles.tobytes(), self.line_starts.tobytes(),
+                              self.links.state(), self.images.state()))
+
+    @classmethod
+    def loads(cls, data):
+        """Rebuilds a document written by dumps(). Raises ValueError if data is not one."""
+        try:
+            itemsize, text, run_starts, run_styles, line_starts, links, images = marshal.loads(data)
+            if itemsize != array('I').itemsize:
+                raise ValueError("written on a platform with another array item size")
+            document = cls()
+            document.text = text
+            document.run_starts.frombytes(run_starts)
+            document.run_styles.frombytes(run_styles)
+            document.line_starts = array('I')
+            document.line_starts.frombytes(line_starts)
+            document.links = LinkTable.from_state(links)
+            document.images = LinkTable.from_state(images)
+        except (EOFError, TypeError) as e:
+            raise ValueError(f"not a rendered document: {e}") from e
+        return document
+
+    def nbytes(self):
+        """Approximate memory held by the document."""
+        size = sys.getsizeof(self.text)
+        size += sum(sys.getsizeof(table) for table in (self.run_starts, self.run_styles, self.line_starts))
+        return size + self.links.nbytes() + self.images.nbytes()
+
+
+class Layout:
+    """Screen rows of a CompactDocument wrapped to one terminal width.
+
+    Rows are produced lazily, so the first screen of a huge page (or of a page that was just
+    resized) costs only the logical lines needed to fill it. A row is just its text offsets, so
+    row lookup is an index into the arrays below.
+    """
+
+    # Сколько последних построенных строк экрана держать готовыми (прокрутка видит их снова)
+    ROW_CACHE_ROWS = 512
+
+    def __init__(self, document, width):
+        self.document = document
+        self.width = max(1, width)
+        self.row_starts = array('I')  # Text offset where every screen row starts
+        self.row_ends = array('I')
+        self.row_lines = array('I')  # Logical line of every row
+        self.line_first_row = array('I')  # First row of every logical line wrapped so far
+        self.row_cache = {}  # row -> runs, built with row_attrs
+        self.row_attrs = None
+
+    @property
+    def row_count(self):
+        return len(self.row_starts)
+
+    @property
+    def complete(self):
+        return len(self.line_first_row) == self.document.line_count
+
+    def ensure(self, row_count):
+        """Wraps more logical lines until at least row_count rows exist (or the page ends)."""
+        document = self.document
+        while len(self.row_starts) < row_count and not self.complete:
+            line_idx = len(self.line_first_row)
+            self.line_first_row.append(len(self.row_starts))
+            start, end = document.line_span(line_idx)
+            for row_start, row_end in wrap_span(document.text, start, end, self.width):
+                self.row_starts.append(row_start)
+                self.row_ends.append(row_end)
+                self.row_lines.append(line_idx)
+
+    def finish(self):
+        self.ensure(float('inf'))
+
+    def visible_rows(self, first, count, attrs):
+        """The (text, attr) runs of count rows from first; attrs maps style IDs to attributes."""
+        self.ensure(first + count)
+        last = min(first + count, len(self.row_starts))
+        if attrs != self.row_attrs or len(self.row_cache) > self.ROW_CACHE_ROWS:
+            self.row_cache = {}
+            self.row_attrs = attrs
+        rows = []
+        for row in range(first, last):
+            runs = self.row_cache.get(row)
+            if runs is None:
+                runs = self.row_cache[row] = self.document.runs(self.row_starts[row], self.row_ends[row], attrs)
+            rows.append(runs)
+        return rows
+
+    def nbytes(self):
+        """Approximate memory held by the row tables (the row cache is bounded by ROW_CACHE_ROWS)."""
+        return sum(sys.getsizeof(table) for table in
+                   (self.row_starts, self.row_ends, self.row_lines, self.line_first_row))
+
+    def anchor(self, row):
+        """Returns the (logical line, char offset) shown at row, to keep the place across resizes."""
+        self.ensure(row + 1)
+        if not self.row_starts:
+            return 0, 0
+        row = min(row, len(self.row_starts) - 1)
+        line_idx = self.row_lines[row]
+        return line_idx, self.row_starts[row] - self.document.line_starts[line_idx]
+
+    def row_for_anchor(self, line_idx, char_offset):
+        """Returns the row that shows char_offset of logical line line_idx in this layout."""
+        while len(self.line_first_row) <= line_idx and not self.complete:
+            self.ensure(len(self.row_starts) + 1)
+        if line_idx >= len(self.line_first_row):
+            return max(0, len(self.row_starts) - 1)
+        self.ensure(self.line_first_row[line_idx] + 1)
+        row = self.line_first_row[line_idx]
+        offset = self.document.line_starts[line_idx] + char_offset
+        while row + 1 < len(self.row_starts) and self.row_lines[row + 1] == line_idx \
+                and self.row_starts[row + 1] <= offset:
+            row += 1
+            if row + 1 >= len(self.row_starts):
+                self.ensure(row + 2)
+        return row
+
+    def row_for_offset(self, offset):
+        """Returns the row that shows text offset offset."""
+        line_starts = self.document.line_starts
+        line_idx = max(0, bisect_right(line_starts, offset) - 1)
+        return self.row_for_anchor(line_idx, offset - line_starts[line_idx])
+
+    def items_in_rows(self, table, first, count):
+        """Indexes (a range) of the links or images of table whose labels start in count rows from first."""
+        self.ensure(first + count)
+        last = min(first + count, len(self.row_starts)) - 1
+        if last < first:
+            return range(0)
+        # Labels are in text order, so the rows' text span maps to a slice of the table
+        return range(bisect_left(table.starts, self.row_starts[first]), bisect_left(table.starts, self.row_ends[last]))
+
+
+def overlay_runs(runs, row_start, overlays):
+    """Draws overlays, (text offset, text, attr) each, over a row's runs starting at offset row_start."""
+    cells = [(char, attr) for text, attr in runs for char in text]
+    for offset, text, attr in overlays:
+        for i, char in enumerate(text, offset - row_start):
+            if 0 <= i < len(cells):
+                cells[i] = (char, attr)
+    merged = []
+    for char, attr in cells:
+        if merged and merged[-1][1] == attr:
+            merged[-1][0].append(char)
+        else:
+            merged.append(([char], attr))
+    return [(''.join(chars), attr) for chars, attr in merged]
+
+
+def hint_labels(count, keys):
+    """count distinct hint strings over keys, all of the same (shortest possible) length."""
+    length = 1
+    while len(keys) ** length < count:
+        length += 1
+    labels = ['']
+    for _ in range(length):
+        labels = [label + key for label in labels for key in keys]
+    return labels[:count]
+
+
+class PageFind:
+    """Case-insensitive find in a rendered page: match offsets in text order, for highlighting and n/N.
+
+    The lowercased text is built once per document (again only if a streamed page grew), and the
+    matches of a query are kept until the query changes, so redraws and n/N are binary searches.
+    """
+
+    def __init__(self):
+        self.document = None
+        self.indexed = 0  # Length of document.text when lower was built
+        self.lower = None  # document.text lowercased, None when that changes offsets
+        self.query = ''
+        self.regex = False
+        self.error = None  # Why a regex did not compile
+        self.starts = array('I')  # Text offsets of the matches, in text order
+        self.ends = None  # End offsets of regex matches; plain matches all have length self.length
+        self.length = 0
+        self.current = None  # Index of the match jumped to last
+
+    def search(self, document, query, regex=False):
+        """Finds every match of query in document and returns how many; cached until either changes."""
+        text = document.text
+        if document is not self.document or len(text) != self.indexed:
+            self.document = document
+            self.indexed = len(text)
+            lower = text.lower()
+            # A few characters (e.g. 'İ') change length when lowercased; such pages are searched directly
+            self.lower = lower if len(lower) == len(text) else None
+            self.query = None
+        if query == self.query and regex == self.regex:
+            return len(self.starts)
+        self.clear()
+        self.query = query
+        self.regex = regex
+        self.error = None
+        if not query:
+            return 0
+        if not regex and self.lower is not None:
+            # Plain text: split() finds the matches and the piece lengths add up to their offsets,
+            # all in C, which keeps one-letter queries on multi-megabyte pages quick
+            needle = query.lower()
+            self.length = len(needle)
+            parts = self.lower.split(needle)
+            if len(parts) > 1:
+                self.starts = array('I', accumulate(map(self.length.__add__, map(len, parts[1:-1])),
+                                                    initial=len(parts[0])))
+            return len(self.starts)
+        try:
+            pattern = re.compile(query if regex else re.escape(query), re.IGNORECASE)
+        except re.error as e:
+            self.error = str(e)
+            return 0
+        self.ends = array('I')
+        for match in pattern.finditer(text):
+            start, end = match.span()
+            if end > start:  # Empty regex matches have nothing to highlight
+                self.starts.append(start)
+                self.ends.append(end)
+        return len(self.starts)
+
+    def clear(self):
+        self.query = ''
+        self.starts = array('I')
+        self.ends = None
+        self.current = None
+
+    def span(self, index):
+        """Text offsets (start, end) of match index."""
+        start = self.starts[index]
+        return start, self.ends[index] if self.ends is not None else start + self.length
+
+    def visible(self, first, last):
+        """Indexes (a range) of the matches overlapping text offsets first..last."""
+        # Matches do not overlap, so their ends are in text order too
+        if self.ends is not None:
+            lo = bisect_right(self.ends, first)
+        else:
+            lo = bisect_right(self.starts, first - self.length)
+        return range(lo, bisect_left(self.starts, last))
+
+    def step(self, first, last, forward=True):
+        """Moves to the next (or previous) match and returns its index; the search wraps around.
+
+        Goes on from the current match when it is on screen (text offsets first..last), else from first.
+        """
+        if self.current is not None and first <= self.starts[self.current] < last:
+            index = self.current + (1 if forward else -1)
+        else:
+            index = bisect_left(self.starts, first) - (0 if forward else 1)
+        self.current = index % len(self.starts)
+        return self.current
+
+
+class ScreenPainter:
+    """Paints whole-screen frames, rewriting only the rows that changed since the last frame.
+
+    A frame is a list of rows, each row a list of (text, attr) runs. Small scrolls of the content
+    area are done with the terminal's scroll region, so only the newly exposed rows are sent.
+    """
+
+    def __init__(self, stdscr):
+        self.stdscr = stdscr
+        self.painted = []  # Runs currently on screen, per row
+        self.size = None
+        self.dirty = True
+        self.scroll_key = None  # Identity of the scrolled content (the Layout) in the last frame
+        self.scroll_pos = 0
+        self.frame_bytes = 0  # Bytes sent to the terminal for the last frame that changed anything
+
+    def invalidate(self):
+        """Forces a full repaint, e.g. after another screen (search, message) drew over ours."""
+        self.dirty = True
+
+    def paint(self, frame, scroll_region=None, scroll_key=None, scroll_pos=0):
+        """Paints frame. scroll_region is the (top, bottom) row range showing scroll_key at scroll_pos.
+
+        Returns the bytes sent to the terminal for it (0 when nothing changed): the text and the
+        escape sequences this painter asks for, counted here rather than measured on the process, whose
+        other writes (cache files, the page index, --trace) are not terminal output.
+        """
+        max_y, max_x = self.stdscr.getmaxyx()
+        frame_bytes = 0
+
+        if self.dirty or self.size != (max_y, max_x):
+            self.stdscr.clear()  # The next update repaints the whole terminal
+            frame_bytes += len('\x1b[H\x1b[2J')
+            self.painted = [None] * max_y
+            self.size = (max_y, max_x)
+            self.dirty = False
+        elif scroll_region is not None and scroll_key is self.scroll_key and scroll_pos != self.scroll_pos:
+            top, bottom = scroll_region
+            delta = scroll_pos - self.scroll_pos
+            if abs(delta) <= (bottom - top) // 2:
+                # Let the terminal move the rows; only the exposed ones are repainted below
+                self.stdscr.scrollok(True)
+                self.stdscr.setscrreg(top, bottom)
+                self.stdscr.scroll(delta)
+                self.stdscr.setscrreg(0, max_y - 1)
+                self.stdscr.scrollok(False)
+                # Set the region, scroll it, reset the region
+                frame_bytes += len(f"\x1b[{top + 1};{bottom + 1}r\x1b[{abs(delta)}S\x1b[1;{max_y}r")
+                region = self.painted[top:bottom + 1]
+                if delta > 0:
+                    region = region[delta:] + [[]] * delta
+                else:
+                    region = [[]] * -delta + region[:delta]
+                self.painted[top:bottom + 1] = region
+        self.scroll_key = scroll_key
+        self.scroll_pos = scroll_pos
+
+        for y, runs in enumerate(frame[:max_y]):
+            if self.painted[y] != runs:
+                frame_bytes += self._paint_row(y, runs, max_x)
+                self.painted[y] = runs
+
+        self.stdscr.noutrefresh()
+        curses.doupdate()
+
+        if frame_bytes:
+            self.frame_bytes = frame_bytes
+        return frame_bytes
+
+    def _paint_row(self, y, runs, max_x):
+        """Paints one row and returns the bytes it takes on the terminal."""
+        x = 0
+        size = len(f"\x1b[{y + 1};1H")  # Cursor addressing
+        for text, attr in runs:
+            if x >= max_x:
+                break
+            text = text[:max_x - x]
+            try:
+                self.stdscr.addstr(y, x, text, attr)
+            except curses.error:
+                # Ignore if trying to addstr outside window bounds (bottom-right corner)
+                pass
+            x += len(text)
+            size += len(text.encode('utf-8', errors='replace')) + len('\x1b[0;1;7;38;5;1m')  # Text and its attributes
+        if x < max_x:
+            # A row filled to the last column leaves the cursor on the next row; don't clear that
+            self.stdscr.move(y, x)
+            self.stdscr.clrtoeol()
+            size += len('\x1b[K')
+        return size
+
+
+# Style IDs of rendered segments; the UI maps them to curses attributes, the CLI to ANSI codes
+STYLE_DEFAULT = 0
+STYLE_BOLD = 1
+STYLE_ITALIC = 2
+STYLE_LINK = 3
+STYLE_IMAGE = 4
+STYLE_HEADER = 5
+# Версия вывода render_ast: увеличивается при каждом его изменении, чтобы старые отрисовки из кэша не использовались
+RENDER_VERSION = 1
+# ANSI-последовательности для стилей (вывод команды render)
+ANSI_STYLES = ('', '\x1b[1;33m', '\x1b[3;36m', '\x1b[34m', '\x1b[32m', '\x1b[1;31m')
+
+
+class RenderedDocument:
+    """Output of render_ast: styled segments plus the page's own link and image tables.
+
+    segments is a list of (text, style ID) with embedded newlines; links and images hold the
+    absolute URLs numbered from link_start / image_start, in order of appearance.
+    """
+
+    def __init__(self, segments, links, images):
+        self.segments = segments
+        self.links = links
+        self.images = images
+
+    def text(self, ansi=False, width=None):
+        """Plain text (or text with ANSI colors), optionally word-wrapped to width."""
+        document = CompactDocument(self)
+        layout = Layout(document, width or max(1, len(document.text)))
+        layout.finish()
+        out = []
+        for row_runs in layout.visible_rows(0, layout.row_count, ANSI_STYLES if ansi else ('',) * len(ANSI_STYLES)):
+            out.append(''.join(f"{code}{part}\x1b[0m" if code else part for part, code in row_runs))
+        return '\n'.join(out) + '\n'
+
+    def nbytes(self):
+        """Approximate memory of the page kept as this (text, style) segment list."""
+        size = sys.getsizeof(self.segments) + sys.getsizeof(self.links) + sys.getsizeof(self.images)
+        size += sum(sys.getsizeof(part) + sys.getsizeof((part, style)) for part, style in self.segments)
+        return size + sum(sys.getsizeof(url) for url in self.links) + sum(sys.getsizeof(url) for url in self.images)
+
+
+class MarkdownNode:
+    """A node with the commonmark attributes render_ast reads, made by the non-commonmark backends."""
+    __slots__ = ('t', 'literal', 'destination', 'info', 'level')
+
+    def __init__(self, t, literal=None, destination=None, info=None, level=None):
+        self.t = t
+        self.literal = literal
+        self.destination = destination
+        self.info = info
+        self.level = level
+
+
+class NodeStream:
+    """Parsed document of a non-commonmark backend: the list of (node, entering) pairs."""
+
+    def __init__(self, events):
+        self.events = events
+
+    def walker(self):
+        return iter(self.events)
+
+
+def normalize_destination(url):
+    """Percent-encodes a link destination the way commonmark does, so every backend yields the same URLs."""
+    return quote(url.encode('utf-8'), safe=';/@:+?=&()%#*,')
+
+
+class ParserBackend:
+    """Parses markdown into a document whose walker() yields (node, entering) pairs like commonmark's.
+
+    Containers (document, paragraph, heading, emph, strong, link, image, list, item, block_quote)
+    are yielded entering and leaving; leaves (text, code, code_block, html_block, html_inline,
+    softbreak, linebreak, thematic_break) once, entering. Every backend must render identically,
+    see bench.py --only backend.
+    """
+    name = None
+    module = None  # Module the backend imports
+
+    def available(self):
+        try:
+            return importlib.util.find_spec(self.module) is not None
+        except (ImportError, ValueError):
+            return False
+
+    def load(self):
+        return importlib.import_module(self.module)
+
+    def parse(self, markdown_text):
+        raise NotImplementedError
+
+
+class CommonmarkParser(ParserBackend):
+    """The reference backend (pure Python)."""
+    name = 'commonmark'
+    module = 'commonmark'
+
+    def parse(self, markdown_text):
+        # A parser keeps state while parsing, so every call (on any thread) gets its own
+        return self.load().Parser().parse(markdown_text)
+
+
+class MarkdownItParser(ParserBackend):
+    """markdown-it-py in its CommonMark preset (pure Python, faster than commonmark)."""
+    name = 'markdown-it'
+    module = 'markdown_it'
+
+    def __init__(self):
+        self.md = None
+
+    def parse(self, markdown_text):
+        if self.md is None:
+            md = self.load().MarkdownIt('commonmark')
+            # Same destinations as commonmark: no link validation, commonmark's percent-encoding
+            md.validateLink = lambda url: True
+            md.normalizeLink = normalize_destination
+            self.md = md  # Parsing keeps its state per call, the instance can be shared
+        events = [(MarkdownNode('document'), True)]
+        for token in self.md.parse(markdown_text):
+            kind = token.type
+            if kind == 'inline':
+                self._inline(token.children or [], events)
+            elif kind in ('fence', 'code_block'):
+                info = token.info.strip() if kind == 'fence' else ''
+                events.append((MarkdownNode('code_block', token.content, info=info), True))
+            elif kind == 'html_block':
+                events.append((MarkdownNode('html_block', token.content), True))
+            elif kind == 'hr':
+                events.append((MarkdownNode('thematic_break'), True))
+            else:
+                node_type = self.BLOCKS.get(kind.rsplit('_', 1)[0])
+                if node_type is not None:
+                    level = int(token.tag[1:]) if node_type == 'heading' else None
+                    events.append((MarkdownNode(node_type, level=level), token.nesting > 0))
+        events.append((MarkdownNode('document'), False))
+        return NodeStream(events)
+
+    # Типы блоков markdown-it (без _open/_close) -> типы узлов commonmark
+    BLOCKS = {'paragraph': 'paragraph', 'heading': 'heading', 'blockquote': 'block_quote',
+              'bullet_list': 'list', 'ordered_list': 'list', 'list_item': 'item'}
+    # Типы строчных элементов markdown-it -> типы узлов commonmark
+    INLINE = {'em': 'emph', 'strong': 'strong', 'link': 'link'}
+
+    def _inline(self, tokens, events):
+        for token in tokens:
+            kind = token.type
+            if kind in ('text', 'text_special'):
+                events.append((MarkdownNode('text', token.content), True))
+            elif kind == 'softbreak':
+                events.append((MarkdownNode('softbreak'), True))
+            elif kind == 'hardbreak':
+                events.append((MarkdownNode('linebreak'), True))
+            elif kind == 'code_inline':
+                events.append((MarkdownNode('code', token.content), True))
+            elif kind == 'html_inline':
+                events.append((MarkdownNode('html_inline', token.content), True))
+            elif kind == 'image':
+                node = MarkdownNode('image', destination=token.attrs.get('src', ''))
+                events.append((node, True))
+                self._inline(token.children or [], events)  # The alt text
+                events.append((node, False))
+            else:
+                node_type = self.INLINE.get(kind.rsplit('_', 1)[0])
+                if node_type is not None:
+                    destination = token.attrs.get('href', '') if node_type == 'link' else None
+                    events.append((MarkdownNode(node_type, destination=destination), token.nesting > 0))
+
+
+class PyromarkParser(ParserBackend):
+    """pyromark: Python bindings of the pulldown-cmark parser (native code, the fastest)."""
+    name = 'pyromark'
+    module = 'pyromark'
+
+    # Блоки pulldown-cmark -> типы узлов commonmark
+    CONTAINERS = {'Paragraph': 'paragraph', 'Heading': 'heading', 'BlockQuote': 'block_quote', 'List': 'list',
+                  'Item': 'item', 'Emphasis': 'emph', 'Strong': 'strong', 'Link': 'link', 'Image': 'image'}
+    # Строчные события, которые в commonmark всегда лежат внутри абзаца
+    INLINE = ('Text', 'Code', 'InlineHtml', 'SoftBreak', 'HardBreak', 'Emphasis', 'Strong', 'Link', 'Image')
+
+    def parse(self, markdown_text):
+        events = [(MarkdownNode('document'), True)]
+        stack = []  # Open container nodes
+        literal = None  # Text collected for the code or HTML block being read
+        for event in self.load().events(markdown_text):
+            if isinstance(event, str):
+                kind, value = event, None
+            else:
+                (kind, value), = event.items()
+            if literal is not None:
+                if kind in ('Text', 'Html'):
+                    literal[1].append(value)
+                else:  # End of the code/HTML block
+                    node_type, parts, info = literal
+                    events.append((MarkdownNode(node_type, ''.join(parts), info=info), True))
+                    literal = None
+                continue
+
+            if kind in ('Start', 'End'):
+                name, data = (value, None) if isinstance(value, str) else next(iter(value.items()))
+            else:
+                name, data = kind, value
+            # Tight list items hold their text directly; commonmark puts it in a paragraph
+            if kind != 'End' and name in self.INLINE and stack and stack[-1].t == 'item':
+                node = MarkdownNode('paragraph', info='tight')
+                stack.append(node)
+                events.append((node, True))
+            elif stack and stack[-1].info == 'tight' and (kind == 'End' or name not in self.INLINE):
+                events.append((stack.pop(), False))
+
+            if kind == 'Start':
+                if name in ('CodeBlock', 'HtmlBlock'):
+                    info = None
+                    if name == 'CodeBlock':
+                        info = data['Fenced'].strip() if isinstance(data, dict) else ''
+                    literal = ('code_block' if name == 'CodeBlock' else 'html_block', [], info)
+                    continue
+                node_type = self.CONTAINERS.get(name)
+                if node_type is None:
+                    continue
+                node = MarkdownNode(node_type)
+                if node_type == 'heading':
+                    node.level = int(data['level'][1:])
+                elif node_type in ('link', 'image'):
+                    destination = data['dest_url']
+                    if data.get('link_type') == 'Email':
+                        destination = 'mailto:' + destination  # Autolinks like <user@host>
+                    node.destination = normalize_destination(destination)
+                stack.append(node)
+                events.append((node, True))
+            elif kind == 'End':
+                if name in self.CONTAINERS:
+                    events.append((stack.pop(), False))
+            elif kind == 'Text':
+                events.append((MarkdownNode('text', value), True))
+            elif kind == 'Code':
+                events.append((MarkdownNode('code', value), True))
+            elif kind == 'InlineHtml':
+                events.append((MarkdownNode('html_inline', value), True))
+            elif kind == 'SoftBreak':
+                events.append((MarkdownNode('softbreak'), True))
+            elif kind == 'HardBreak':
+                events.append((MarkdownNode('linebreak'), True))
+            elif kind == 'Rule':
+                events.append((MarkdownNode('thematic_break'), True))
+        events.append((MarkdownNode('document'), False))
+        return NodeStream(events)
+
+
+# Парсеры по имени; при автовыборе берётся первый установленный из PARSER_PREFERENCE
+PARSER_BACKENDS = {backend.name: backend for backend in (CommonmarkParser, MarkdownItParser, PyromarkParser)}
+PARSER_PREFERENCE = ('pyromark', 'commonmark')  # markdown-it measured no faster than commonmark
+markdown_parser_name = 'auto'  # Set by --parser
+markdown_parser = None  # The backend in use, picked on first parse
+
+
+def select_parser(name='auto'):
+    """Makes the named backend (or with 'auto' the fastest installed one) the parser in use and returns it."""
+    global markdown_parser, markdown_parser_name
+    if name == 'auto':
+        for candidate in PARSER_PREFERENCE:
+            backend = PARSER_BACKENDS[candidate]()
+            if backend.available():
+                break
+    else:
+        if name not in PARSER_BACKENDS:
+            raise ValueError(f"unknown parser {name!r}, choose from {', '.join(PARSER_BACKENDS)}")
+        backend = PARSER_BACKENDS[name]()
+        if not backend.available():
+            raise ValueError(f"parser {name!r} needs the {backend.module} module, which is not installed")
+    markdown_parser_name = name
+    markdown_parser = backend
+    return backend
+
+
+def parse_markdown(markdown_text):
+    """Parses markdown with the selected backend (see select_parser)."""
+    backend = markdown_parser or select_parser(markdown_parser_name)
+    return backend.parse(markdown_text)
+
+
+def render_ast(ast, base_url, simple_mode=True, link_start=1, image_start=1):
+    """Walks a parsed markdown AST into a RenderedDocument. Pure: touches no UI state."""
+    segments = []  # Store rendered segments
+    links = []
+    images = []
+    current_line = ""
+    current_style = STYLE_DEFAULT
+    link_counter = link_start
+    image_counter = image_start
+    in_code_block = False
+    code_block_lang = ""
+    walker = ast.walker()
+
+    for current, entering in walker:
+        node_type = current.t
+        literal = current.literal
+
+        if node_type == 'code_block':
+            if entering:
+                in_code_block = True
+                code_block_lang = current.info if current.info else "text"
+                current_line += f"\n```{code_block_lang}\n"
+                segments.append((current_line, STYLE_DEFAULT))
+                current_line = ""
+            else:
+                current_line += "\n```\n"
+                segments.append((current_line, STYLE_DEFAULT))
+                current_line = ""
+                in_code_block = False
+        elif node_type == 'code':
+            if entering:
+                current_line += "`"
+            else:
+                current_line += "`"
+        elif node_type == 'html_inline' or node_type == 'html_block':
+            # Skip HTML tags as per requirement
+            pass
+        elif node_type == 'text':
+            if not in_code_block:
+                current_line += literal
+            else:
+                current_line += literal
+        elif node_type == 'emph':  # Italic
+            if entering:
+                # Append current segment with previous style before changing
+                if current_line:
+                    segments.append((current_line, current_style))
+                    current_line = ""
+                current_style = STYLE_ITALIC
+            else:
+                # Append current segment with italic style before changing back
+                if current_line:
+                    segments.append((current_line, current_style))
+                    current_line = ""
+                current_style = STYLE_DEFAULT
+        elif node_type == 'strong':  # Bold
+            if entering:
+                # Append current segment with previous style before changing
+                if current_line:
+                    segments.append((current_line, current_style))
+                    current_line = ""
+                current_style = STYLE_BOLD
+            else:
+                # Append current segment with bold style before changing back
+                if current_line:
+                    segments.append((current_line, current_style))
+                    current_line = ""
+                current_style = STYLE_DEFAULT
+        elif node_type == 'link':
+            if entering:
+                # Store the destination URL for later use
+                dest_url = urljoin(base_url, current.destination)
+                links.append(dest_url)
+                # Append current segment with previous style before adding link
+                if current_line:
+                    segments.append((current_line, current_style))
+                    current_line = ""
+
+                if simple_mode:
+                    # Simple mode: only number and text
+                    link_text = f"[{link_counter}]"
+                else:
+                    # Normal mode: number and destination
+                    link_text = f"[Link {link_counter}: {current.destination}]"
+
+                segments.append((link_text, STYLE_LINK))
+                current_line = ""  # Reset line after adding link
+                link_counter += 1
+                current_style = STYLE_DEFAULT  # Reset style after link
+        elif node_type == 'image':
+            if entering:
+                # Store the image source URL for later use
+                img_src = urljoin(base_url, current.destination)
+                images.append(img_src)
+                # Append current segment with previous style before adding image
+                if current_line:
+                    segments.append((current_line, current_style))
+                    current_line = ""
+
+                if simple_mode:
+                    # Simple mode: only number and filename
+                    filename = os.path.basename(current.destination)
+                    image_text = f"[IMG {image_counter}: {filename}]"
+                else:
+                    # Normal mode: number and destination
+                    image_text = f"[Image {image_counter}: {current.destination}]"
+
+                segments.append((image_text, STYLE_IMAGE))
+                current_line = ""  # Reset line after adding image
+                image_counter += 1
+                current_style = STYLE_DEFAULT  # Reset style after image
+        elif node_type == 'heading':
+            if entering:
+                # Append current segment if any before the heading
+                if current_line:
+                    segments.append((current_line, current_style))
+                    current_line = ""
+                # Use the header style
+                current_style = STYLE_HEADER
+                current_line += "#" * current.level + " "
+            else:
+                current_line += "\n"
+                segments.append((current_line, current_style))
+                current_line = ""
+                current_style = STYLE_DEFAULT  # Reset style after heading
+        elif node_type == 'list':
+            # Add a newline before the list starts
+            if entering and current_line:
+                segments.append((current_line, current_style))
+                current_line = ""
+            elif entering:
+                if not simple_mode:  # Add newline in normal mode
+                    current_line += "\n"
+        elif node_type == 'item':
+            # Add a newline and a bullet before the item
+            if entering:
+                if current_line:
+                    segments.append((current_line, current_style))
+                    current_line = ""
+                if not simple_mode:  # Add newline in normal mode
+                    current_line += "\n"
+                current_line += " - "
+        elif node_type == 'paragraph':
+            if not entering:
+                current_line += "\n"
+                if simple_mode:  # Add an extra newline for paragraph separation in simple mode
+                    current_line += "\n"
+                segments.append((current_line, STYLE_DEFAULT))
+                current_line = ""
+        elif node_type == 'block_quote':
+            if entering:
+                # In simple mode, just add a space or a symbol to indicate quote
+                if simple_mode:
+                    current_line += "> "
+                else:
+                    current_line += "\n> "
+            else:
+                current_line += "\n"
+                segments.append((current_line, STYLE_DEFAULT))
+                current_line = ""
+        elif node_type == 'softbreak':
+            # In simple mode, treat as space; in normal mode, treat as space (as before)
+            if not simple_mode:
+                current_line += " "
+            else:
+                current_line += " "
+        elif node_type == 'linebreak':
+            # In simple mode, treat as newline; in normal mode, treat as newline (as before)
+            current_line += "\n"
+            if not simple_mode:
+                segments.append((current_line, STYLE_DEFAULT))
+                current_line = ""
+        elif node_type == 'thematic_break':
+            # In simple mode, just add a newline; in normal mode, add a line
+            if simple_mode:
+                current_line += "\n"
+            else:
+                current_line += "\n---\n"
+            segments.append((current_line, STYLE_DEFAULT))
+            current_line = ""
+
+    # Append any remaining text on the current line
+    if current_line:
+        segments.append((current_line, current_style))
+
+    # Add a final newline if needed (only if the last line didn't end with \n)
+    if current_line and not current_line.endswith('\n'):
+        segments.append(("\n", STYLE_DEFAULT))
+
+    return RenderedDocument(segments, links, images)
+
+
+def render_markdown(markdown_text, base_url, simple_mode=True, link_start=1, image_start=1):
+    """Parses and renders markdown text, see render_ast."""
+    return render_ast(parse_markdown(markdown_text), base_url, simple_mode, link_start, image_start)
+
+
+def extract_links(markdown_text, base_url, images=None):
+    """Returns (link_text, absolute_url) for every link in a markdown document.
+
+    If an images list is given, absolute URLs of the document's images are appended to it.
+    """
+    # Parse markdown to extract links and their text content
+    ast = parse_markdown(markdown_text)
+    walker = ast.walker()
+
+    links = []  # List of (link_text, destination_url)
+    current_link_text = None  # To accumulate text *inside* the link
+
+    for current, entering in walker:
+        node_type = current.t
+
+        if node_type == 'link':
+            if entering:
+                # Start collecting text for this link
+                current_link_text = ""
+            else:  # exiting the link node
+                dest_url = urljoin(base_url, current.destination)
+                # Use the accumulated text inside the link as the link text
+                link_text = current_link_text.strip()
+                if link_text and dest_url:  # Only add if both exist
+                    links.append((link_text, dest_url))
+                current_link_text = None
+        elif node_type == 'image' and entering and images is not None:
+            images.append(urljoin(base_url, current.destination))
+        elif node_type == 'text' and current_link_text is not None:
+            # We are inside a link: add the text literal to the current link's text
+            current_link_text += current.literal
+    return links
+
+
+def word_trigrams(text, partial_last_word=False):
+    """Trigrams of the lowercased words of text, padded like pg_trgm ("  w", " wo", ..., "rd ").
+
+    With partial_last_word the closing trigram of the last word is left out, so a word that is
+    still being typed matches as a prefix.
+    """
+    words = text.lower().split()
+    grams = []
+    for i, word in enumerate(words):
+        padded = f"  {word} "
+        if partial_last_word and i == len(words) - 1:
+            padded = padded[:-1]
+        grams.extend(padded[j:j + 3] for j in range(len(padded) - 2))
+    return grams
+
+
+class SiteIndex:
+    """Trigram index over the (name, url) pairs of list.md, persisted in the cache directory."""
+
+    VERSION = 1
+
+    def __init__(self, path, max_age=3600):
+        self.path = path
+        self.max_age = max_age  # Seconds before the list is fetched again
+        self.sites = []  # [(name, url), ...]
+        self.trigrams = {}  # trigram -> [site index, ...]
+        self.source_hash = None
+        self.checked_at = 0
+        self.loaded = False
+
+    def load(self):
+        """Reads the index from disk once. Returns True if usable entries are available."""
+        if not self.loaded:
+            self.loaded = True
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get('version') == self.VERSION:
+                    self.sites = [tuple(site) for site in data['sites']]
+                    self.trigrams = data['trigrams']
+                    self.source_hash = data['source_hash']
+                    self.checked_at = data['checked_at']
+            except (OSError, ValueError, KeyError):
+                pass
+        return bool(self.sites)
+
+    def is_stale(self):
+        return not self.sites or time.time() - self.checked_at > self.max_age
+
+    def update(self, markdown_text, base_url):
+        """Rebuilds the index from a freshly fetched list.md, unless its content did not change."""
+        source_hash = hashlib.sha1(markdown_text.encode('utf-8')).hexdigest()
+        if source_hash != self.source_hash:
+            self.sites = extract_links(markdown_text, base_url)
+            self.trigrams = {}
+            for site_id, (name, _) in enumerate(self.sites):
+                for gram in set(word_trigrams(name)):
+                    self.trigrams.setdefault(gram, []).append(site_id)
+            self.source_hash = source_hash
+        self.checked_at = time.time()
+        self.save()
+
+    def save(self):
+        data = {
+            'version': self.VERSION,
+            'source_hash': self.source_hash,
+            'checked_at': self.checked_at,
+            'sites': self.sites,
+            'trigrams': self.trigrams,
+        }
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass  # The in-memory index still works for this session
+
+    def search(self, query):
+        """Returns (name, url) pairs ranked by trigram similarity to query; all sites for an empty query."""
+        query_lower = query.lower().strip()
+        if not query_lower:
+            return list(self.sites)
+        grams = set(word_trigrams(query_lower, partial_last_word=True))
+        shared = {}
+        for gram in grams:
+            for site_id in self.trigrams.get(gram, ()):
+                shared[site_id] = shared.get(site_id, 0) + 1
+
+        ranked = []
+        for site_id, count in shared.items():
+            name_lower = self.sites[site_id][0].lower()
+            score = count / len(grams)
+            if query_lower in name_lower:
+                score += 1.0
+                if name_lower.startswith(query_lower):
+                    score += 0.5
+            elif score < 0.3:
+                continue  # Too few trigrams in common to be a misspelling of the query
+            ranked.append((-score, name_lower, site_id))
+        ranked.sort()
+        return [self.sites[site_id] for _, _, site_id in ranked]
+
+
+class PageIndex:
+    """SQLite FTS5 full-text index of every page fetch_markdown has loaded.
+
+    Pages are added from any thread; a single writer thread owns the database writes. A page is
+    re-indexed only when its content hash changes, so revisiting an unchanged page costs nothing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = queue.Queue()
+        self.writer = None
+        self.reader = None  # Connection used by the UI thread for queries
+        self.lock = threading.Lock()
+        self.available = True  # False if this SQLite has no FTS5
+        self.known_hashes = {}  # url -> content hash already indexed in this session
+
+    def connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=10)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # The UI reader and the writer may both connect first: one of them creates the schema
+        # (IF NOT EXISTS covers another process, e.g. a gateway, sharing the file)
+        with self.lock:
+            connection.execute("CREATE TABLE IF NOT EXISTS pages ("
+                               "id INTEGER PRIMARY KEY, url TEXT UNIQUE, content_hash TEXT, title TEXT, "
+                               "indexed_at REAL)")
+            exists = connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'pages_fts'").fetchone()
+            if not exists:
+                connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS pages_fts USING fts5("
+                                   "title, body, tokenize='unicode61 remove_diacritics 2')")
+                # Matches in the title weigh more than matches in the body
+                connection.execute("INSERT INTO pages_fts(pages_fts, rank) VALUES('rank', 'bm25(5.0, 1.0)')")
+            connection.commit()
+        return connection
+
+    def add(self, url, markdown_text):
+        """Queues a loaded page for (re-)indexing. Cheap enough to call on every fetch."""
+        if not self.available:
+            return
+        content_hash = hashlib.sha1(markdown_text.encode('utf-8')).hexdigest()
+        with self.lock:
+            if self.known_hashes.get(url) == content_hash:
+                return
+            self.known_hashes[url] = content_hash
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._write_loop, name='page-index', daemon=True)
+                self.writer.start()
+        self.pending.put((url, content_hash, markdown_text))
+
+    def search(self, query, limit=50):
+        """Returns [(url, title, snippet)] ranked by bm25. Matches in snippets are wrapped in \\x02/\\x03."""
+        terms = re.findall(r'\w+', query)
+        if not terms or not self.available:
+            return []
+        # Every term must match; the last one may still be being typed, so all match as prefixes
+        fts_query = ' '.join(f'"{term}"*' for term in terms)
+        try:
+            if self.reader is None:
+                self.reader = self.connect()
+            return self.reader.execute(
+                "SELECT p.url, p.title, snippet(pages_fts, 1, char(2), char(3), '...', 12) "
+                "FROM pages_fts JOIN pages p ON p.id = pages_fts.rowid "
+                "WHERE pages_fts MATCH ? ORDER BY rank LIMIT ?", (fts_query, limit)).fetchall()
+        except (sqlite3.Error, OSError):
+            return []
+
+    def _write_loop(self):
+        try:
+            connection = self.connect()
+        except (sqlite3.Error, OSError):
+            self.available = False  # No FTS5 (or no disk): full-text search is simply off
+            return
+        while True:
+            url, content_hash, markdown_text = self.pending.get()
+            try:
+                self._index(connection, url, content_hash, markdown_text)
+                if self.pending.empty():
+                    connection.commit()  # Batch commits while pages keep arriving
+            except sqlite3.Error:
+                connection.rollback()
+
+    def _index(self, connection, url, content_hash, markdown_text):
+        row = connection.execute("SELECT id, content_hash FROM pages WHERE url = ?", (url,)).fetchone()
+        if row is not None and row[1] == content_hash:
+            return
+        # Index the words, not link targets: [text](dest) -> text
+        body = re.sub(r'!?\[([^\]]*)\]\([^)]*\)', r'\1', markdown_text)
+        title_match = re.search(r'^#+\s+(.+)$', markdown_text, re.MULTILINE)
+        title = title_match.group(1).strip() if title_match else url
+        if row is None:
+            cursor = connection.execute(
+                "INSERT INTO pages (url, content_hash, title, indexed_at) VALUES (?, ?, ?, ?)",
+                (url, content_hash, title, time.time()))
+            page_id = cursor.lastrowid
+        else:
+            page_id = row[0]
+            connection.execute("UPDATE pages SET content_hash = ?, title = ?, indexed_at = ? WHERE id = ?",
+                               (content_hash, title, time.time(), page_id))
+            connection.execute("DELETE FROM pages_fts WHERE rowid = ?", (page_id,))
+        connection.execute("INSERT INTO pages_fts (rowid, title, body) VALUES (?, ?, ?)",
+                           (page_id, title, body))
+
+
+def is_web_url(url):
+    """True for absolute http(s) URLs, the only ones taken from pages (not typed by the user)."""
+    return url.lower().startswith(('http://', 'https://')) and bool(urlparse(url).netloc)
+
+
+def mirror_path(mirror_dir, url):
+    """Maps an http(s) URL to its file in a crawl mirror: <mirror_dir>/<host>/<path>."""
+    parsed = urlparse(url)
+    path = posixpath.normpath('/' + unquote(parsed.path)).lstrip('/')  # No escaping the mirror with ..
+    if not path or parsed.path.endswith('/'):
+        path = posixpath.join(path, 'main.md')
+    if parsed.query:
+        root, ext = posixpath.splitext(path)
+        path = f"{root}_{hashlib.sha1(parsed.query.encode('utf-8')).hexdigest()[:8]}{ext}"
+    host = parsed.netloc.replace(':', '_')
+    if host in ('', '.', '..'):
+        host = '_' + host  # Nor with a host of ..
+    return os.path.join(mirror_dir, host, *path.split('/'))
+
+
+class Crawler:
+    """Breadth-first crawler that mirrors AlterNet pages (and optionally images) into a directory.
+
+    Progress is appended to a journal in the mirror directory, so an interrupted crawl can resume.
+    """
+
+    JOURNAL_NAME = 'crawl-journal.jsonl'
+
+    def __init__(self, browser, out_dir, max_depth=2, concurrency=4, delay=1.0, images=False,
+                 same_host=False, max_image_bytes=5 * 1024 * 1024):
+        self.browser = browser
+        self.out_dir = out_dir
+        self.max_depth = max_depth
+        self.concurrency = concurrency
+        self.delay = delay  # Seconds between two requests to the same host
+        self.images = images
+        self.same_host = same_host
+        self.max_image_bytes = max_image_bytes
+        self.lock = threading.Lock()
+        self.next_request_at = {}  # host -> earliest time of the next request to it
+        self.seen_images = set()
+        self.journal = None
+
+    def run(self, seeds, resume=False):
+        """Crawls from the seed URLs. Returns (pages saved, pages failed)."""
+        os.makedirs(self.out_dir, exist_ok=True)
+        journal_path = os.path.join(self.out_dir, self.JOURNAL_NAME)
+        seen = set()
+        frontier = deque()  # (url, depth), breadth-first
+        if resume and os.path.exists(journal_path):
+            queued = {}
+            finished = set()
+            with open(journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue  # Last line may be cut off by the interruption
+                    if event['event'] == 'queued':
+                        queued.setdefault(event['url'], event['depth'])
+                    else:
+                        finished.add(event['url'])
+            seen.update(queued)
+            frontier.extend((url, depth) for url, depth in queued.items()
+                            if url not in finished and (depth == 0 or is_web_url(url)))
+            self.journal = open(journal_path, 'a', encoding='utf-8')
+        else:
+            self.journal = open(journal_path, 'w', encoding='utf-8')
+        # Seeds may be local files; everything found on pages must be on the web
+        seeds = [self.browser.normalize_url(seed, local_files=True) for seed in seeds]
+        seed_hosts = {urlparse(seed).netloc for seed in seeds}
+
+        def enqueue(url, depth):
+            url = urldefrag(url)[0]
+            if url in seen or not url.lower().endswith('.md'):
+                return
+            if depth and not is_web_url(url):
+                return  # A file:// link on a crawled page would copy our own files into the mirror
+            if self.same_host and urlparse(url).netloc not in seed_hosts:
+                return
+            seen.add(url)
+            frontier.append((url, depth))
+            self.write_journal('queued', url, depth)
+
+        for seed in seeds:
+            enqueue(seed, 0)
+
+        saved = failed = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            in_flight = {}
+            try:
+                while frontier or in_flight:
+                    while frontier and len(in_flight) < self.concurrency:
+                        url, depth = frontier.popleft()
+                        in_flight[pool.submit(self.crawl_page, url)] = (url, depth)
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        url, depth = in_flight.pop(future)
+                        try:
+                            error, links = future.result()
+                        except Exception as e:
+                            # E.g. a full disk or a page the parser chokes on: fail this page, not the crawl
+                            error, links = f"{type(e).__name__}: {e}", []
+                        if error:
+                            failed += 1
+                            self.write_journal('failed', url, depth)
+                            print(f"[{depth}] FAILED {url}: {error}")
+                            continue
+                        saved += 1
+                        self.write_journal('done', url, depth)
+                        print(f"[{depth}] {url} ({saved} saved, {len(frontier) + len(in_flight)} queued)")
+                        if depth < self.max_depth:
+                            for link in links:
+                                enqueue(self.browser.normalize_url(link), depth + 1)
+            except KeyboardInterrupt:
+                # Let requests already running finish; the journal lets the next run resume
+                for future in in_flight:
+                    future.cancel()
+                print("Interrupted; continue with --resume.")
+        self.journal.close()
+        return saved, failed
+
+    def write_journal(self, event, url, depth):
+        self.journal.write(json.dumps({'event': event, 'url': url, 'depth': depth}) + '\n')
+        self.journal.flush()
+
+    def wait_for_host(self, url):
+        """Sleeps until the politeness delay for url's host has passed, and books the next slot."""
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_request_at.get(host, 0))
+            self.next_request_at[host] = start + self.delay
+        if start > now:
+            time.sleep(start - now)
+
+    def crawl_page(self, url):
+        """Fetches and saves one page (and its images). Returns (error or None, links)."""
+        self.wait_for_host(url)
+        markdown_text = self.browser.fetch_markdown(url)
+        if markdown_text.startswith("[ERROR]"):
+            return markdown_text, []
+        path = mirror_path(self.out_dir, url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(markdown_text)
+
+        image_urls = []
+        links = [link for _, link in extract_links(markdown_text, url, image_urls)]
+        if self.images:
+            for image_url in image_urls:
+                with self.lock:
+                    if image_url in self.seen_images:
+                        continue
+                    self.seen_images.add(image_url)
+                self.save_image(image_url)
+        return None, links
+
+    def save_image(self, image_url):
+        import requests
+        path = mirror_path(self.out_dir, image_url)
+        if os.path.exists(path) or not image_url.startswith(('http://', 'https://')):
+            return
+        self.wait_for_host(image_url)
+        tmp_path = path + '.part'
+
+        def read(response):
+            response.raise_for_status()
+            size = 0
+            with open(tmp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    size += len(chunk)
+                    if size > self.max_image_bytes:
+                        raise ValueError(f"image larger than {self.max_image_bytes} bytes")
+                    f.write(chunk)
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.browser.transport.fetch(image_url, read, merge=False)
+            os.replace(tmp_path, path)
+        except (requests.exceptions.RequestException, OSError, ValueError) as e:
+            print(f"    image skipped {image_url}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+# Браузер процесса-исполнителя команды render
+render_browser = None
+
+
+def render_worker_init(offline, mirror_dir, parser_name='auto'):
+    """Process pool initializer of the render command: one fetching browser per process."""
+    global render_browser
+    select_parser(parser_name)
+    render_browser = AlternetBrowser()
+    render_browser.offline = offline
+    render_browser.mirror_dir = mirror_dir
+
+
+def render_output(markdown_text, url, simple_mode, ansi, width, references):
+    """Text (or ANSI) of a page as the render command and the gateway print it."""
+    document = render_markdown(markdown_text, url, simple_mode)
+    output = document.text(ansi, width)
+    if references and (document.links or document.images):
+        output += "\nLinks:\n" + ''.join(f"[{n}] {link}\n" for n, link in enumerate(document.links, 1))
+        if document.images:
+            output += "\nImages:\n" + ''.join(f"[{n}] {image}\n" for n, image in enumerate(document.images, 1))
+    return output
+
+
+def render_source(source, target, simple_mode, ansi, width, references):
+    """Fetches and renders one URL or file for the render command. Returns (output or None, error).
+
+    With a target path the output is written there (and the path returned) instead of returned.
+    """
+    url = render_browser.normalize_url(source, local_files=True)
+    markdown_text = render_browser.fetch_markdown_unindexed(url)
+    if markdown_text.startswith("[ERROR]"):
+        return None, markdown_text
+    output = render_output(markdown_text, url, simple_mode, ansi, width, references)
+    if target is None:
+        return output, None
+    try:
+        os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+        with open(target, 'w', encoding='utf-8') as f:
+            f.write(output)
+    except OSError as e:
+        return None, f"[ERROR] Failed to write {target}: {e}"
+    return target, None
+
+
+class Gateway:
+    """Fetch and render service shared by many clients (`browser.py serve`).
+
+    Pages come through one AlternetBrowser, so every client shares its HTTP cache and transport,
+    and concurrent requests for one URL become a single upstream fetch. Rendered output is kept
+    in an LRU cache keyed by the page content and the render options.
+    """
+
+    # Сколько байт отрисованного вывода держать в памяти
+    RENDER_CACHE_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, browser, max_bytes=RENDER_CACHE_BYTES):
+        self.browser = browser
+        self.max_bytes = max_bytes
+        self.renders = OrderedDict()  # (content hash, options) -> output bytes, least recently used first
+        self.total_bytes = 0
+        self.in_flight = {}  # Same key -> InFlightRequest of the render running for it
+        self.lock = threading.Lock()
+        self.counts = {'pages': 0, 'renders': 0, 'render_hits': 0, 'render_merged': 0, 'errors': 0}
+
+    def page(self, source):
+        """Returns (url, markdown text, error) for an absolute http(s) URL.
+
+        Raises ValueError for anything else: local paths and file:// URLs would let any client
+        read the gateway's files.
+        """
+        if not source.lower().startswith(('http://', 'https://')) or not urlparse(source).netloc:
+            raise ValueError(f"Only absolute http:// and https:// URLs can be fetched: {source}")
+        url = self.browser.normalize_url(source)
+        text = self.browser.fetch_markdown_unindexed(url)
+        with self.lock:
+            self.counts['pages'] += 1
+            if text.startswith("[ERROR]"):
+                self.counts['errors'] += 1
+        if text.startswith("[ERROR]"):
+            return url, None, text
+        return url, text, None
+
+    def render(self, source, simple_mode=True, ansi=False, width=None, references=True):
+        """Returns (output bytes, error) of the page, rendered like the render command does."""
+        url, text, error = self.page(source)
+        if error is not None:
+            return None, error
+        key = (hashlib.sha1(text.encode('utf-8')).hexdigest(), url, simple_mode, ansi, width, references)
+        with self.lock:
+            self.counts['renders'] += 1
+            output = self.renders.get(key)
+            if output is not None:
+                self.renders.move_to_end(key)
+                self.counts['render_hits'] += 1
+                return output, None
+            waiting = self.in_flight.get(key)
+            if waiting is None:
+                request = self.in_flight[key] = InFlightRequest()
+            else:
+                self.counts['render_merged'] += 1
+        if waiting is not None:
+            waiting.done.wait()
+            return waiting.result, waiting.error
+
+        try:
+            request.result = render_output(text, url, simple_mode, ansi, width, references).encode('utf-8')
+        except Exception as e:
+            request.error = f"[ERROR] Failed to render {url}: {e}"
+        with self.lock:
+            del self.in_flight[key]
+            if request.result is not None:
+                self.renders[key] = request.result
+                self.total_bytes += len(request.result)
+                while self.total_bytes > self.max_bytes and self.renders:
+                    _, dropped = self.renders.popitem(last=False)
+                    self.total_bytes -= len(dropped)
+        request.done.set()
+        return request.result, request.error
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts, render_entries=len(self.renders), render_bytes=self.total_bytes)
+        stats['hosts'] = self.browser.transport.stats()
+        return stats
+
+
+def gateway_server(gateway, host='127.0.0.1', port=8070, socket_path=None, workers=16):
+    """Builds the HTTP server of the gateway; requests are answered by a pool of worker threads.
+
+    GET /page?url=U returns the markdown of U (with an ETag, so clients can revalidate), GET
+    /render?url=U[&format=ansi][&mode=normal][&width=N][&references=0] the rendered text and
+    GET /stats the counters as JSON. With socket_path the server listens on a Unix socket instead.
+    URLs other than absolute http(s) ones get 400. A page that could not be fetched or rendered gets
+    500, not 502: the gateway has retried already, and clients' Transport would retry a 502 again.
+    """
+    import http.server
+    import socketserver
+    pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='gateway')
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        server_version = "AlterLynxGateway/1"
+
+        def do_GET(self):
+            parsed = urlparse(self.path)
+            params = {name: values[-1] for name, values in parse_qs(parsed.query).items()}
+            if parsed.path == '/stats':
+                self.reply(200, json.dumps(gateway.stats()).encode('utf-8'), 'application/json')
+            elif parsed.path not in ('/page', '/render'):
+                self.reply(404, b"Unknown path: use /page, /render or /stats\n")
+            elif not params.get('url'):
+                self.reply(400, b"Missing url parameter\n")
+            elif parsed.path == '/page':
+                try:
+                    _, text, error = gateway.page(params['url'])
+                except ValueError as e:
+                    self.reply(400, f"{e}\n".encode('utf-8'))
+                    return
+                if error is not None:
+                    self.reply(500, error.encode('utf-8'))
+                    return
+                body = text.encode('utf-8')
+                etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+                if self.headers.get('If-None-Match') == etag:
+                    self.reply(304, b'', etag=etag)
+                else:
+                    self.reply(200, body, 'text/markdown; charset=utf-8', etag=etag)
+            else:
+                try:
+                    width = int(params.get('width', 0)) or None
+                except ValueError:
+                    self.reply(400, b"width must be a number\n")
+                    return
+                try:
+                    output, error = gateway.render(params['url'], params.get('mode') != 'normal',
+                                                   params.get('format') == 'ansi', width,
+                                                   params.get('references', '1') != '0')
+                except ValueError as e:
+                    self.reply(400, f"{e}\n".encode('utf-8'))
+                    return
+                if error is not None:
+                    self.reply(500, error.encode('utf-8'))
+                else:
+                    self.reply(200, output)
+
+        def reply(self, status, body, content_type='text/plain; charset=utf-8', etag=None):
+            self.send_response(status)
+            if etag is not None:
+                self.send_header('ETag', etag)
+            if status != 304:
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def address_string(self):
+            return self.client_address[0] if self.client_address else 'unix'
+
+        def log_message(self, format, *args):
+            pass  # One line per request would drown the console of a busy gateway
+
+    class PooledServer(socketserver.UnixStreamServer if socket_path else http.server.HTTPServer):
+        daemon_threads = True
+
+        def process_request(self, request, client_address):
+            pool.submit(self.process_request_thread, request, client_address)
+
+        def process_request_thread(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+        def server_close(self):
+            super().server_close()
+            pool.shutdown(wait=False)
+
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)  # Left over from an earlier run
+        return PooledServer(socket_path, Handler)
+    return PooledServer((host, port), Handler)
+
+
+def rgb_to_terminal_color(rgb, colors):
+    """Maps an (r, g, b) triple to an xterm-256 color cube index, or to one of the 8 basic colors."""
+    r, g, b = rgb
+    if colors >= 256:
+        return 16 + 36 * round(r / 255 * 5) + 6 * round(g / 255 * 5) + round(b / 255 * 5)
+    # curses.COLOR_RED/GREEN/BLUE are bits 1/2/4 of the basic color number
+    return (r > 127) * 1 + (g > 127) * 2 + (b > 127) * 4
+
+
+def image_to_cells(img, cols, rows, mode, colors=256, max_colors=15):
+    """Downscales a PIL image to fit a grid of cols x rows terminal cells.
+
+    mode 'halfblock': every cell is an upper half block with the upper pixel as foreground and the
+    lower one as background; returns rows of (fg, bg) terminal color numbers. The image is
+    quantized to max_colors first so the (fg, bg) combinations fit into the curses color pairs.
+    mode 'braille': 2x4 dithered dots per cell; returns rows of strings.
+    """
+    from PIL import Image
+    dots_x, dots_y = (1, 2) if mode == 'halfblock' else (2, 4)
+    width, height = img.size
+    scale = min(cols * dots_x / width, rows * dots_y / height, 1.0)
+    target_w = max(1, int(width * scale))
+    target_h = max(dots_y, int(height * scale))
+    target_h += -target_h % dots_y  # Whole cells only
+    target_w += -target_w % dots_x
+
+    if mode == 'halfblock':
+        small = img.convert('RGB').resize((target_w, target_h), Image.LANCZOS)
+        quantized = small.quantize(colors=max_colors)
+        palette = quantized.getpalette()
+        terminal = [rgb_to_terminal_color(palette[i * 3:i * 3 + 3], colors) for i in range(len(palette) // 3)]
+        pixels = list(quantized.getdata())
+        return [[(terminal[pixels[y * target_w + x]], terminal[pixels[(y + 1) * target_w + x]])
+                 for x in range(target_w)]
+                for y in range(0, target_h, 2)]
+
+    small = img.convert('L').resize((target_w, target_h), Image.LANCZOS).convert('1')  # Floyd-Steinberg
+    pixels = list(small.getdata())
+    # Braille dot bits for (dx, dy) inside a 2x4 cell
+    dot_bits = ((0x01, 0x08), (0x02, 0x10), (0x04, 0x20), (0x40, 0x80))
+    cells = []
+    for y in range(0, target_h, 4):
+        row = []
+        for x in range(0, target_w, 2):
+            bits = 0
+            for dy in range(4):
+                for dx in range(2):
+                    if pixels[(y + dy) * target_w + x + dx]:  # Light pixels become dots
+                        bits |= dot_bits[dy][dx]
+            row.append(chr(0x2800 + bits))
+        cells.append(''.join(row))
+    return cells
+
+
+class ThumbnailCache:
+    """Small LRU cache of decoded image cell grids keyed by (url, cols, rows, mode)."""
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        cells = self.entries.get(key)
+        if cells is not None:
+            self.entries.move_to_end(key)
+        return cells
+
+    def put(self, key, cells):
+        self.entries[key] = cells
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class CachedPage:
+    """A fetched markdown page together with its rendered forms."""
+
+    def __init__(self, text):
+        self.text = text
+        # simple_mode -> (CompactDocument, size)
+        self.renders = {}
+        self.size = sys.getsizeof(text)
+
+
+class PageCache:
+    """In-memory LRU cache of pages keyed by URL, bounded by a byte budget."""
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.entries = OrderedDict()  # url -> CachedPage, least recently used first
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        """Returns the cached page for url (marking it recently used) or None."""
+        with self.lock:
+            page = self.entries.get(url)
+            if page is not None:
+                self.entries.move_to_end(url)
+            return page
+
+    def put(self, url, text):
+        """Stores freshly fetched text for url, dropping any older renders."""
+        page = CachedPage(text)
+        with self.lock:
+            self._remove(url)
+            self.entries[url] = page
+            self.total_bytes += page.size
+            self._evict()
+        return page
+
+    def add_render(self, url, key, document):
+        """Attaches a rendered CompactDocument to a cached page."""
+        with self.lock:
+            page = self.entries.get(url)
+            if page is None:
+                return
+            size = document.nbytes()
+            old = page.renders.get(key)
+            if old is not None:
+                page.size -= old[1]
+                self.total_bytes -= old[1]
+            page.renders[key] = (document, size)
+            page.size += size
+            self.total_bytes += size
+            self._evict()
+
+    def discard(self, url):
+        """Forgets url entirely (used by reload)."""
+        with self.lock:
+            self._remove(url)
+
+    def discard_render(self, url, document):
+        """Drops document from the renders of url, keeping its text."""
+        with self.lock:
+            page = self.entries.get(url)
+            if page is None:
+                return
+            for key, (rendered, size) in list(page.renders.items()):
+                if rendered is document:
+                    del page.renders[key]
+                    page.size -= size
+                    self.total_bytes -= size
+
+    def _remove(self, url):
+        page = self.entries.pop(url, None)
+        if page is not None:
+            self.total_bytes -= page.size
+
+    def _evict(self):
+        # Drop least recently used pages until we fit into the budget
+        while self.total_bytes > self.max_bytes and self.entries:
+            _, page = self.entries.popitem(last=False)
+            self.total_bytes -= page.size
+
+
+class HistoryEntry:
+    """A visited page: its URL, where the user left it and when its content was fetched.
+
+    anchor is a (logical line, char offset) pair, so the place survives a different terminal width;
+    the rendered page itself is found in the page cache under url.
+    """
+
+    __slots__ = ('url', 'anchor', 'fetched_at')
+
+    def __init__(self, url, anchor=None, fetched_at=None):
+        self.url = url
+        self.anchor = anchor
+        self.fetched_at = fetched_at
+
+
+class History:
+    """Back/forward list of visited pages, persisted in the cache directory (unless path is None)."""
+
+    VERSION = 1
+    # Сколько записей истории хранить (самые старые отбрасываются)
+    MAX_ENTRIES = 200
+
+    def __init__(self, path, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = []
+        self.index = -1  # Position of the current entry; later entries are the forward list
+
+    @property
+    def current(self):
+        return self.entries[self.index] if self.entries else None
+
+    def load(self):
+        """Reads the saved history; the last current page becomes current again."""
+        if self.path is None:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == self.VERSION:
+                self.entries = [HistoryEntry(entry['url'], tuple(entry['anchor']) if entry.get('anchor') else None,
+                                             entry.get('fetched_at')) for entry in data['entries']]
+                self.index = min(max(0, data['index']), len(self.entries) - 1)
+        except (OSError, ValueError, KeyError, TypeError):
+            self.entries = []
+            self.index = -1
+
+    def save(self):
+        if self.path is None:
+            return
+        data = {
+            'version': self.VERSION,
+            'index': self.index,
+            'entries': [{'url': entry.url, 'anchor': entry.anchor, 'fetched_at': entry.fetched_at}
+                        for entry in self.entries],
+        }
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass  # History still works for this session
+
+    def remember(self, anchor):
+        """Stores where the user is on the current page."""
+        if self.entries and anchor is not None:
+            self.entries[self.index].anchor = anchor
+
+    def visit(self, url, anchor=None):
+        """Makes url the current page, after remembering anchor for the page being left.
+
+        The forward list is dropped, as in every browser; visiting the current URL again is a no-op.
+        """
+        self.remember(anchor)
+        if self.entries and self.entries[self.index].url == url:
+            return self.entries[self.index]
+        del self.entries[self.index + 1:]
+        self.entries.append(HistoryEntry(url))
+        if len(self.entries) > self.max_entries:
+            del self.entries[:len(self.entries) - self.max_entries]
+        self.index = len(self.entries) - 1
+        self.save()
+        return self.entries[self.index]
+
+    def back(self, anchor=None):
+        """Moves to the previous page and returns its entry, or None at the start."""
+        return self._move(-1, anchor)
+
+    def forward(self, anchor=None):
+        """Moves to the next page and returns its entry, or None at the end."""
+        return self._move(1, anchor)
+
+    def settle(self, url):
+        """Makes the neighbouring entry of url current again after the load of the current one was cancelled."""
+        for index in (self.index - 1, self.index + 1):
+            if 0 <= index < len(self.entries) and self.entries[index].url == url:
+                self.index = index
+                self.save()
+                return
+
+    def fetched(self, url):
+        """Notes that the content of the current page url was just fetched."""
+        if self.entries and self.entries[self.index].url == url:
+            self.entries[self.index].fetched_at = time.time()
+            self.save()
+
+    def _move(self, step, anchor):
+        index = self.index + step
+        if not self.entries or not 0 <= index < len(self.entries):
+            return None
+        self.remember(anchor)
+        self.index = index
+        self.save()
+        return self.entries[index]
+
+
+def splash_document(url):
+    """The page shown while url is loading and nothing of it has arrived yet."""
+    return CompactDocument(RenderedDocument(
+        [("AlterLynx\n\n", STYLE_HEADER), (f"Loading {url} ...\n", STYLE_DEFAULT)], [], []))
+
+
+class Tab:
+    """One open page with its own history, place on the page, rendered document and fetch.
+
+    Everything needed to show the tab again is kept here, so switching tabs is just a redraw.
+    discard_render() drops the document and layouts of a tab that is out of view; they are
+    rebuilt from the page cache (or the HTTP cache) when the tab is shown, at the same place.
+    """
+
+    def __init__(self, url, history):
+        self.url = url  # Page the tab is on, or is going to
+        self.history = history
+        self.scroll_pos = 0
+        self.restore = None  # (url, anchor) to scroll to once url is on screen
+        self.from_history = False  # The page being opened came from back/forward: any cached copy will do
+        self.revalidate = False  # Set by reload so a fresh HTTP cache entry is checked again
+        self.document = splash_document(url)
+        self.shown_key = None  # (url, simple_mode) of the document held
+        self.shown_url = None  # URL of the page in document
+        self.laid_out_document = None  # The document the layouts below were built from
+        self.layouts = {}  # width -> Layout of document
+        self.layout = None
+        self.page_job = None  # Background fetch of the page
+        self.streaming_url = None  # URL whose partially received blocks are in document
+        self.focus = None  # Index of the link focused with Tab
+        self.viewed_at = time.monotonic()
+
+    def show(self, document, simple_mode):
+        """Makes document the tab's page. Returns True if it is another page than the one held."""
+        self.document = document
+        self.shown_key = (self.url, simple_mode)
+        if self.url == self.shown_url:
+            return False
+        self.shown_url = self.url
+        self.scroll_pos = 0
+        self.focus = None
+        return True
+
+    def nbytes(self):
+        return self.document.nbytes() + sum(layout.nbytes() for layout in self.layouts.values())
+
+    def discard_render(self):
+        """Drops the rendered page, remembering the place on it for when it is rebuilt."""
+        if self.shown_key is None or self.page_job is not None:
+            return  # Nothing rendered yet, or still loading
+        anchor = self.layout.anchor(self.scroll_pos) if self.layout is not None else None
+        self.restore = (self.url, anchor)
+        self.from_history = True
+        self.document = splash_document(self.url)
+        self.shown_key = None
+        self.laid_out_document = None
+        self.layouts = {}
+        self.layout = None
+
+
+class HttpCache:
+    """Persistent on-disk HTTP cache that revalidates entries with ETag/Last-Modified."""
+
+    def __init__(self, cache_dir, max_bytes=64 * 1024 * 1024):
+        self.cache_dir = os.path.join(cache_dir, 'http')
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _paths(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        base = os.path.join(self.cache_dir, key)
+        return base + '.json', base + '.body'
+
+    def lookup(self, url):
+        """Returns the stored metadata for url, or None if it is not cached."""
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get('url') != url or not os.path.exists(body_path):
+            return None
+        return meta
+
+    def read_body(self, url):
+        """Returns the cached body bytes for url and marks the entry as recently used.
+
+        Returns None, and forgets the entry, if the body is gone (evicted by another thread since lookup()).
+        """
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(body_path, 'rb') as f:
+                body = f.read()
+        except OSError:
+            try:
+                os.remove(meta_path)
+            except OSError:
+                pass
+            return None
+        try:
+            os.utime(body_path)  # mtime doubles as the LRU timestamp
+        except OSError:
+            pass
+        return body
+
+    def is_fresh(self, meta, min_fresh=0):
+        """Checks Cache-Control max-age (or Expires) to see if the entry may be served without asking.
+
+        Entries younger than min_fresh seconds count as fresh whatever the headers say.
+        """
+        age = time.time() - meta.get('stored_at', 0)
+        if age < min_fresh:
+            return True
+        cache_control = (meta.get('cache_control') or '').lower()
+        directives = [d.strip() for d in cache_control.split(',')]
+        if 'no-cache' in directives or 'no-store' in directives:
+            return False
+        for directive in directives:
+            if directive.startswith('max-age='):
+                try:
+                    return age < int(directive[len('max-age='):])
+                except ValueError:
+                    return False
+        if meta.get('expires'):
+            try:
+                return time.time() < parsedate_to_datetime(meta['expires']).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def conditional_headers(self, meta):
+        """Builds If-None-Match/If-Modified-Since headers for revalidating a stored entry."""
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def store(self, url, body, headers):
+        """Saves a 200 response body with its validators. Honors Cache-Control: no-store."""
+        if 'no-store' in headers.get('Cache-Control', '').lower():
+            return
+        meta_path, body_path = self._paths(url)
+        with self.lock:
+            self._write(body_path, body)
+            self._write_meta(meta_path, url, headers, len(body))
+            self._evict()
+
+    def refresh(self, url, meta, headers):
+        """Records a 304 Not Modified: updates validators and restarts the freshness clock."""
+        meta_path, _ = self._paths(url)
+        merged = {
+            'ETag': headers.get('ETag', meta.get('etag')),
+            'Last-Modified': headers.get('Last-Modified', meta.get('last_modified')),
+            'Cache-Control': headers.get('Cache-Control', meta.get('cache_control')),
+            'Expires': headers.get('Expires', meta.get('expires')),
+            'Content-Type': meta.get('content_type'),
+        }
+        with self.lock:
+            self._write_meta(meta_path, url, merged, meta.get('size', 0))
+
+    def _write_meta(self, meta_path, url, headers, size):
+        meta = {
+            'url': url,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'cache_control': headers.get('Cache-Control'),
+            'expires': headers.get('Expires'),
+            'content_type': headers.get('Content-Type'),
+            'stored_at': time.time(),
+            'size': size,
+        }
+        self._write(meta_path, json.dumps(meta).encode('utf-8'))
+
+    def _write(self, path, data):
+        # Write to a temp file first so a crash never leaves a truncated entry
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _evict(self):
+        # Remove least recently used bodies (oldest mtime) until under the size cap
+        bodies = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.body'):
+                stat = entry.stat()
+                bodies.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        bodies.sort()
+        for _, size, body_path in bodies:
+            if total <= self.max_bytes:
+                break
+            for path in (body_path, body_path[:-len('.body')] + '.json'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+
+class RenderCache:
+    """Rendered pages keyed by a hash of their markdown and display mode, in memory and on disk.
+
+    A page rendered before, in this session or an earlier one, comes back without being parsed.
+    Entries are CompactDocument.dumps() files; they hold style IDs, not curses attributes, so they
+    are valid in any terminal. The key includes RENDER_VERSION, so a changed renderer starts afresh.
+    """
+
+    def __init__(self, cache_dir, max_bytes=64 * 1024 * 1024, memory_bytes=16 * 1024 * 1024):
+        self.cache_dir = os.path.join(cache_dir, 'render')
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self.total_bytes = 0
+        self.entries = OrderedDict()  # key -> (CompactDocument, size), least recently used first
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(markdown_text, base_url, simple_mode):
+        """Cache key of markdown_text rendered for base_url (links are made absolute against it)."""
+        digest = hashlib.sha1(f"{RENDER_VERSION}\0{int(simple_mode)}\0{base_url}\0".encode('utf-8'))
+        digest.update(markdown_text.encode('utf-8', errors='surrogatepass'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Returns the cached document for key (from memory, else from disk) or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry[0]
+        path = os.path.join(self.cache_dir, key)
+        try:
+            with open(path, 'rb') as f:
+                document = CompactDocument.loads(f.read())
+            os.utime(path)  # mtime doubles as the LRU timestamp
+        except OSError:
+            return None
+        except ValueError:
+            # Truncated or from another platform: it will be written again after rendering
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        self._remember(key, document)
+        return document
+
+    def put(self, key, document):
+        """Stores a freshly rendered document under key. Must not be appended to afterwards."""
+        self._remember(key, document)
+        path = os.path.join(self.cache_dir, key)
+        # Write to a temp file first so a crash never leaves a truncated entry
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with self.lock:
+            try:
+                with open(tmp_path, 'wb') as f:
+                    f.write(document.dumps())
+                os.replace(tmp_path, path)
+                self._evict()
+            except OSError:
+                pass  # A full or read-only disk must not break browsing
+
+    def discard(self, document):
+        """Drops document from memory; its file stays, so it is read back instead of rendered again."""
+        with self.lock:
+            for key, (held, size) in list(self.entries.items()):
+                if held is document:
+                    del self.entries[key]
+                    self.total_bytes -= size
+
+    def _remember(self, key, document):
+        size = document.nbytes()
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            self.entries[key] = (document, size)
+            self.total_bytes += size
+            while self.total_bytes > self.memory_bytes and self.entries:
+                _, (_, dropped) = self.entries.popitem(last=False)
+                self.total_bytes -= dropped
+
+    def _evict(self):
+        # Remove least recently used entries (oldest mtime) until under the size cap
+        files = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        files.sort()
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+class Tracer:
+    """Per-phase timings and byte counts of page loads, for the overlay and the --trace file.
+
+    Phases are recorded per URL from any thread: cache (how the page was served), http (time to
+    response headers, retries), download, parse, render, layout and paint. With a trace file
+    every record is also written to it as a JSON line.
+    """
+    # Сколько последних страниц помнить
+    MAX_PAGES = 64
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pages = OrderedDict()  # url -> {phase: {'ms': ..., other fields}}
+        self.file = None
+
+    def open(self, path):
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def navigate(self, url):
+        """Starts a new record for url; the time to its first paint is measured from here."""
+        with self.lock:
+            self.pages.pop(url, None)
+            self.pages[url] = {'navigate': {'started': time.perf_counter()}}
+            while len(self.pages) > self.MAX_PAGES:
+                self.pages.popitem(last=False)
+        self.event('navigate', url)
+
+    def record(self, url, phase, ms=None, add=False, **fields):
+        """Stores a phase of url. With add=True ms is added to what the phase already took."""
+        with self.lock:
+            timing = self.pages.get(url)
+            if timing is None:
+                timing = self.pages[url] = {}
+                if len(self.pages) > self.MAX_PAGES:
+                    self.pages.popitem(last=False)
+            entry = timing.setdefault(phase, {})
+            if ms is not None:
+                entry['ms'] = entry.get('ms', 0.0) + ms if add else ms
+            entry.update(fields)
+        self.event(phase, url, ms=ms, **fields)
+
+    def recorded(self, url, phase):
+        with self.lock:
+            return phase in self.pages.get(url, {})
+
+    def since_navigate(self, url):
+        """Milliseconds since navigate(url), or None."""
+        with self.lock:
+            started = self.pages.get(url, {}).get('navigate', {}).get('started')
+        return None if started is None else (time.perf_counter() - started) * 1000
+
+    def event(self, name, url, **fields):
+        if self.file is None:
+            return
+        record = {'ts': round(time.time(), 6), 'event': name, 'url': url}
+        record.update((k, round(v, 3) if isinstance(v, float) else v) for k, v in fields.items() if v is not None)
+        with self.lock:
+            if self.file is not None:
+                self.file.write(json.dumps(record) + '\n')
+                self.file.flush()
+
+    def summary(self, url):
+        """One line with the phases of url, for the overlay."""
+        with self.lock:
+            timing = {phase: dict(entry) for phase, entry in self.pages.get(url, {}).items()}
+        parts = []
+        if 'cache' in timing:
+            parts.append(f"cache {timing['cache'].get('result', '?')}")
+        http = timing.get('http')
+        if http is not None:
+            text = f"http {http.get('ms', 0):.0f}ms"
+            if http.get('retries'):
+                text += f" ({http['retries']} retries)"
+            parts.append(text)
+        download = timing.get('download')
+        if download is not None:
+            parts.append(f"download {download.get('ms', 0):.0f}ms {download.get('bytes', 0) / 1024:.1f}KB")
+        for phase in ('parse', 'render', 'layout'):
+            if phase in timing:
+                parts.append(f"{phase} {timing[phase].get('ms', 0):.1f}ms")
+                if phase == 'parse' and timing[phase].get('parser'):
+                    parts[-1] += f" ({timing[phase]['parser']})"
+                if phase == 'render' and timing[phase].get('memo'):
+                    parts[-1] += " (cached, not parsed)"
+                if phase == 'render' and timing[phase].get('memory'):
+                    memory = timing[phase]
+                    parts[-1] += (f" {memory['memory'] / 1024:.0f}KB"
+                                  f" ({memory['segment_memory'] / memory['memory']:.1f}x smaller)")
+        paint = timing.get('paint')
+        if paint is not None:
+            parts.append(f"paint {paint.get('ms', 0):.1f}ms {paint.get('bytes', 0)}B")
+            if paint.get('total_ms') is not None:
+                parts.append(f"first paint after {paint['total_ms']:.0f}ms")
+        return "Timing: " + (" | ".join(parts) if parts else "nothing recorded yet")
+
+
+class InFlightRequest:
+    """A request shared by every caller that asked for the same key while it was running."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Transport:
+    """Owns all HTTP fetching: pooled connections, retries, timeouts, merged requests and statistics.
+
+    Requests are streamed; fetch() hands the response to a read callback and returns its result.
+    Connection errors, timeouts and RETRY_STATUSES are retried with exponential backoff and full
+    jitter. Failures after the body started arriving are not retried.
+    """
+    # Ответы сервера, после которых запрос стоит повторить
+    RETRY_STATUSES = (429, 502, 503, 504)
+
+    def __init__(self, timeout=(5, 30), retries=2, backoff=0.5, max_backoff=8.0,
+                 pool_hosts=16, pool_per_host=8, user_agent='Alternet-Browser/1.0', tracer=None):
+        self.timeout = timeout  # (connect, read) seconds
+        self.tracer = tracer or Tracer()
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool_hosts = pool_hosts
+        self.pool_per_host = pool_per_host
+        self.user_agent = user_agent
+        self.requests_session = None  # Made on first use: importing requests is slow
+        self.lock = threading.Lock()
+        self.in_flight = {}  # key -> InFlightRequest
+        self.host_stats = {}  # host -> counters, see stats()
+
+    def fetch(self, url, read, headers=None, merge=True):
+        """GETs url and returns read(response); exceptions of the request or of read propagate.
+
+        With merge=True, concurrent fetches of the same url and headers share one request: the
+        later callers wait for it and get the same result (or exception). A request cancelled by its
+        first caller (LoadCancelled from read) is not shared: the others then make their own.
+        Pass merge=False when the result must not be shared, e.g. a temporary file the caller deletes.
+        """
+        headers = headers or {}
+        if not merge:
+            return self._fetch(url, read, headers)
+        key = (url, tuple(sorted(headers.items())))
+        while True:
+            with self.lock:
+                flight = self.in_flight.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self.in_flight[key] = InFlightRequest()
+            if leader:
+                break
+            self._count(url, 'merged')
+            flight.done.wait()
+            if isinstance(flight.error, LoadCancelled):
+                continue  # Only the leader's load was cancelled, not ours
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = self._fetch(url, read, headers)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            flight.done.set()
+
+    @property
+    def session(self):
+        with self.lock:
+            if self.requests_session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                session.headers.update({'User-Agent': self.user_agent})
+                # Keep-alive pools for pool_hosts hosts; requests beyond pool_per_host open extra
+                # connections instead of blocking, those are just not kept afterwards
+                adapter = HTTPAdapter(pool_connections=self.pool_hosts, pool_maxsize=self.pool_per_host,
+                                      max_retries=0)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.requests_session = session
+            return self.requests_session
+
+    def stats(self):
+        """Returns {host: {'requests', 'errors', 'retries', 'merged', 'avg_ms', 'last_ms'}}.
+
+        Latency is the time until the response headers arrived.
+        """
+        with self.lock:
+            result = {}
+            for host, counters in self.host_stats.items():
+                entry = dict(counters)
+                total_ms = entry.pop('total_ms')
+                timed = entry.pop('timed')
+                entry['avg_ms'] = total_ms / timed if timed else 0.0
+                result[host] = entry
+            return result
+
+    def _fetch(self, url, read, headers):
+        import requests
+        attempt = 0
+        while True:
+            self._count(url, 'requests')
+            started = time.perf_counter()
+            try:
+                response = self.session.get(url, headers=headers, timeout=self.timeout, stream=True)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self._count(url, 'errors')
+                if attempt >= self.retries:
+                    raise
+                self._count(url, 'retries')
+                self.tracer.event('retry', url, attempt=attempt + 1, reason=type(e).__name__)
+                time.sleep(self._delay(attempt))
+                attempt += 1
+                continue
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self._record_latency(url, elapsed_ms)
+            with response:
+                if response.status_code in self.RETRY_STATUSES and attempt < self.retries:
+                    self._count(url, 'retries')
+                    self.tracer.event('retry', url, attempt=attempt + 1, reason=response.status_code)
+                    delay = self._delay(attempt, response.headers.get('Retry-After'))
+                else:
+                    self.tracer.record(url, 'http', elapsed_ms, status=response.status_code, retries=attempt)
+                    if response.status_code >= 400:
+                        self._count(url, 'errors')
+                    try:
+                        return read(response)
+                    except requests.exceptions.HTTPError:
+                        raise  # raise_for_status(): already counted by its status above
+                    except requests.exceptions.RequestException:
+                        self._count(url, 'errors')  # E.g. the connection broke while reading the body
+                        raise
+            time.sleep(delay)
+            attempt += 1
+
+    def _delay(self, attempt, retry_after=None):
+        if retry_after is not None and retry_after.isdigit():
+            return min(int(retry_after), self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _counters(self, url):
+        host = urlparse(url).netloc
+        counters = self.host_stats.get(host)
+        if counters is None:
+            counters = self.host_stats[host] = {'requests': 0, 'errors': 0, 'retries': 0, 'merged': 0,
+                                                'total_ms': 0.0, 'timed': 0, 'last_ms': 0.0}
+        return counters
+
+    def _count(self, url, name):
+        with self.lock:
+            self._counters(url)[name] += 1
+
+    def _record_latency(self, url, elapsed_ms):
+        with self.lock:
+            counters = self._counters(url)
+            counters['total_ms'] += elapsed_ms
+            counters['timed'] += 1
+            counters['last_ms'] = elapsed_ms
+
+
+class Prefetcher:
+    """Fetches the first linked .md pages in the background into the page cache."""
+
+    def __init__(self, fetch, page_cache, max_pages=8, max_workers=4, per_host=2,
+                 max_bytes=8 * 1024 * 1024, notify=None):
+        self.fetch = fetch  # url -> markdown text or "[ERROR] ..." string
+        self.page_cache = page_cache
+        self.notify = notify  # Called when a prefetch finishes, so the status bar is redrawn
+        self.max_pages = max_pages
+        self.max_bytes = max_bytes  # Memory cap for the pages prefetched from one page
+        self.per_host = per_host
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='prefetch')
+        self.host_slots = {}  # host -> Semaphore limiting concurrent requests per host
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.futures = []
+        self.pending = 0
+        self.done = 0
+        self.fetched_bytes = 0
+
+    def schedule(self, urls):
+        """Cancels prefetches of the previous page and starts fetching the given links."""
+        self.cancel()
+        with self.lock:
+            generation = self.generation
+            candidates = []
+            for url in urls:
+                if len(candidates) >= self.max_pages:
+                    break
+                if url.lower().endswith('.md') and url not in candidates and self.page_cache.get(url) is None:
+                    candidates.append(url)
+            self.pending = len(candidates)
+            for url in candidates:
+                self.futures.append(self.executor.submit(self._prefetch, url, generation))
+
+    def cancel(self):
+        """Drops queued prefetches; requests already in flight finish but are ignored."""
+        with self.lock:
+            self.generation += 1
+            for future in self.futures:
+                future.cancel()
+            self.futures = []
+            self.pending = 0
+            self.done = 0
+            self.fetched_bytes = 0
+
+    def status(self):
+        """Returns (pending, done) counts for the current page."""
+        with self.lock:
+            return self.pending, self.done
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _host_slot(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            slot = self.host_slots.get(host)
+            if slot is None:
+                slot = self.host_slots[host] = threading.Semaphore(self.per_host)
+            return slot
+
+    def _prefetch(self, url, generation):
+        with self._host_slot(url):
+            if generation != self.generation:
+                return  # The user already left the page
+            try:
+                text = self.fetch(url)
+            except Exception as e:
+                text = f"[ERROR] Failed to fetch {url}: {e}"  # Never leave the page pending
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.pending -= 1
+            self.done += 1
+            stored = not text.startswith("[ERROR]") and self.fetched_bytes + len(text) <= self.max_bytes
+            if stored:
+                self.fetched_bytes += len(text)
+        if stored:
+            self.page_cache.put(url, text)
+        if self.notify is not None:
+            self.notify()
+
+
+class BlockSplitter:
+    """Cuts an incrementally decoded markdown stream into complete top-level blocks.
+
+    A block ends at a blank line outside a fenced code block. Cutting there is good enough for
+    progressive display; the complete document is rendered once more when it has arrived.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.scanned = 0  # Offset up to which buffer lines have been looked at
+        self.cut = 0  # Offset just after the last blank line seen outside a fence
+        self.fence = None  # Opening fence characters while inside a fenced code block
+        self.has_content = False
+
+    def feed(self, text):
+        """Adds decoded text and returns the complete blocks now available (possibly "")."""
+        self.buffer += text
+        while True:
+            newline = self.buffer.find('\n', self.scanned)
+            if newline == -1:
+                break
+            line = self.buffer[self.scanned:newline]
+            self.scanned = newline + 1
+            stripped = line.lstrip(' ')
+            if self.fence is not None:
+                if stripped.startswith(self.fence):
+                    self.fence = None
+            elif len(line) - len(stripped) < 4 and stripped[:3] in ('```', '~~~'):
+                self.fence = stripped[:3]
+                self.has_content = True
+            elif not stripped.strip():
+                if self.has_content:
+                    self.cut = self.scanned
+                    self.has_content = False
+            else:
+                self.has_content = True
+        if not self.cut:
+            return ""
+        blocks = self.buffer[:self.cut]
+        self.buffer = self.buffer[self.cut:]
+        self.scanned -= self.cut
+        self.cut = 0
+        return blocks
+
+
+class Wakeup:
+    """Self-pipe that wakes the UI thread out of select(): written by worker threads and signals."""
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        os.set_blocking(self.write_fd, False)
+
+    def fileno(self):
+        return self.read_fd
+
+    def notify(self):
+        try:
+            os.write(self.write_fd, b'\0')
+        except BlockingIOError:
+            pass  # The pipe is full: a wakeup is pending anyway
+
+    def drain(self):
+        try:
+            while os.read(self.read_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+
+class LoadCancelled(Exception):
+    """Raised inside a streaming job to stop reading once its LoadJob has been cancelled."""
+
+
+class LoadJob:
+    """A unit of blocking work (page, image, site list) run by the Loader."""
+
+    def __init__(self, kind, url, func, args, notify=None, cleanup=None):
+        self.kind = kind
+        self.url = url
+        self.func = func
+        self.args = args
+        self.notify = notify  # Called when progress is posted, to wake the UI thread
+        self.cleanup = cleanup  # Called with the result of a job that finished after it was cancelled
+        self.result = None
+        self.error = None  # Exception raised by func, if any
+        self.cancelled = False
+        self.finished = threading.Event()
+        self.progress = queue.Queue()  # Partial results posted while the job runs
+
+    def cancel(self):
+        # A plain request cannot be aborted; its result is simply dropped.
+        # Streaming jobs stop at their next post_progress().
+        self.cancelled = True
+
+    def post_progress(self, item):
+        if self.cancelled:
+            raise LoadCancelled()
+        self.progress.put(item)
+        if self.notify is not None:
+            self.notify()
+
+    def take_progress(self):
+        """Returns all partial results posted since the last call."""
+        items = []
+        while True:
+            try:
+                items.append(self.progress.get_nowait())
+            except queue.Empty:
+                return items
+
+
+class Loader:
+    """Runs network jobs on worker threads so the UI thread never blocks on a fetch.
+
+    Finished jobs are put on a result queue which main_curses drains between keys; notify (the
+    UI's Wakeup.notify) is called whenever there is something new, so the UI never has to poll.
+    """
+
+    def __init__(self, workers=2, notify=None):
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.notify = notify
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f'loader-{i}', daemon=True).start()
+
+    def submit(self, kind, url, func, *args, progress=False, cleanup=None):
+        """Queues func(*args). With progress=True the job's post_progress is passed as a last argument.
+
+        cleanup(result) releases what a job made (e.g. a temporary file) if it is cancelled and its
+        result dropped.
+        """
+        job = LoadJob(kind, url, func, args, self.notify, cleanup)
+        if progress:
+            job.args = args + (job.post_progress,)
+        self.jobs.put(job)
+        return job
+
+    def poll(self):
+        """Returns the jobs finished since the last call, skipping (and cleaning up) cancelled ones."""
+        finished = []
+        while True:
+            try:
+                job = self.results.get_nowait()
+            except queue.Empty:
+                return finished
+            if not job.cancelled:
+                finished.append(job)
+            elif job.cleanup is not None and job.result is not None:
+                job.cleanup(job.result)
+
+    def _worker(self):
+        while True:
+            job = self.jobs.get()
+            if not job.cancelled:
+                try:
+                    job.result = job.func(*job.args)
+                except Exception as e:
+                    job.error = e
+            job.finished.set()
+            self.results.put(job)
+            if self.notify is not None:
+                self.notify()
 
 
 class AlternetBrowser:
@@ -15,21 +2809,67 @@ class AlternetBrowser:
     DEFAULT_HOME_URL = "http://ionics.neocities.org/alternet/list.md"
     # Константа для URL списка сайтов
     SITES_LIST_URL = "http://ionics.neocities.org/alternet/list.md"
+    # Максимальный размер загружаемой страницы, остальное отбрасывается
+    MAX_DOCUMENT_BYTES = 8 * 1024 * 1024
+    # Максимальный размер загружаемого изображения
+    MAX_IMAGE_BYTES = 10 * 1024 * 1024
+    # Буквы подсказок для выбора ссылок на экране (после l или i)
+    HINT_KEYS = 'asdfghjklqwertyuiopzxcvbnm'
+    # Сколько памяти могут занимать отрисованные страницы фоновых вкладок (давно не виденные отбрасываются)
+    TAB_MEMORY_BYTES = 16 * 1024 * 1024
+    # Каталог для кэша (HTTP-ответы и т.п.)
+    CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'alterlynx')
 
     def __init__(self):
         # Initialize stdscr as None, it will be set by curses.wrapper
         self.stdscr = None
-        self.session = requests.Session()
-        self.history = []
+        # Per-phase timings of page loads (overlay toggled with 'p', --trace FILE writes them out)
+        self.tracer = Tracer()
+        self.show_timings = False
+        # Every network request goes through the transport (pools, retries, timeouts, statistics)
+        self.transport = Transport(tracer=self.tracer)
         self.current_url = ""
-        self.links = []
-        self.images = []
-        # Set a user-agent to be polite
-        self.session.headers.update({'User-Agent': 'Alternet-Browser/1.0'})
+        # Page on screen, and its link / image tables (LinkTable)
+        self.set_document(CompactDocument())
 
         # Initialize display mode: True for simple, False for normal
         self.simple_mode = True  # Упрощенный режим по умолчанию
 
+        # Fetched text and rendered documents of recently visited pages
+        self.page_cache = PageCache()
+        # Persistent HTTP cache; in offline mode pages are served from it only
+        self.http_cache = HttpCache(self.CACHE_DIR)
+        # Rendered pages by content hash and display mode, kept across sessions
+        self.render_cache = RenderCache(self.CACHE_DIR)
+        # Searchable index of the sites in SITES_LIST_URL
+        self.site_index = SiteIndex(os.path.join(self.CACHE_DIR, 'sites.json'))
+        # Full-text index of every page loaded so far
+        self.page_index = PageIndex(os.path.join(self.CACHE_DIR, 'fulltext.db'))
+        # Back/forward list, kept across sessions; it belongs to the first tab, other tabs get their own
+        self.history = History(os.path.join(self.CACHE_DIR, 'history.json'))
+        self.tabs = []  # Open tabs, in display order; made in main_curses
+        self.tab_label = ""  # "[2/3] " in the top line when more than one tab is open
+        self.offline = False
+        self.mirror_dir = None  # Directory made by `crawl`; pages found there are read from disk
+        self.gateway = None  # Base URL of a `serve` gateway that fetches pages for us
+        self.min_fresh = 0  # Seconds a cached page is served without asking the server (serve --fresh)
+        # Background fetching of linked pages, enabled with --prefetch N
+        self.prefetcher = None
+        # Wakes the input loop when a background job finishes or the terminal is resized
+        self.wakeup = Wakeup()
+        self.selector = None  # Waits on stdin and self.wakeup; made in setup_curses
+        self.resized = False  # Set by the SIGWINCH handler
+        self.woken = False  # The last read_key() returned because of self.wakeup
+        self.previous_sigwinch = None
+        # Input loop counters, written to the trace as a 'session' event
+        self.loop_stats = {'iterations': 0, 'wakeups': 0}
+        # Worker threads for page/image/site list fetches
+        self.loader = Loader(notify=self.wakeup.notify)
+        self.loading_url = None  # URL being fetched in the background, shown in the status bar
+        # Decoded inline image previews; image_mode is picked in setup_curses
+        self.thumbnail_cache = ThumbnailCache()
+        self.image_mode = 'braille'
+
         # Initialize other attributes but not curses-specific ones yet
         # Colors will be initialized in setup_curses after stdscr is available
 
@@ -37,8 +2877,18 @@ class AlternetBrowser:
         """Initialize curses settings and define color pairs."""
         # Now stdscr is guaranteed to be available
         curses.curs_set(0)  # Hide cursor
-        self.stdscr.nodelay(0)  # Block on getch() initially
-        self.stdscr.timeout(100)  # Timeout for getch in milliseconds for smoother scrolling
+        if hasattr(curses, 'set_escdelay'):
+            curses.set_escdelay(25)  # Esc cancels loading, don't make it wait a whole second
+        self.stdscr.idlok(True)  # Allow hardware line scrolling for one-line scrolls
+        self.painter = ScreenPainter(self.stdscr)
+        # getch() never blocks: read_key() sleeps in select() on stdin, the wakeup pipe and SIGWINCH
+        self.stdscr.nodelay(True)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(sys.stdin.fileno(), selectors.EVENT_READ)
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        if hasattr(signal, 'SIGWINCH'):
+            self.previous_sigwinch = signal.signal(signal.SIGWINCH, self._on_resize)
+            signal.set_wakeup_fd(self.wakeup.write_fd, warn_on_full_buffer=False)
         if curses.has_colors():
             curses.start_color()
             curses.use_default_colors()
@@ -60,6 +2910,10 @@ class AlternetBrowser:
             self.color_image = curses.color_pair(5)
             self.color_status = curses.color_pair(6) | curses.A_BOLD
             self.color_header = curses.color_pair(7) | curses.A_BOLD  # Example: Red and Bold
+            # Half-block previews need a color pair per (fg, bg) combination; pairs above 255
+            # cannot be expressed as attributes, so only 16..255 are used for them
+            if min(curses.COLOR_PAIRS, 256) - 16 >= 64:
+                self.image_mode = 'halfblock'
         else:
             # Fallback if colors are not supported
             self.color_default = curses.A_NORMAL
@@ -71,8 +2925,16 @@ class AlternetBrowser:
             # Use bold for headers as a fallback
             self.color_header = curses.A_BOLD
 
-    def normalize_url(self, url):
-        """Ensures the URL has http:// and appends /main.md if no path is specified."""
+    def normalize_url(self, url, local_files=False):
+        """Ensures the URL has http:// and appends /main.md if no path is specified.
+
+        With local_files=True (for what the user typed, never for link targets taken from pages)
+        existing local files, e.g. pages of a crawl mirror, become file:// URLs.
+        """
+        if url.startswith('file://'):
+            return url
+        if local_files and os.path.isfile(url):
+            return 'file://' + os.path.abspath(url)
         if not url.startswith(('http://', 'https://')):
             url = 'http://' + url
 
@@ -84,14 +2946,67 @@ class AlternetBrowser:
 
         return url
 
-    def fetch_markdown(self, url):
-        """Fetches the markdown content from the given URL."""
-        try:
-            response = self.session.get(url)
-            response.raise_for_status()
+    def local_path(self, url):
+        """Returns the file to read for url: file:// URLs and pages present in the --mirror directory."""
+        if url.startswith('file://'):
+            return unquote(urlparse(url).path)
+        if self.mirror_dir and url.startswith(('http://', 'https://')):
+            path = mirror_path(self.mirror_dir, url)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def fetch_markdown(self, url, revalidate=False, from_history=False, on_block=None):
+        """Fetches the markdown content from the given URL, going through the HTTP cache.
+
+        With revalidate=True a fresh cache entry is still checked with the server (used by reload);
+        with from_history=True (back/forward) any cached copy is used as it is, however old.
+        The body is streamed; if on_block is given it receives complete top-level markdown blocks
+        as they arrive, so the page can be shown before the download ends.
+        Every successfully loaded page is added to the full-text index.
+        """
+        markdown_text = self.fetch_markdown_unindexed(url, revalidate, from_history, on_block)
+        if not markdown_text.startswith("[ERROR]"):
+            self.page_index.add(url, markdown_text)
+        return markdown_text
+
+    def fetch_markdown_unindexed(self, url, revalidate=False, from_history=False, on_block=None):
+        """fetch_markdown without the full-text indexing."""
+        import requests
+        path = self.local_path(url)
+        if path is not None:
+            self.tracer.record(url, 'cache', result='local')
+            try:
+                with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                    return f.read(self.MAX_DOCUMENT_BYTES)
+            except OSError as e:
+                return f"[ERROR] Failed to read {url}: {e}"
+
+        meta = self.http_cache.lookup(url)
+        if meta is not None and (self.offline or from_history or
+                                 (self.http_cache.is_fresh(meta, self.min_fresh) and not revalidate)):
+            # Fresh (or offline, or going back to it): serve straight from disk without touching the network
+            body = self.http_cache.read_body(url)
+            if body is not None:
+                self.tracer.record(url, 'cache', result='hit')
+                return body.decode('utf-8', errors='replace')
+            meta = None  # Evicted meanwhile: a miss
+        if self.offline:
+            self.tracer.record(url, 'cache', result='offline-miss')
+            return f"[ERROR] Offline mode: {url} is not in the cache"
 
-            # Явно указываем, что мы ожидаем UTF-8
-            response.encoding = 'utf-8'
+        def read(response):
+            if response.status_code == 304 and meta is not None:
+                # Not modified: the cached body is still valid
+                body = self.http_cache.read_body(url)
+                if body is None:
+                    # Evicted meanwhile: the entry is gone, so this fetches it again without validators
+                    return self.fetch_markdown_unindexed(url, False, False, on_block)
+                self.tracer.record(url, 'cache', result='revalidated')
+                self.http_cache.refresh(url, meta, response.headers)
+                return body.decode('utf-8', errors='replace')
+            self.tracer.record(url, 'cache', result='stale' if meta is not None else 'miss')
+            response.raise_for_status()
 
             content_type = response.headers.get('Content-Type', '').lower()
             # Check if the response is likely markdown text
@@ -101,422 +3016,485 @@ class AlternetBrowser:
                                ['text', 'markdown', 'plain', 'html'])  # 'html' might be served for .md sometimes
 
             if is_markdown_url or is_text_type:
-                return response.text  # Теперь response.text будет декодирован как UTF-8
+                return self.read_markdown_stream(url, response, on_block)
             else:
                 # Return error message to be displayed in the UI
                 return f"[ERROR] Expected text/markdown content, got Content-Type: '{content_type}' for URL: {url}"
+
+        try:
+            # A page already being fetched (e.g. by the prefetcher) is shared instead of fetched twice;
+            # only the first caller sees its blocks as they arrive
+            headers = self.http_cache.conditional_headers(meta) if meta is not None else {}
+            if self.gateway is not None:
+                # The gateway fetches for us; it is cached and revalidated here under the page's own URL
+                return self.transport.fetch(f"{self.gateway}/page?url={quote(url, safe='')}", read, headers)
+            return self.transport.fetch(url, read, headers)
         except requests.exceptions.RequestException as e:
             return f"[ERROR] Failed to fetch {url}: {e}"
+        except LoadCancelled:
+            raise  # Our own load was cancelled: the Loader drops the job
+        except Exception as e:
+            # Whatever else broke while reading still becomes the page shown
+            return f"[ERROR] Failed to fetch {url}: {type(e).__name__}: {e}"
 
-    def render_markdown_to_curses(self, markdown_text, base_url):
-        """Renders markdown AST to the curses window."""
-        self.links = []  # Reset links list for this page
-        self.images = []  # Reset images list for this page
-        lines = []  # Store rendered lines
-        current_line = ""
-        current_attr = self.color_default
-        link_counter = 1
-        image_counter = 1
-        in_code_block = False
-        code_block_lang = ""
-
-        # Parse markdown into AST
-        ast = commonmark.Parser().parse(markdown_text)
-        walker = ast.walker()
-
-        for current, entering in walker:
-            node_type = current.t
-            literal = current.literal
-
-            if node_type == 'code_block':
-                if entering:
-                    in_code_block = True
-                    code_block_lang = current.info if current.info else "text"
-                    current_line += f"\n```{code_block_lang}\n"
-                    lines.append((current_line, self.color_default))
-                    current_line = ""
-                else:
-                    current_line += "\n```\n"
-                    lines.append((current_line, self.color_default))
-                    current_line = ""
-                    in_code_block = False
-            elif node_type == 'code':
-                if entering:
-                    current_line += "`"
-                else:
-                    current_line += "`"
-            elif node_type == 'html_inline' or node_type == 'html_block':
-                # Skip HTML tags as per requirement
-                pass
-            elif node_type == 'text':
-                if not in_code_block:
-                    current_line += literal
-                else:
-                    current_line += literal
-            elif node_type == 'emph':  # Italic
-                if entering:
-                    # Append current segment with previous attribute before changing
-                    if current_line:
-                        lines.append((current_line, current_attr))
-                        current_line = ""
-                    current_attr = self.color_italic
-                else:
-                    # Append current segment with italic attribute before changing back
-                    if current_line:
-                        lines.append((current_line, current_attr))
-                        current_line = ""
-                    current_attr = self.color_default
-            elif node_type == 'strong':  # Bold
-                if entering:
-                    # Append current segment with previous attribute before changing
-                    if current_line:
-                        lines.append((current_line, current_attr))
-                        current_line = ""
-                    current_attr = self.color_bold
-                else:
-                    # Append current segment with bold attribute before changing back
-                    if current_line:
-                        lines.append((current_line, current_attr))
-                        current_line = ""
-                    current_attr = self.color_default
-            elif node_type == 'link':
-                if entering:
-                    # Store the destination URL for later use
-                    dest_url = urljoin(base_url, current.destination)
-                    self.links.append(dest_url)
-                    # Append current segment with previous attribute before adding link
-                    if current_line:
-                        lines.append((current_line, current_attr))
-                        current_line = ""
-
-                    if self.simple_mode:
-                        # Simple mode: only number and text
-                        link_text = f"[{link_counter}]"
-                    else:
-                        # Normal mode: number and destination
-                        link_text = f"[Link {link_counter}: {current.destination}]"
-
-                    lines.append((link_text, self.color_link))
-                    current_line = ""  # Reset line after adding link
-                    link_counter += 1
-                    current_attr = self.color_default  # Reset attribute after link
-            elif node_type == 'image':
-                if entering:
-                    # Store the image source URL for later use
-                    img_src = urljoin(base_url, current.destination)
-                    self.images.append(img_src)
-                    # Append current segment with previous attribute before adding image
-                    if current_line:
-                        lines.append((current_line, current_attr))
-                        current_line = ""
-
-                    if self.simple_mode:
-                        # Simple mode: only number and filename
-                        filename = os.path.basename(current.destination)
-                        image_text = f"[IMG {image_counter}: {filename}]"
-                    else:
-                        # Normal mode: number and destination
-                        image_text = f"[Image {image_counter}: {current.destination}]"
-
-                    lines.append((image_text, self.color_image))
-                    current_line = ""  # Reset line after adding image
-                    image_counter += 1
-                    current_attr = self.color_default  # Reset attribute after image
-            elif node_type == 'heading':
-                if entering:
-                    # Append current segment if any before the heading
-                    if current_line:
-                        lines.append((current_line, current_attr))
-                        current_line = ""
-                    # Use the header-specific color/attribute
-                    current_attr = self.color_header
-                    current_line += "#" * current.level + " "
-                else:
-                    current_line += "\n"
-                    lines.append((current_line, current_attr))
-                    current_line = ""
-                    current_attr = self.color_default  # Reset attribute after heading
-            elif node_type == 'list':
-                # Add a newline before the list starts
-                if entering and current_line:
-                    lines.append((current_line, current_attr))
-                    current_line = ""
-                elif entering:
-                    if not self.simple_mode:  # Add newline in normal mode
-                        current_line += "\n"
-            elif node_type == 'item':
-                # Add a newline and a bullet before the item
-                if entering:
-                    if current_line:
-                        lines.append((current_line, current_attr))
-                        current_line = ""
-                    if not self.simple_mode:  # Add newline in normal mode
-                        current_line += "\n"
-                    current_line += " - "
-            elif node_type == 'paragraph':
-                if not entering:
-                    current_line += "\n"
-                    if self.simple_mode:  # Add an extra newline for paragraph separation in simple mode
-                        current_line += "\n"
-                    lines.append((current_line, self.color_default))
-                    current_line = ""
-            elif node_type == 'block_quote':
-                if entering:
-                    # In simple mode, just add a space or a symbol to indicate quote
-                    if self.simple_mode:
-                        current_line += "> "
-                    else:
-                        current_line += "\n> "
-                else:
-                    current_line += "\n"
-                    lines.append((current_line, self.color_default))
-                    current_line = ""
-            elif node_type == 'softbreak':
-                # In simple mode, treat as space; in normal mode, treat as space (as before)
-                if not self.simple_mode:
-                    current_line += " "
-                else:
-                    current_line += " "
-            elif node_type == 'linebreak':
-                # In simple mode, treat as newline; in normal mode, treat as newline (as before)
-                current_line += "\n"
-                if not self.simple_mode:
-                    lines.append((current_line, self.color_default))
-                    current_line = ""
-            elif node_type == 'thematic_break':
-                # In simple mode, just add a newline; in normal mode, add a line
-                if self.simple_mode:
-                    current_line += "\n"
-                else:
-                    current_line += "\n---\n"
-                lines.append((current_line, self.color_default))
-                current_line = ""
+    def read_markdown_stream(self, url, response, on_block=None):
+        """Reads a streamed response body as UTF-8 (at most MAX_DOCUMENT_BYTES) and caches it."""
+        # Явно указываем, что мы ожидаем UTF-8; decode incrementally so multibyte chars may span chunks
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        splitter = BlockSplitter() if on_block is not None else None
+        chunks = []
+        text_parts = []
+        size = 0
+        truncated = False
+        started = time.perf_counter()
+        # Small chunks: urllib3 waits until a whole chunk has arrived before handing it over
+        for chunk in response.iter_content(chunk_size=4096):
+            if size + len(chunk) > self.MAX_DOCUMENT_BYTES:
+                chunk = chunk[:self.MAX_DOCUMENT_BYTES - size]
+                truncated = True
+            chunks.append(chunk)
+            size += len(chunk)
+            text = decoder.decode(chunk)
+            text_parts.append(text)
+            if splitter is not None:
+                blocks = splitter.feed(text)
+                if blocks:
+                    on_block(blocks)
+            if truncated:
+                break
+        text_parts.append(decoder.decode(b'', final=True))
+        markdown_text = ''.join(text_parts)
+        self.tracer.record(url, 'download', (time.perf_counter() - started) * 1000, bytes=size)
+
+        if truncated:
+            # Never cache a cut-off body as if it were the whole page
+            limit_mb = self.MAX_DOCUMENT_BYTES / (1024 * 1024)
+            return markdown_text + f"\n\n*[Document truncated: larger than {limit_mb:g} MB]*\n"
+        try:
+            self.http_cache.store(url, b''.join(chunks), response.headers)
+        except OSError:
+            pass  # A full or read-only disk must not break browsing
+        return markdown_text
+
+    def render_markdown_to_curses(self, markdown_text, base_url, append=False):
+        """Renders markdown to a CompactDocument and sets self.links/self.images from it.
+
+        With append=True the text continues the current page (progressive loading): it is added to
+        self.document in place, and links and images are numbered on from the ones already there.
+        """
+        if not append:
+            self.set_document(CompactDocument())
+        return self.render_into(self.document, markdown_text, base_url, self.simple_mode, append)
+
+    def render_into(self, document, markdown_text, base_url, simple_mode, append=False):
+        """Parses and renders markdown onto the end of document and records the timings.
+
+        Touches no UI state, so it runs on loader threads too. Returns document.
+        """
+        started = time.perf_counter()
+        ast = parse_markdown(markdown_text)
+        parsed = time.perf_counter()
+        rendered = render_ast(ast, base_url, simple_mode, len(document.links) + 1, len(document.images) + 1)
+        document.append(rendered)
+
+        # Blocks of a streamed page add up; the final full render replaces them
+        self.tracer.record(base_url, 'parse', (parsed - started) * 1000, add=append, bytes=len(markdown_text),
+                           parser=markdown_parser.name)
+        memory = {}
+        if not append:
+            # What the page takes now versus kept as the segment list render_ast returned
+            memory = {'memory': document.nbytes(), 'segment_memory': rendered.nbytes()}
+        self.tracer.record(base_url, 'render', (time.perf_counter() - parsed) * 1000, add=append,
+                           segments=len(rendered.segments), **memory)
+        return document
+
+    def activate_tab(self, tab):
+        """Puts tab on screen with its own document, layouts and place: no fetch, no re-render."""
+        tab.viewed_at = time.monotonic()
+        self.set_document(tab.document)
+        self.trim_tabs(tab)
+        return tab
+
+    def open_background_tab(self, url, after):
+        """Opens url in a new tab right after the tab after; it loads while the user stays put."""
+        tab = Tab(url, History(None))
+        tab.history.visit(url)
+        page = self.page_cache.get(url)
+        rendered = page.renders.get(self.simple_mode) if page is not None else None
+        if rendered is not None:
+            tab.show(rendered[0], self.simple_mode)
+        else:
+            tab.page_job = self.loader.submit('page', url, self.load_page, url, False, False, self.simple_mode,
+                                              progress=True)
+        self.tabs.insert(self.tabs.index(after) + 1, tab)
+        return tab
+
+    def close_tab(self, tab):
+        if tab.page_job is not None:
+            tab.page_job.cancel()
+        index = self.tabs.index(tab)
+        self.tabs.remove(tab)
+        if tab.history is self.history:
+            # The history kept across sessions is now the one of the tab taking its place
+            heir = self.tabs[min(index, len(self.tabs) - 1)]
+            heir.history.path = self.history.path
+            self.history = heir.history
+            self.history.save()
 
-        # Append any remaining text on the current line
-        if current_line:
-            lines.append((current_line, current_attr))
+    def trim_tabs(self, active):
+        """Drops the rendered pages of the least recently viewed tabs beyond TAB_MEMORY_BYTES.
 
-        # Add a final newline if needed (only if the last line didn't end with \n)
-        if current_line and not current_line.endswith('\n'):
-            lines.append(("\n", self.color_default))
+        The page and render caches let go of them too, or nothing would be freed; pages that
+        another tab shows stay, since that tab still holds them.
+        """
+        kept = 0
+        for tab in sorted(self.tabs, key=lambda tab: tab.viewed_at, reverse=True):
+            if tab is active:
+                continue
+            size = tab.nbytes()
+            if kept + size > self.TAB_MEMORY_BYTES:
+                url, document = tab.shown_url, tab.document
+                tab.discard_render()
+                if tab.document is not document and not any(other.document is document for other in self.tabs):
+                    self.page_cache.discard_render(url, document)
+                    self.render_cache.discard(document)
+            else:
+                kept += size
+
+    def set_document(self, document):
+        """Makes document the current page; self.links/self.images are its LinkRecord tables."""
+        self.document = document
+        self.links = document.links
+        self.images = document.images
+
+    def style_attrs(self):
+        """curses attributes indexed by style ID."""
+        return (self.color_default, self.color_bold, self.color_italic, self.color_link, self.color_image,
+                self.color_header)
+
+    def cached_page_document(self, url):
+        """Returns the rendered document for url from the page cache, or None if it has to be fetched."""
+        page = self.page_cache.get(url)
+        if page is None:
+            return None
+        rendered = page.renders.get(self.simple_mode)
+        if rendered is not None:
+            self.tracer.record(url, 'cache', result='rendered')
+            self.set_document(rendered[0])
+            return self.document
+        self.tracer.record(url, 'cache', result='page')
+        return self.render_page(url, page.text)
+
+    def render_page(self, url, markdown_content):
+        """Renders fetched content for url (see render_document) and makes it the current page."""
+        self.set_document(self.render_document(url, markdown_content, self.simple_mode))
+        return self.document
+
+    def render_document(self, url, markdown_content, simple_mode):
+        """Renders fetched content for url into a new document and remembers it in the page cache.
+
+        Content rendered before in this mode (even in an earlier session) comes from the render
+        cache without being parsed. Touches no UI state, so it runs on loader threads too.
+        """
+        # Check if fetch_markdown returned an error message instead of content
+        if markdown_content.startswith("[ERROR]"):
+            # Display error message as content; errors are not cached so a revisit retries
+            return self.render_into(CompactDocument(), f"# Fetch Error\n\n{markdown_content}", url, simple_mode)
+        if self.page_cache.get(url) is None:
+            self.page_cache.put(url, markdown_content)
+        started = time.perf_counter()
+        key = self.render_cache.key(markdown_content, url, simple_mode)
+        document = self.render_cache.get(key)
+        if document is not None:
+            self.tracer.record(url, 'render', (time.perf_counter() - started) * 1000, memo=True)
+        else:
+            document = self.render_into(CompactDocument(), markdown_content, url, simple_mode)
+            self.render_cache.put(key, document)
+        self.page_cache.add_render(url, simple_mode, document)
+        return document
+
+    def load_page(self, url, revalidate, from_history, simple_mode, on_block=None):
+        """Page job of the Loader: fetches url and renders the whole page, both on the loader thread.
 
-        return lines
+        Streamed blocks go to on_block as they arrive. Returns (markdown text or [ERROR] message,
+        simple_mode, CompactDocument), so the UI thread only has to show the document.
+        """
+        markdown_content = self.fetch_markdown(url, revalidate, from_history, on_block)
+        return markdown_content, simple_mode, self.render_document(url, markdown_content, simple_mode)
 
-    def display_content(self, lines, scroll_pos):
-        """Displays the rendered content lines starting from scroll_pos."""
+    def display_content(self, layout, scroll_pos, overlays=(), prompt=None):
+        """Displays the wrapped rows of layout starting from screen row scroll_pos.
+
+        overlays are (text offset, text, attr) drawn over the page (link hints and highlights);
+        prompt replaces the bottom line while a link or image is being selected.
+        """
         max_y, max_x = self.stdscr.getmaxyx()
         status_bar_height = 2
         content_start_y = 1
         content_end_y = max_y - status_bar_height - 1
 
-        self.stdscr.erase()
-
-        # Display URL bar
-        self.stdscr.addstr(0, 0, f"URL: {self.current_url[:max_x - 6]}", curses.A_REVERSE)
-        self.stdscr.clrtoeol()  # Clear to end of line
-
-        # Display content lines
-        line_idx = scroll_pos
-        disp_y = content_start_y
-        while disp_y <= content_end_y and line_idx < len(lines):
-            text, attr = lines[line_idx]
-            # Split text by newlines to handle multi-line strings in one element
-            text_parts = text.split('\n')
-            for i, part in enumerate(text_parts):
-                if disp_y > content_end_y:
-                    break
-                # Add the part of the line
-                try:
-                    self.stdscr.addstr(disp_y, 0, part.ljust(max_x), attr)
-                    self.stdscr.clrtoeol()  # Clear to end of line to avoid artifacts
-                except curses.error:
-                    # Ignore if trying to addstr outside window bounds
-                    pass
+        # Build the whole frame; the painter sends only the rows that differ from the last one
+        if self.show_timings:
+            header = self.tracer.summary(self.current_url)
+        else:
+            header = f"{self.tab_label}URL: {self.current_url}"
+        frame = [[(header[:max_x - 1], curses.A_REVERSE)]]
 
-                # Move to next line only if it's not the last part of the split
-                if i < len(text_parts) - 1:
-                    disp_y += 1
-            line_idx += 1
-            disp_y += 1
+        # Display content rows: only the visible slice of the layout is touched
+        content_rows = content_end_y - content_start_y + 1
+        rows = layout.visible_rows(scroll_pos, content_rows, self.style_attrs())
+        if overlays:
+            for i in range(len(rows)):
+                start, end = layout.row_starts[scroll_pos + i], layout.row_ends[scroll_pos + i]
+                hits = [overlay for overlay in overlays if overlay[0] < end and overlay[0] + len(overlay[1]) > start]
+                if hits:
+                    rows[i] = overlay_runs(rows[i], start, hits)
+        frame.extend(rows)
+        while len(frame) < content_end_y + 1:
+            frame.append([])
 
+        row_count = f"{layout.row_count}" if layout.complete else f"{layout.row_count}+"
         # Display status bar
         mode_text = "SIMPLE" if self.simple_mode else "NORMAL"
-        status_text = f"Mode: {mode_text} | Lines: {len(lines)} | Scroll: {scroll_pos + 1}/{len(lines)} | Links: {len(self.links)} Images: {len(self.images)} | Keys: j/k/pgup/pgdn - scroll, g/G - top/bottom, b - back, q - quit, l<n> - link, i<n> - image, m - toggle mode, s - search sites"
+        if self.offline:
+            mode_text += " OFFLINE"
+        prefetch_text = ""
+        if self.prefetcher is not None:
+            pending, done = self.prefetcher.status()
+            prefetch_text = f" | Prefetch: {done} done, {pending} pending"
+        status_text = f"Mode: {mode_text}{prefetch_text} | Lines: {row_count} | Scroll: {scroll_pos + 1}/{row_count} | Links: {len(self.links)} Images: {len(self.images)} | Out: {self.painter.frame_bytes}B/frame | Keys: j/k/pgup/pgdn - scroll, g/G - top/bottom, b/f - back/forward, q - quit, l/i - select link/image, Tab/Enter - focus/open link, m - toggle mode, r - reload, Esc - cancel loading, t - new tab, T - open link in new tab, [/] - previous/next tab, x - close tab, / - find in page, n/N - next/previous match, s - search sites, F - full-text search, p - timings"
         # Truncate status text if necessary
         status_text = status_text[:max_x - 1]
-        self.stdscr.addstr(max_y - status_bar_height, 0, status_text, self.color_status)
-        self.stdscr.clrtoeol()
-        self.stdscr.addstr(max_y - 1, 0, f"Current: {self.current_url[:max_x - 11]}", self.color_status)
-        self.stdscr.clrtoeol()
+        frame.append([(status_text, self.color_status)])
+        if prompt is not None:
+            bottom_text = prompt
+        elif self.loading_url:
+            spinner = "|/-\\"[int(time.time() * 10) % 4]
+            bottom_text = f"{spinner} Loading: {self.loading_url} (Esc - cancel)"
+        else:
+            bottom_text = f"Current: {self.current_url}"
+        frame.append([(bottom_text[:max_x - 1], self.color_status)])
 
-        self.stdscr.refresh()
+        started = time.perf_counter()
+        frame_bytes = self.painter.paint(frame, (content_start_y, content_end_y), layout, scroll_pos)
+        if frame_bytes and not self.loading_url and not self.tracer.recorded(self.current_url, 'paint'):
+            # First paint of the finished page; later frames (scrolling) are not traced
+            self.tracer.record(self.current_url, 'paint', (time.perf_counter() - started) * 1000,
+                               bytes=frame_bytes, total_ms=self.tracer.since_navigate(self.current_url))
+
+    def _on_resize(self, signum, frame):
+        self.resized = True  # The wakeup fd is written by Python itself, so select() returns
+
+    def teardown_input(self):
+        """Undoes the signal handling set up by setup_curses."""
+        if self.previous_sigwinch is not None:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGWINCH, self.previous_sigwinch)
+            self.previous_sigwinch = None
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+
+    def read_key(self, timeout=None, wide=False):
+        """Waits for a key for up to timeout seconds (None: for ever) and returns it.
+
+        Returns -1 when the wait ended without a key: the timeout passed or a background job
+        woke us up (self.woken is then set). wide=True returns str keys, as get_wch() does.
+        """
+        self.woken = False
+        while True:
+            if self.resized:
+                self.resized = False
+                lines, cols = os.get_terminal_size(sys.stdin.fileno())[::-1]
+                if curses.is_term_resized(lines, cols):
+                    curses.resizeterm(lines, cols)
+                    curses.update_lines_cols()
+                    self.painter.invalidate()
+                    return curses.KEY_RESIZE
+            try:
+                key = self.stdscr.get_wch() if wide else self.stdscr.getch()
+            except curses.error:
+                key = -1
+            if key != -1:
+                return key
+            if self.woken:
+                return -1
+            ready = self.selector.select(timeout)
+            if not ready:
+                return -1  # Timed out
+            for selector_key, _ in ready:
+                if selector_key.fileobj is self.wakeup:
+                    self.wakeup.drain()
+                    self.woken = True
+            # Loop: a resize, a key, or (woken) one last check for a key before returning
 
     def search_sites(self):
-        """Displays a search interface for sites listed in SITES_LIST_URL."""
-        # Prompt for search query
-        self.stdscr.clear()
-        self.stdscr.addstr(0, 0, "Alternet Site Search", curses.A_REVERSE)
-        self.stdscr.clrtoeol()
-        self.stdscr.addstr(2, 0, "Enter search query: ", curses.A_BOLD)
-        self.stdscr.refresh()
+        """Displays a search-as-you-type interface for sites listed in SITES_LIST_URL.
+
+        Results come from the persisted SiteIndex; the list is fetched again in the background
+        only when the index is missing or stale. Returns the selected URL or None.
+        """
+        self.site_index.load()
+        sites_job = None
+        if self.site_index.is_stale():
+            sites_job = self.loader.submit('sites', self.SITES_LIST_URL, self.fetch_markdown, self.SITES_LIST_URL)
 
-        # Get search query
         search_query = ""
-        y, x = 2, 22
+        matches = self.site_index.search(search_query)
+        selected = 0
+        error_msg = ""
         while True:
-            char = self.stdscr.getch()
-            if char == 10 or char == 13:  # Enter key
-                break
-            elif char == ord('q') or char == ord('Q'):  # Quit
-                return None
-            elif char == curses.KEY_BACKSPACE or char == 127 or char == 8:  # Backspace
-                if len(search_query) > 0:
-                    search_query = search_query[:-1]
-                    # Redraw line to remove character
-                    self.stdscr.move(y, x)
-                    self.stdscr.clrtoeol()
-                    self.stdscr.addstr(y, x, search_query)
-            elif 32 <= char <= 126:  # Printable characters
-                search_query += chr(char)
-                self.stdscr.addstr(y, x + len(search_query) - 1, chr(char))
-            self.stdscr.refresh()
+            # Swap in the refreshed index as soon as the list has been fetched
+            if sites_job is not None and sites_job.finished.is_set():
+                markdown_content = sites_job.result
+                if sites_job.error is not None:
+                    markdown_content = f"[ERROR] Failed to fetch {self.SITES_LIST_URL}: {sites_job.error}"
+                if not markdown_content or markdown_content.startswith("[ERROR]"):
+                    error_msg = f"Failed to load site list: {markdown_content if markdown_content else 'No content'}"
+                else:
+                    self.site_index.update(markdown_content, self.SITES_LIST_URL)
+                    matches = self.site_index.search(search_query)
+                    selected = 0
+                sites_job = None
 
-        if not search_query:
-            # If query is empty, perhaps show all or just return
-            msg = "Empty query. Press any key to return."
-            self.stdscr.addstr(4, 0, msg[:curses.COLS - 1], curses.color_pair(1) | curses.A_REVERSE)
+            # Draw the search screen
+            max_y, max_x = self.stdscr.getmaxyx()
+            page_size = max(1, max_y - 6)
+            page_start = selected // page_size * page_size
+            self.stdscr.erase()
+            self.stdscr.addstr(0, 0, "Alternet Site Search"[:max_x - 1], curses.A_REVERSE)
             self.stdscr.clrtoeol()
+            self.stdscr.addstr(2, 0, f"Search: {search_query}"[:max_x - 1], curses.A_BOLD)
+            if error_msg:
+                info = error_msg
+            elif sites_job is not None and not self.site_index.sites:
+                info = "Loading site list..."
+            else:
+                pages = (len(matches) + page_size - 1) // page_size
+                info = f"{len(matches)} site(s), page {page_start // page_size + 1}/{max(1, pages)}"
+                if sites_job is not None:
+                    info += " (refreshing list...)"
+            self.stdscr.addstr(3, 0, info[:max_x - 1], curses.A_NORMAL)
+            for row, (name, site_url) in enumerate(matches[page_start:page_start + page_size]):
+                display_text = f"{page_start + row + 1}. {name} -> {site_url}"
+                if len(display_text) > max_x - 1:
+                    display_text = display_text[:max_x - 4] + "..."
+                attr = curses.A_REVERSE if page_start + row == selected else curses.A_NORMAL
+                self.stdscr.addstr(4 + row, 0, display_text, attr)
+            help_text = "Type to search | Up/Down, PgUp/PgDn - select | Enter - open | Esc - cancel"
+            self.stdscr.addstr(max_y - 1, 0, help_text[:max_x - 1], curses.A_BOLD)
             self.stdscr.refresh()
-            self.stdscr.getch()  # Wait for keypress
-            return None
 
-        # Fetch the list of sites
-        markdown_content = self.fetch_markdown(self.SITES_LIST_URL)
-        if not markdown_content or markdown_content.startswith("[ERROR]"):
-            error_msg = f"Failed to load site list: {markdown_content if markdown_content else 'No content'}"
-            self.stdscr.addstr(4, 0, error_msg[:curses.COLS - 1], curses.color_pair(1) | curses.A_REVERSE)
+            # Wide characters so non-ASCII (e.g. Cyrillic) queries can be typed
+            char = self.read_key(wide=True)
+            if char == -1:
+                continue  # Woken up: check on the background fetch again
+            if char in ('\n', '\r', curses.KEY_ENTER):
+                if matches:
+                    return matches[selected][1]
+            elif char == '\x1b':  # Esc
+                if sites_job is not None:
+                    sites_job.cancel()
+                return None
+            elif char in (curses.KEY_BACKSPACE, '\x7f', '\x08'):
+                if search_query:
+                    search_query = search_query[:-1]
+                    matches = self.site_index.search(search_query)
+                    selected = 0
+            elif char == curses.KEY_UP:
+                selected = max(0, selected - 1)
+            elif char == curses.KEY_DOWN:
+                selected = min(max(0, len(matches) - 1), selected + 1)
+            elif char == curses.KEY_PPAGE:
+                selected = max(0, selected - page_size)
+            elif char == curses.KEY_NPAGE:
+                selected = min(max(0, len(matches) - 1), selected + page_size)
+            elif isinstance(char, str) and char.isprintable():
+                search_query += char
+                matches = self.site_index.search(search_query)
+                selected = 0
+
+    def search_pages(self):
+        """Full-text search over every page loaded so far. Returns the selected URL or None."""
+        search_query = ""
+        results = []
+        selected = 0
+        elapsed_ms = 0.0
+        while True:
+            max_y, max_x = self.stdscr.getmaxyx()
+            page_size = max(1, (max_y - 6) // 3)  # Title, URL and snippet per result
+            page_start = selected // page_size * page_size
+            self.stdscr.erase()
+            self.stdscr.addstr(0, 0, "Full-text Search (visited and cached pages)"[:max_x - 1], curses.A_REVERSE)
             self.stdscr.clrtoeol()
+            self.stdscr.addstr(2, 0, f"Search: {search_query}"[:max_x - 1], curses.A_BOLD)
+            if not self.page_index.available:
+                info = "Full-text search is unavailable (SQLite without FTS5)."
+            elif search_query:
+                info = f"{len(results)} page(s) in {elapsed_ms:.1f} ms"
+            else:
+                info = "Type words to search for."
+            self.stdscr.addstr(3, 0, info[:max_x - 1], curses.A_NORMAL)
+            y = 4
+            for i, (page_url, title, snippet) in enumerate(results[page_start:page_start + page_size]):
+                attr = curses.A_REVERSE if page_start + i == selected else curses.A_BOLD
+                self.stdscr.addstr(y, 0, f"{page_start + i + 1}. {title}"[:max_x - 1], attr)
+                self.stdscr.addstr(y + 1, 3, page_url[:max_x - 4], self.color_link)
+                # Snippet with matches (between \x02 and \x03) highlighted
+                x = 3
+                for j, part in enumerate(re.split('[\x02\x03]', snippet.replace('\n', ' '))):
+                    part = part[:max(0, max_x - 1 - x)]
+                    if part:
+                        self.stdscr.addstr(y + 2, x, part, self.color_bold if j % 2 else curses.A_NORMAL)
+                        x += len(part)
+                y += 3
+            help_text = "Type to search | Up/Down, PgUp/PgDn - select | Enter - open | Esc - cancel"
+            self.stdscr.addstr(max_y - 1, 0, help_text[:max_x - 1], curses.A_BOLD)
             self.stdscr.refresh()
-            self.stdscr.getch()  # Wait for keypress to acknowledge
-            return None
 
-        # Parse markdown to extract links and their text content
-        ast = commonmark.Parser().parse(markdown_content)
-        walker = ast.walker()
-
-        sites = []  # List of (link_text, destination_url)
-        current_link_text = ""  # To accumulate text *inside* the link
-
-        for current, entering in walker:
-            node_type = current.t
-            literal = current.literal
-
-            if node_type == 'link':
-                if entering:
-                    # Start collecting text for this link
-                    current_link_text = ""
-                else:  # exiting the link node
-                    # The destination URL is current.destination
-                    dest_url = urljoin(self.SITES_LIST_URL, current.destination)
-                    # Use the accumulated text inside the link as the link text
-                    link_text = current_link_text.strip()
-                    if link_text and dest_url:  # Only add if both exist
-                        sites.append((link_text, dest_url))
-                    # Reset for the next link
-                    current_link_text = ""
-            elif node_type == 'text' and current_link_text is not None:
-                # If we are inside a link (current_link_text is not None),
-                # add the text literal to the current link's text
-                current_link_text += literal
-
-        # Filter sites based on search query (case-insensitive)
-        search_lower = search_query.lower()
-        filtered_sites = [(name, url) for name, url in sites if search_lower in name.lower()]
-
-        # Display search results
-        self.stdscr.clear()
-        self.stdscr.addstr(0, 0, f"Alternet Search: '{search_query}'", curses.A_REVERSE)
-        self.stdscr.clrtoeol()
-
-        if not filtered_sites:
-            self.stdscr.addstr(2, 0, f"No sites found matching '{search_query}'. Press any key to return.",
-                               curses.A_NORMAL)
-        else:
-            self.stdscr.addstr(2, 0,
-                               f"Found {len(filtered_sites)} site(s) matching '{search_query}'. Select one (or 'q' to cancel):",
-                               curses.A_NORMAL)
-            max_y, max_x = self.stdscr.getmaxyx()
-            start_display_y = 4
-            for i, (name, url) in enumerate(filtered_sites):
-                display_num = i + 1
-                display_text = f"{display_num}. {name[:max_x - 5]} -> {url[:max_x - 5 - len(name) - 6]}"
-                if len(display_text) > max_x - 1:
-                    display_text = display_text[:max_x - 4] + "..."
-                self.stdscr.addstr(start_display_y + i, 0, display_text, curses.A_NORMAL)
-                if start_display_y + i >= max_y - 3:  # Leave space for prompt and error
-                    break
+            char = self.read_key(wide=True)
+            if char == -1:
+                continue  # Woken up by a background job; nothing to do here
+            query_changed = False
+            if char in ('\n', '\r', curses.KEY_ENTER):
+                if results:
+                    return results[selected][0]
+            elif char == '\x1b':  # Esc
+                return None
+            elif char in (curses.KEY_BACKSPACE, '\x7f', '\x08'):
+                if search_query:
+                    search_query = search_query[:-1]
+                    query_changed = True
+            elif char == curses.KEY_UP:
+                selected = max(0, selected - 1)
+            elif char == curses.KEY_DOWN:
+                selected = min(max(0, len(results) - 1), selected + 1)
+            elif char == curses.KEY_PPAGE:
+                selected = max(0, selected - page_size)
+            elif char == curses.KEY_NPAGE:
+                selected = min(max(0, len(results) - 1), selected + page_size)
+            elif isinstance(char, str) and char.isprintable():
+                search_query += char
+                query_changed = True
+            if query_changed:
+                started = time.perf_counter()
+                results = self.page_index.search(search_query)
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                selected = 0
 
-        # Prompt for selection if there are results
-        if filtered_sites:
-            prompt_y = max(5, start_display_y + len(filtered_sites))
-            self.stdscr.addstr(prompt_y, 0, "Enter number: ", curses.A_BOLD)
-            self.stdscr.refresh()
+    def download_image(self, image_url):
+        """Streams an image into a temporary file (at most MAX_IMAGE_BYTES) and returns its path.
 
-            # Get user input for selection
-            input_str = ""
-            y, x = prompt_y, 14
-            while True:
-                char = self.stdscr.getch()
-                if char == 10 or char == 13:  # Enter key
-                    break
-                elif char == ord('q') or char == ord('Q'):  # Quit
-                    return None
-                elif char == curses.KEY_BACKSPACE or char == 127 or char == 8:  # Backspace
-                    if len(input_str) > 0:
-                        input_str = input_str[:-1]
-                        # Redraw line to remove character
-                        self.stdscr.move(y, x)
-                        self.stdscr.clrtoeol()
-                        self.stdscr.addstr(y, x, input_str)
-                elif 48 <= char <= 57:  # Digits 0-9
-                    input_str += chr(char)
-                    self.stdscr.addstr(y, x + len(input_str) - 1, chr(char))
-                self.stdscr.refresh()
-
-            # Process the input
-            try:
-                selection_num = int(input_str)
-                if 1 <= selection_num <= len(filtered_sites):
-                    selected_url = filtered_sites[selection_num - 1][1]
-                    return selected_url
-                else:
-                    error_msg = f"Invalid selection: {selection_num}. Must be between 1 and {len(filtered_sites)}."
-                    self.stdscr.addstr(prompt_y + 2, 0, error_msg[:curses.COLS - 1],
-                                       curses.color_pair(1) | curses.A_REVERSE)
-                    self.stdscr.clrtoeol()
-                    self.stdscr.refresh()
-                    self.stdscr.getch()  # Wait for keypress
-                    return self.search_sites()  # Recursive call to try again
-            except ValueError:
-                error_msg = f"Invalid input: '{input_str}'. Please enter a number."
-                self.stdscr.addstr(prompt_y + 2, 0, error_msg[:curses.COLS - 1],
-                                   curses.color_pair(1) | curses.A_REVERSE)
-                self.stdscr.clrtoeol()
-                self.stdscr.refresh()
-                self.stdscr.getch()  # Wait for keypress
-                return self.search_sites()  # Recursive call to try again
-        else:
-            # No results, just wait for a key press to return
-            self.stdscr.refresh()
-            self.stdscr.getch()
-            return None
+        Runs on a loader thread. Local (file:// or mirrored) images are returned in place.
+        """
+        import mimetypes
+        import tempfile
+        path = self.local_path(image_url)
+        if path is not None:
+            return path
 
-    def open_image(self, image_url):
-        """Downloads and opens an image using PIL/Pillow."""
-        try:
-            response = self.session.get(image_url)
+        def read(response):
             response.raise_for_status()
-            image_data = response.content
 
             # Guess the file extension from the URL or content-type
             parsed_url = urlparse(image_url)
@@ -525,37 +3503,321 @@ class AlternetBrowser:
                 content_type = response.headers.get('Content-Type', '')
                 ext = mimetypes.guess_extension(content_type.split(';')[0]) or '.jpg'  # fallback
 
-            # Create a temporary file
+            # Create a temporary file; callers delete it with discard_download()
             with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as tmp_file:
-                tmp_file.write(image_data)
-                temp_filename = tmp_file.name
+                size = 0
+                try:
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        size += len(chunk)
+                        if size > self.MAX_IMAGE_BYTES:
+                            raise ValueError(f"image is larger than {self.MAX_IMAGE_BYTES // (1024 * 1024)} MB")
+                        tmp_file.write(chunk)
+                except BaseException:
+                    tmp_file.close()
+                    os.unlink(tmp_file.name)
+                    raise
+                return tmp_file.name
+
+        # Not merged: every caller gets (and deletes) its own temporary file
+        return self.transport.fetch(image_url, read, merge=False)
+
+    def submit_download(self, image_url):
+        """Downloads an image for the viewer in the background; if the job is cancelled, its file is deleted."""
+        return self.loader.submit('image', image_url, self.download_image, image_url,
+                                  cleanup=lambda path: self.discard_download(image_url, path))
+
+    def discard_download(self, image_url, path):
+        """Deletes a temporary file made by download_image (local images are left alone)."""
+        if path is not None and self.local_path(image_url) is None:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def load_image_preview(self, image_url, cols, rows, mode, colors):
+        """Downloads and decodes an image into a preview cell grid. Runs on a loader thread."""
+        from PIL import Image
+        path = self.download_image(image_url)
+        try:
+            with Image.open(path) as img:
+                return image_to_cells(img, cols, rows, mode, colors)
+        finally:
+            self.discard_download(image_url, path)
+
+    def show_image_preview(self, image_url, cells, mode):
+        """Draws a decoded preview over the content area and waits for a key. Returns the key."""
+        max_y, max_x = self.stdscr.getmaxyx()
+        self.stdscr.erase()
+        self.stdscr.addstr(0, 0, f"Image: {image_url}"[:max_x - 1], curses.A_REVERSE)
+        self.stdscr.clrtoeol()
+        if mode == 'halfblock':
+            pairs = {}  # (fg, bg) -> color pair number
+            next_pair = 16  # 1-7 are the page colors
+            for y, row in enumerate(cells[:max_y - 3]):
+                # Runs of cells with the same colors are drawn with one addstr
+                x = 0
+                while x < len(row) and x < max_x:
+                    colors = row[x]
+                    run = 1
+                    while x + run < len(row) and x + run < max_x and row[x + run] == colors:
+                        run += 1
+                    pair = pairs.get(colors)
+                    if pair is None:
+                        pair = min(next_pair, min(curses.COLOR_PAIRS, 256) - 1)
+                        next_pair += 1
+                        curses.init_pair(pair, colors[0] % curses.COLORS, colors[1] % curses.COLORS)
+                        pairs[colors] = pair
+                    try:
+                        self.stdscr.addstr(1 + y, x, "\u2580" * run, curses.color_pair(pair))
+                    except curses.error:
+                        pass
+                    x += run
+        else:
+            for y, row in enumerate(cells[:max_y - 3]):
+                try:
+                    self.stdscr.addstr(1 + y, 0, row[:max_x - 1], self.color_image)
+                except curses.error:
+                    pass
+        help_text = "o - open in external viewer | any other key - back"
+        self.stdscr.addstr(max_y - 1, 0, help_text[:max_x - 1], self.color_status)
+        self.stdscr.refresh()
+        key = self.read_key()
+        while key in (-1, curses.KEY_RESIZE):  # Woken up by a background job or a resize
+            key = self.read_key()
+        self.painter.invalidate()
+        return key
 
-            # Open the image using PIL, which uses the system's default viewer
-            img = Image.open(temp_filename)
-            img.show()
+    def open_image(self, image_url, temp_filename=None):
+        """Opens an image using PIL/Pillow, downloading it first unless temp_filename is given."""
+        try:
+            from PIL import Image
+            if temp_filename is None:
+                temp_filename = self.download_image(image_url)
 
-            # Optionally, delete the temp file after a delay or prompt
-            # os.unlink(temp_filename) # Uncomment if you want to auto-delete
+            # Open the image using PIL, which uses the system's default viewer.
+            # show() writes its own copy for the viewer, so our download can go right away.
+            with Image.open(temp_filename) as img:
+                img.load()
+                img.show()
 
         except Exception as e:
             # Return error message to be displayed potentially in a pop-up or status
-            error_msg = f"Could not open image {image_url}: {e}"
-            self.stdscr.addstr(curses.LINES - 3, 0, error_msg[:curses.COLS - 1],
-                               curses.color_pair(1) | curses.A_REVERSE)
-            self.stdscr.clrtoeol()
-            self.stdscr.refresh()
-            self.stdscr.getch()  # Wait for keypress to acknowledge error
+            self.show_message(f"Could not open image {image_url}: {e}")
+        finally:
+            self.discard_download(image_url, temp_filename)
+
+    def show_message(self, msg):
+        """Shows a one-line message above the status bar and waits for a key press."""
+        self.stdscr.addstr(curses.LINES - 3, 0, msg[:curses.COLS - 1],
+                           curses.color_pair(1) | curses.A_REVERSE)
+        self.stdscr.clrtoeol()
+        self.stdscr.refresh()
+        while self.read_key() in (-1, curses.KEY_RESIZE):  # Woken up by a background job or a resize
+            pass
+        self.painter.invalidate()
 
     def run(self):
         """Main loop of the browser using curses."""
+        if len(sys.argv) > 1 and sys.argv[1] == 'crawl':
+            return self.crawl(sys.argv[2:])
+        if len(sys.argv) > 1 and sys.argv[1] == 'render':
+            return self.render(sys.argv[2:])
+        if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+            return self.serve(sys.argv[2:])
+        parser = argparse.ArgumentParser(description="Alternet Browser",
+                                         epilog="Mirror sites for offline use: %(prog)s crawl --help; "
+                                                "render pages without a terminal: %(prog)s render --help; "
+                                                "share fetching between users: %(prog)s serve --help")
+        parser.add_argument('url', nargs='?', help="URL to open (default: home page)")
+        parser.add_argument('--offline', action='store_true', help="serve pages from the local cache only")
+        parser.add_argument('--mirror', metavar='DIR', help="read pages from a mirror made by crawl when present")
+        parser.add_argument('--prefetch', type=int, default=0, metavar='N',
+                            help="fetch the first N linked pages in the background (default: off)")
+        parser.add_argument('--connect-timeout', type=float, default=self.transport.timeout[0], metavar='SEC',
+                            help=f"network connect timeout (default: {self.transport.timeout[0]})")
+        parser.add_argument('--read-timeout', type=float, default=self.transport.timeout[1], metavar='SEC',
+                            help=f"network read timeout (default: {self.transport.timeout[1]})")
+        parser.add_argument('--retries', type=int, default=self.transport.retries, metavar='N',
+                            help=f"retries of failed requests, with backoff (default: {self.transport.retries})")
+        parser.add_argument('--parser', choices=('auto',) + tuple(PARSER_BACKENDS), default='auto',
+                            help="markdown parser (default: auto, the fastest installed)")
+        parser.add_argument('--trace', metavar='FILE',
+                            help="append per-phase timings of every page load to FILE as JSON lines")
+        parser.add_argument('--gateway', metavar='URL',
+                            help="fetch pages through a gateway started with `serve` (e.g. http://127.0.0.1:8070)")
+        args = parser.parse_args()
+        try:
+            select_parser(args.parser)
+        except ValueError as e:
+            parser.error(str(e))
+        if args.trace:
+            self.tracer.open(args.trace)
+        self.offline = args.offline
+        self.mirror_dir = args.mirror
+        self.gateway = args.gateway.rstrip('/') if args.gateway else None
+        self.transport.timeout = (args.connect_timeout, args.read_timeout)
+        self.transport.retries = max(0, args.retries)
+        if args.prefetch > 0:
+            self.prefetcher = Prefetcher(self.fetch_markdown, self.page_cache, max_pages=args.prefetch,
+                                         notify=self.wakeup.notify)
+
         print("Starting Alternet Browser TUI...")  # Initial message before curses takes over
         initial_url = None
-        if len(sys.argv) > 1:
-            initial_url = sys.argv[1].strip()
+        if args.url and args.url.strip():
+            initial_url = args.url.strip()
         else:
             # Если аргумент не передан, используем домашнюю страницу по умолчанию
             initial_url = self.DEFAULT_HOME_URL
-        curses.wrapper(self.main_curses, initial_url)
+        try:
+            curses.wrapper(self.main_curses, initial_url)
+        finally:
+            self.teardown_input()
+            if self.prefetcher is not None:
+                self.prefetcher.shutdown()
+            self.tracer.event('session', self.current_url, **self.loop_stats)
+            self.tracer.close()
+
+    def serve(self, argv):
+        """Runs the gateway: one shared fetch and render service for many users of a slow uplink."""
+        parser = argparse.ArgumentParser(prog="browser.py serve",
+                                         description="Serve fetched and rendered AlterNet pages to many clients.")
+        parser.add_argument('--host', default='127.0.0.1', help="address to listen on (default: 127.0.0.1)")
+        parser.add_argument('--port', type=int, default=8070, help="port to listen on (default: 8070)")
+        parser.add_argument('--socket', metavar='PATH', help="listen on a Unix socket instead of TCP")
+        parser.add_argument('-j', '--workers', type=int, default=16,
+                            help="requests answered at the same time (default: 16)")
+        parser.add_argument('--fresh', type=float, default=60, metavar='SEC',
+                            help="serve a fetched page this long without asking its server again (default: 60)")
+        parser.add_argument('--offline', action='store_true', help="serve pages from the local cache only")
+        parser.add_argument('--mirror', metavar='DIR', help="read pages from a mirror made by crawl when present")
+        parser.add_argument('--parser', choices=('auto',) + tuple(PARSER_BACKENDS), default='auto',
+                            help="markdown parser (default: auto, the fastest installed)")
+        args = parser.parse_args(argv)
+        try:
+            select_parser(args.parser)
+        except ValueError as e:
+            parser.error(str(e))
+        self.offline = args.offline
+        self.mirror_dir = args.mirror
+        self.min_fresh = max(0.0, args.fresh)
+
+        server = gateway_server(Gateway(self), args.host, args.port, args.socket, args.workers)
+        where = args.socket or f"http://{args.host}:{server.server_address[1]}/"
+        print(f"Gateway listening on {where} (Ctrl-C to stop)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if args.socket:
+                try:
+                    os.unlink(args.socket)
+                except OSError:
+                    pass
+
+    def crawl(self, argv):
+        """Headless entry point: mirrors sites breadth-first into a local directory."""
+        parser = argparse.ArgumentParser(prog="browser.py crawl",
+                                         description="Mirror AlterNet pages for offline browsing (--mirror DIR).")
+        parser.add_argument('seeds', nargs='*', metavar='URL', help="start pages (default: the site list)")
+        parser.add_argument('-o', '--out', default='mirror', metavar='DIR', help="mirror directory (default: mirror)")
+        parser.add_argument('-d', '--depth', type=int, default=2, help="link depth to follow (default: 2)")
+        parser.add_argument('-j', '--concurrency', type=int, default=4, help="parallel requests (default: 4)")
+        parser.add_argument('--delay', type=float, default=1.0, metavar='SEC',
+                            help="pause between requests to the same host (default: 1.0)")
+        parser.add_argument('--images', action='store_true', help="also download images")
+        parser.add_argument('--same-host', action='store_true', help="do not leave the seed hosts")
+        parser.add_argument('--resume', action='store_true', help="continue an interrupted crawl from its journal")
+        args = parser.parse_args(argv)
+
+        crawler = Crawler(self, args.out, max_depth=args.depth, concurrency=max(1, args.concurrency),
+                          delay=args.delay, images=args.images, same_host=args.same_host)
+        saved, failed = crawler.run(args.seeds or [self.SITES_LIST_URL], resume=args.resume)
+        print(f"Done: {saved} page(s) saved to {args.out}, {failed} failed.")
+        for host, stats in sorted(self.transport.stats().items()):
+            print(f"  {host}: {stats['requests']} request(s), {stats['avg_ms']:.0f} ms avg, "
+                  f"{stats['errors']} error(s), {stats['retries']} retried")
+
+    def render(self, argv):
+        """Headless entry point: renders URLs, .md files or whole directories to text on stdout or files."""
+        parser = argparse.ArgumentParser(prog="browser.py render",
+                                         description="Render AlterNet pages to plain text or ANSI without a terminal.")
+        parser.add_argument('sources', nargs='+', metavar='URL|FILE|DIR',
+                            help="pages to render; directories (e.g. a crawl mirror) are searched for .md files")
+        parser.add_argument('-f', '--format', choices=('text', 'ansi'), default='text', help="output format")
+        parser.add_argument('--normal', action='store_true', help="render in normal mode instead of simple mode")
+        parser.add_argument('-w', '--width', type=int, default=0, metavar='COLS',
+                            help="word-wrap to COLS columns (default: no wrapping)")
+        parser.add_argument('--no-references', action='store_true', help="omit the numbered link and image lists")
+        parser.add_argument('-o', '--out', metavar='DIR',
+                            help="write one file per page into DIR instead of printing them")
+        parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                            help="worker processes (default: number of CPUs)")
+        parser.add_argument('--offline', action='store_true', help="serve pages from the local cache only")
+        parser.add_argument('--mirror', metavar='DIR', help="read pages from a mirror made by crawl when present")
+        parser.add_argument('--parser', choices=('auto',) + tuple(PARSER_BACKENDS), default='auto',
+                            help="markdown parser (default: auto, the fastest installed)")
+        args = parser.parse_args(argv)
+        try:
+            select_parser(args.parser)
+        except ValueError as e:
+            parser.error(str(e))
+
+        # (source, output file or None); directories expand to their .md files
+        work = []
+        suffix = '.ans' if args.format == 'ansi' else '.txt'
+        for source in args.sources:
+            if os.path.isdir(source):
+                for root, dirs, files in os.walk(source):
+                    dirs.sort()
+                    for name in sorted(files):
+                        if name.lower().endswith('.md'):
+                            path = os.path.join(root, name)
+                            target = None
+                            if args.out:
+                                target = os.path.join(args.out, os.path.relpath(path, source))
+                                target = os.path.splitext(target)[0] + suffix
+                            work.append((path, target))
+            else:
+                target = None
+                if args.out:
+                    if os.path.isfile(source):
+                        target = os.path.join(args.out, os.path.basename(source))
+                    else:
+                        target = mirror_path(args.out, self.normalize_url(source, local_files=True))
+                    target = os.path.splitext(target)[0] + suffix
+                work.append((source, target))
+
+        from concurrent.futures import ProcessPoolExecutor
+        options = (not args.normal, args.format == 'ansi', args.width or None, not args.no_references)
+        failed = 0
+
+        def report(source, output, error):
+            nonlocal failed
+            if error is not None:
+                failed += 1
+                print(f"{source}: {error}", file=sys.stderr)
+            elif args.out:
+                print(output)  # The file written
+            else:
+                sys.stdout.write(output)
+
+        jobs = min(max(1, args.jobs), len(work))
+        if jobs <= 1:
+            # One page (or -j 1): not worth starting processes
+            render_worker_init(args.offline, args.mirror, args.parser)
+            for source, target in work:
+                report(source, *render_source(source, target, *options))
+        else:
+            with ProcessPoolExecutor(max_workers=jobs, initializer=render_worker_init,
+                                     initargs=(args.offline, args.mirror, args.parser)) as pool:
+                futures = [pool.submit(render_source, source, target, *options) for source, target in work]
+                # Results are reported in input order so stdout reads like the sources were given
+                for (source, _), future in zip(work, futures):
+                    report(source, *future.result())
+        if failed:
+            sys.exit(1)
 
     def main_curses(self, stdscr, initial_url_arg):
         """Main curses application logic."""
@@ -569,150 +3831,427 @@ class AlternetBrowser:
         if not initial_url:
             return  # Exit if somehow initial_url is still empty after DEFAULT_HOME_URL fallback
 
-        url = self.normalize_url(initial_url)
-        self.history.append(url)
-        scroll_pos = 0
+        tab = Tab(self.normalize_url(initial_url, local_files=True), self.history)
+        self.tabs = [tab]
+        tab.history.load()
+        entry = tab.history.visit(tab.url)
+        tab.restore = (tab.url, entry.anchor)
+        # The splash stays until the first page arrives; the slow modules load meanwhile
+        preload_modules()
+        image_job = None  # Background download of an image preview ('preview') or for the viewer ('image')
+        preview_key = None
+        select_kind = None  # 'l' or 'i' while a link / image is being selected, 't' for a link to open in a new tab
+        select_input = ''  # Number or hint letters typed so far
+        hints = {}  # Hint letters -> index of a link / image on screen
+        find = PageFind()  # Matches of the last / query, in whichever page it was last run on
+        finding = False  # The / prompt is open
+        find_query = ''
+        find_regex = False
+        find_origin = 0  # Text offset at the top of the screen when / was pressed
 
         while True:
-            markdown_content = self.fetch_markdown(url)
-            # Check if fetch_markdown returned an error message instead of content
-            if markdown_content.startswith("[ERROR]"):
-                # Display error message as content
-                lines = self.render_markdown_to_curses(f"# Fetch Error\n\n{markdown_content}", url)
-            else:
-                lines = self.render_markdown_to_curses(markdown_content, url)
-
-            self.current_url = url
             max_y, max_x = self.stdscr.getmaxyx()
+            view_key = (tab.url, self.simple_mode)
+            new_document = None
+            new_document_mode = self.simple_mode  # Display mode new_document was rendered in
+            page_loaded = False  # The whole page of the tab has just come in
+
+            # Pick up finished background fetches, of this tab or of the others
+            for job in self.loader.poll():
+                owner = next((t for t in self.tabs if t.page_job is job), None)
+                if owner is not None:
+                    owner.page_job = None
+                    owner.streaming_url = None
+                    # The loader rendered the whole document once more (blocks were cut heuristically)
+                    if job.error is not None:
+                        document_mode = self.simple_mode
+                        document = self.render_document(job.url, f"[ERROR] Failed to fetch {job.url}: {job.error}",
+                                                        document_mode)
+                    else:
+                        markdown_content, document_mode, document = job.result
+                        if not markdown_content.startswith("[ERROR]"):
+                            owner.history.fetched(job.url)
+                    if job.url != owner.url:
+                        # The tab went to another page meanwhile (back/forward, a link, a typed URL): the
+                        # page stays in the page cache for a later visit, the tab loads the one it is on now
+                        pass
+                    elif owner is tab:
+                        self.set_document(document)
+                        new_document = document
+                        new_document_mode = document_mode
+                        page_loaded = True
+                    else:
+                        # Shown right away, so switching to the tab is just a redraw
+                        owner.show(document, document_mode)
+                        self.trim_tabs(tab)
+                elif job is image_job:
+                    image_job = None
+                    if job.error is not None:
+                        self.show_message(f"Could not open image {job.url}: {job.error}")
+                    elif job.kind == 'preview':
+                        self.thumbnail_cache.put(preview_key, job.result)
+                        if self.show_image_preview(job.url, job.result, self.image_mode) == ord('o'):
+                            image_job = self.submit_download(job.url)
+                    else:
+                        self.open_image(job.url, job.result)
+
+            # Progressive loading: show the blocks of a streamed page as they arrive
+            if tab.page_job is not None and new_document is None:
+                blocks = tab.page_job.take_progress()
+                if blocks:
+                    block_text = ''.join(blocks)
+                    if tab.streaming_url != tab.page_job.url:
+                        # First blocks of the page: it replaces the one on screen
+                        tab.streaming_url = tab.page_job.url
+                        new_document = self.render_markdown_to_curses(block_text, tab.page_job.url)
+                    else:
+                        # Appended in place, so the existing layouts just wrap the new lines
+                        self.render_markdown_to_curses(block_text, tab.page_job.url, append=True)
+
+            # Only fetch/re-render when the URL or the display mode changes; width is handled by layout
+            if new_document is None and view_key != tab.shown_key:
+                if tab.page_job is not None and tab.page_job.url != tab.url:
+                    tab.page_job.cancel()  # The user went somewhere else while it was loading
+                    tab.page_job = None
+                if tab.page_job is None:
+                    self.tracer.navigate(tab.url)
+                    new_document = None if tab.revalidate else self.cached_page_document(tab.url)
+                    if new_document is None:
+                        tab.page_job = self.loader.submit('page', tab.url, self.load_page, tab.url, tab.revalidate,
+                                                          tab.from_history, self.simple_mode, progress=True)
+                        tab.revalidate = False
+                    tab.from_history = False
+
+            if new_document is not None:
+                changed = tab.show(new_document, new_document_mode)
+                if changed:
+                    select_kind = None  # A different page is now on screen
+                if (changed or page_loaded) and self.prefetcher is not None:
+                    # Forget the previous page's prefetches and warm up this page's links; a streamed page
+                    # was shown before its end arrived, so it is scheduled again with all of its links
+                    self.prefetcher.schedule([self.normalize_url(link.url) for link in self.links])
+
+            self.current_url = tab.shown_url or tab.url
+            self.loading_url = tab.page_job.url if tab.page_job else (image_job.url if image_job else None)
+            self.tab_label = ""
+            if len(self.tabs) > 1:
+                loading = sum(1 for other in self.tabs if other is not tab and other.page_job is not None)
+                self.tab_label = f"[{self.tabs.index(tab) + 1}/{len(self.tabs)}"
+                self.tab_label += f", {loading} loading] " if loading else "] "
             status_bar_height = 2
             content_height = max_y - status_bar_height - 1  # Height of content area
 
+            # Wrap the document into screen rows for the current width (cached per width)
+            layout_started = time.perf_counter()
+            relayout = (tab.document is not tab.laid_out_document or tab.layout is None
+                        or tab.layout.width != max(1, max_x))
+            if tab.document is not tab.laid_out_document:
+                tab.laid_out_document = tab.document
+                tab.layouts = {}
+                tab.layout = None
+            if tab.layout is None or tab.layout.width != max(1, max_x):
+                previous = tab.layout
+                tab.layout = tab.layouts.get(max_x)
+                if tab.layout is None:
+                    tab.layout = tab.layouts[max_x] = Layout(tab.document, max_x)
+                if previous is not None:
+                    # Resized: keep the same text at the top of the screen
+                    tab.scroll_pos = tab.layout.row_for_anchor(*previous.anchor(tab.scroll_pos))
+            if tab.restore is not None and tab.restore[0] != tab.url:
+                tab.restore = None
+            if tab.restore is not None and relayout and tab.restore[0] == tab.shown_url:
+                # Back at a page from history: where the user left it (again once the whole page is in)
+                if tab.restore[1] is not None:
+                    tab.scroll_pos = tab.layout.row_for_anchor(*tab.restore[1])
+                if tab.page_job is None:
+                    tab.restore = None
+
             # Ensure scroll position is valid
-            max_scroll = max(0, len(lines) - content_height)
-            if scroll_pos > max_scroll:
-                scroll_pos = max_scroll
-            if scroll_pos < 0:
-                scroll_pos = 0
+            tab.layout.ensure(tab.scroll_pos + 2 * content_height)
+            if relayout and tab.page_job is None:
+                self.tracer.record(self.current_url, 'layout', (time.perf_counter() - layout_started) * 1000,
+                                   rows=tab.layout.row_count)
+            max_scroll = max(0, tab.layout.row_count - content_height)
+            if tab.scroll_pos > max_scroll:
+                tab.scroll_pos = max_scroll
+            if tab.scroll_pos < 0:
+                tab.scroll_pos = 0
+
+            # Link selection draws over the page: hints and the typed number, or the Tab focus
+            overlays = []
+            prompt = None
+            if find.query and find.document is tab.document:
+                # Matches in view are highlighted (under the link labels); a streamed page is searched again as it grows
+                find.search(tab.document, find.query, find.regex)
+                last_row = min(tab.scroll_pos + content_height, tab.layout.row_count) - 1
+                if last_row >= tab.scroll_pos:
+                    for index in find.visible(tab.layout.row_starts[tab.scroll_pos], tab.layout.row_ends[last_row]):
+                        start, end = find.span(index)
+                        attr = self.color_bold | curses.A_REVERSE if index == find.current else curses.A_REVERSE
+                        overlays.append((start, tab.document.text[start:end], attr))
+            if finding:
+                mode = "Regex" if find_regex else "Find"
+                found = f"error: {find.error}" if find.error else f"{len(find.starts)} matches"
+                prompt = f"{mode}: {find_query}_ ({found} | Enter - done, Esc - cancel, Ctrl-R - regex on/off)"
+            elif find.query and find.document is tab.document and not self.loading_url:
+                position = f"{find.current + 1}/{len(find.starts)}" if find.current is not None else len(find.starts)
+                prompt = f"Match {position} for {find.query!r} (n/N - next/previous, Esc - clear)"
+            if select_kind is not None:
+                table = self.images if select_kind == 'i' else self.links
+                label_attr = (self.color_image if select_kind == 'i' else self.color_link) | curses.A_REVERSE
+                visible = tab.layout.items_in_rows(table, tab.scroll_pos, content_height)
+                hints = dict(zip(hint_labels(len(visible), self.HINT_KEYS), visible))
+                if select_input.isdigit():
+                    if 1 <= int(select_input) <= len(table):
+                        record = table[int(select_input) - 1]
+                        overlays.append((record.start, tab.document.text[record.start:record.end], label_attr))
+                else:
+                    overlays.extend((table.starts[index], hint, self.color_header | curses.A_REVERSE)
+                                    for hint, index in hints.items() if hint.startswith(select_input))
+                noun = {'l': "Link", 'i': "Image", 't': "Link to open in a new tab"}[select_kind]
+                prompt = (f"{noun}: {select_input}_ (number 1-{len(table)} or hint letters, Enter - open, "
+                          f"Esc - cancel)")
+            elif tab.focus is not None and tab.focus < len(self.links):
+                record = self.links[tab.focus]
+                overlays.append((record.start, tab.document.text[record.start:record.end],
+                                 self.color_link | curses.A_REVERSE))
 
-            self.display_content(lines, scroll_pos)
+            self.display_content(tab.layout, tab.scroll_pos, overlays, prompt)
+            # Place on the page on screen, remembered in its history entry when leaving it
+            here = tab.layout.anchor(tab.scroll_pos) if tab.shown_url == tab.history.current.url else None
 
-            # Get user input
-            key = self.stdscr.getch()
+            # Sleep until a key, a resize or a finished background job; only the loading
+            # spinner needs a timer, so an idle browser does not wake up at all
+            key = self.read_key(0.1 if self.loading_url else None, wide=finding)
+            self.loop_stats['iterations'] += 1
+            if key == -1:
+                # Up without a key: the spinner's timer, a background job (self.woken) or a resize that
+                # changed nothing. Each one is traced, so wake-ups of an idle browser show up
+                self.loop_stats['wakeups'] += 1
+                self.tracer.event('wakeup', self.current_url, woken=self.woken, loading=self.loading_url is not None)
 
             # Handle navigation keys
-            if key == ord('q'):
+            open_item = None  # ('l' or 'i', number) picked by selection or Tab focus
+            jump = None  # (first, last, forward): go to the next / previous match of find, see PageFind.step
+            if finding:
+                # Find prompt: the page is searched as the query is typed; keys that came in while
+                # a long page was being searched are applied together, with one search for all of them
+                while key != -1:
+                    if key == '\x1b':
+                        finding = False
+                        find.clear()
+                        tab.scroll_pos = tab.layout.row_for_offset(find_origin)
+                        break
+                    elif key in ('\n', '\r', curses.KEY_ENTER):
+                        finding = False
+                        break
+                    elif key in (curses.KEY_BACKSPACE, '\x7f', '\x08'):
+                        find_query = find_query[:-1]
+                    elif key == '\x12':  # Ctrl-R
+                        find_regex = not find_regex
+                    elif isinstance(key, str) and key.isprintable():
+                        find_query += key
+                    key = self.read_key(0, wide=True)
+                if key != '\x1b' and (find_query, find_regex) != (find.query, find.regex):
+                    if find.search(tab.document, find_query, find_regex):
+                        jump = (find_origin, find_origin, True)
+                    else:
+                        tab.scroll_pos = tab.layout.row_for_offset(find_origin)
+            elif select_kind is not None:
+                # Selection mode: every key goes here until a link is picked or Esc
+                table = self.images if select_kind == 'i' else self.links
+                if key == 27:
+                    select_kind = None
+                elif key in (curses.KEY_BACKSPACE, 127, 8):
+                    select_input = select_input[:-1]
+                elif key in (10, 13, curses.KEY_ENTER):
+                    if select_input.isdigit():
+                        open_item = (select_kind, int(select_input))
+                    select_kind = None
+                elif ord('0') <= key <= ord('9') and (not select_input or select_input.isdigit()):
+                    select_input += chr(key)
+                    number = int(select_input)
+                    if number * 10 > len(table):
+                        open_item = (select_kind, number)  # No longer number starts with these digits
+                        select_kind = None
+                    elif number >= 1:
+                        # Bring the typed link on screen
+                        row = tab.layout.row_for_offset(table.starts[number - 1])
+                        if not tab.scroll_pos <= row < tab.scroll_pos + content_height:
+                            tab.scroll_pos = row
+                elif 0 <= key < 256 and chr(key) in self.HINT_KEYS and not select_input.isdigit():
+                    typed = select_input + chr(key)
+                    if typed in hints:
+                        open_item = (select_kind, hints[typed] + 1)
+                        select_kind = None
+                    elif any(hint.startswith(typed) for hint in hints):
+                        select_input = typed
+            elif key == ord('q'):
+                tab.history.remember(here)
+                self.history.save()
                 break
+            elif key == 27 and find.query and tab.page_job is None and image_job is None:  # Esc - clear the matches
+                find.clear()
+            elif key == 27:  # Esc - cancel loading
+                if image_job is not None:
+                    image_job.cancel()
+                    image_job = None
+                if tab.page_job is not None:
+                    tab.page_job.cancel()
+                    tab.page_job = None
+                    tab.streaming_url = None
+                    if tab.shown_url is not None:
+                        # Stay on the page that is on screen (possibly the part received so far)
+                        tab.url = tab.shown_url
+                        tab.history.settle(tab.url)
+                    else:
+                        tab.document = self.render_markdown_to_curses(
+                            f"# Cancelled\n\nLoading of {tab.url} was cancelled. Press r to retry.", tab.url)
+                        tab.shown_key = view_key
             elif key == ord('k') or key == curses.KEY_UP:  # Up
-                scroll_pos = max(0, scroll_pos - 1)
+                tab.scroll_pos = max(0, tab.scroll_pos - 1)
             elif key == ord('j') or key == curses.KEY_DOWN:  # Down
-                scroll_pos = min(max_scroll, scroll_pos + 1)
+                tab.scroll_pos = min(max_scroll, tab.scroll_pos + 1)
             elif key == curses.KEY_PPAGE:  # Page Up
-                scroll_pos = max(0, scroll_pos - content_height)
+                tab.scroll_pos = max(0, tab.scroll_pos - content_height)
             elif key == curses.KEY_NPAGE:  # Page Down
-                scroll_pos = min(max_scroll, scroll_pos + content_height)
+                tab.scroll_pos = min(max_scroll, tab.scroll_pos + content_height)
             elif key == ord('g') or key == curses.KEY_HOME:  # Go to top
-                scroll_pos = 0
+                tab.scroll_pos = 0
             elif key == ord('G') or key == curses.KEY_END:  # Go to bottom
-                scroll_pos = max_scroll
-            elif key == ord('b'):  # Back
-                if len(self.history) > 1:
-                    self.history.pop()  # Remove current page
-                    url = self.history[-1]  # Go to previous
-                    scroll_pos = 0  # Reset scroll on back
+                tab.layout.finish()
+                tab.scroll_pos = max(0, tab.layout.row_count - content_height)
+            elif key in (ord('b'), ord('f')):  # Back / forward, to where the user left the page
+                entry = tab.history.back(here) if key == ord('b') else tab.history.forward(here)
+                if entry is not None:
+                    tab.url = entry.url
+                    tab.restore = (tab.url, entry.anchor)
+                    tab.from_history = True
                 else:
                     # Display message if no history
-                    msg = "No previous page in history."
-                    self.stdscr.addstr(curses.LINES - 3, 0, msg[:curses.COLS - 1],
-                                       curses.color_pair(1) | curses.A_REVERSE)
-                    self.stdscr.clrtoeol()
-                    self.stdscr.refresh()
-                    self.stdscr.getch()  # Wait for keypress to acknowledge
+                    msg = "No previous page in history." if key == ord('b') else "No next page in history."
+                    self.show_message(msg)
+            elif key == ord('p'):  # Timing overlay in the top line
+                self.show_timings = not self.show_timings
             elif key == ord('m'):  # Toggle mode
                 self.simple_mode = not self.simple_mode
                 # Redraw after toggling mode
                 continue  # Skip the rest of the loop iteration to redraw immediately
+            elif key == ord('r'):  # Reload, bypassing the page cache
+                self.page_cache.discard(tab.url)
+                tab.revalidate = True
+                tab.shown_key = None
+                continue
             elif key == ord('s'):  # Search sites
                 selected_url = self.search_sites()
+                self.painter.invalidate()  # The search screen replaced ours
                 if selected_url:
-                    # Add current URL to history before navigating to search result
-                    if self.current_url != self.history[-1]:
-                        self.history.append(self.current_url)
-                    url = self.normalize_url(selected_url)
-                    scroll_pos = 0  # Reset scroll on search result click
+                    tab.url = self.normalize_url(selected_url)
+                    tab.history.visit(tab.url, here)
                 # Redraw after search (whether a site was selected or not)
                 continue  # Skip the rest of the loop iteration to redraw immediately
-            elif key in (ord('l'), ord('i')):  # Handle link/image selection
-                # Temporarily switch to non-blocking mode to get the number
-                self.stdscr.nodelay(1)
-                num_char1 = self.stdscr.getch()
-                num_char2 = -1  # Initialize as invalid
-                # Check if the first char is a digit
-                if 48 <= num_char1 <= 57:  # '0' to '9'
-                    num_str = chr(num_char1)
-                    # Try to get a potential second digit immediately
-                    # getch() in nodelay mode returns -1 if no input
-                    time.sleep(0.01)  # Small delay to allow input buffer to fill
-                    num_char2 = self.stdscr.getch()
-                    if 48 <= num_char2 <= 57:  # '0' to '9'
-                        num_str += chr(num_char2)
-                    else:
-                        # If second char is not a digit, put it back if it was valid input
-                        if num_char2 != -1:
-                            curses.ungetch(num_char2)
+            elif key == ord('F'):  # Full-text search over loaded pages
+                selected_url = self.search_pages()
+                self.painter.invalidate()
+                if selected_url:
+                    tab.url = selected_url
+                    tab.history.visit(tab.url, here)
+                continue
+            elif key in (ord('l'), ord('i')):  # Select a link / image: by number or by the hints drawn on screen
+                select_kind = chr(key)
+                select_input = ''
+            elif key == ord('/'):  # Find in the page
+                finding = True
+                find_query = ''
+                find_regex = False
+                find_origin = tab.layout.row_starts[tab.scroll_pos] if tab.layout.row_count else 0
+                find.clear()
+            elif key in (ord('n'), ord('N')):  # Next / previous match
+                find.search(tab.document, find.query, find.regex)  # The same query in another page
+                if not find.query:
+                    self.show_message("Nothing to find yet: press / and type what to look for.")
+                elif not find.starts:
+                    self.show_message(f"Not found: {find.query}")
                 else:
-                    # If first char after 'l'/'i' is not a digit, put it back
-                    if num_char1 != -1:
-                        curses.ungetch(num_char1)
-                    num_str = ""  # Indicate no valid number found
+                    last_row = max(tab.scroll_pos, min(tab.scroll_pos + content_height, tab.layout.row_count) - 1)
+                    jump = (tab.layout.row_starts[tab.scroll_pos], tab.layout.row_ends[last_row], key == ord('n'))
+            elif key == ord('T'):  # Select a link to load in a new tab, staying on this page meanwhile
+                select_kind = 't'
+                select_input = ''
+            elif key == ord('t'):  # New tab for a URL typed in
+                typed_url = self.prompt_url()
+                self.painter.invalidate()
+                if typed_url:
+                    tab.history.remember(here)
+                    new_tab = Tab(self.normalize_url(typed_url, local_files=True), History(None))
+                    new_tab.history.visit(new_tab.url)
+                    self.tabs.insert(self.tabs.index(tab) + 1, new_tab)
+                    tab = self.activate_tab(new_tab)
+                continue
+            elif key in (ord('['), ord(']')) and len(self.tabs) > 1:  # Previous / next tab
+                tab.history.remember(here)
+                index = (self.tabs.index(tab) + (1 if key == ord(']') else -1)) % len(self.tabs)
+                tab = self.activate_tab(self.tabs[index])
+            elif key == ord('x'):  # Close the tab
+                if len(self.tabs) == 1:
+                    self.show_message("This is the only tab (q - quit).")
+                else:
+                    index = self.tabs.index(tab)
+                    self.close_tab(tab)
+                    tab = self.activate_tab(self.tabs[min(index, len(self.tabs) - 1)])
+            elif key in (9, curses.KEY_BTAB):  # Tab / Shift-Tab: focus the next / previous link on screen
+                visible = tab.layout.items_in_rows(self.links, tab.scroll_pos, content_height)
+                step = 1 if key == 9 else -1
+                if tab.focus is None or tab.focus not in visible:
+                    tab.focus = (visible[0] if step > 0 else visible[-1]) if visible else tab.focus
+                elif 0 <= tab.focus + step < len(self.links):
+                    tab.focus += step
+                if tab.focus is not None:
+                    row = tab.layout.row_for_offset(self.links.starts[tab.focus])
+                    if row < tab.scroll_pos:
+                        tab.scroll_pos = row
+                    elif row >= tab.scroll_pos + content_height:
+                        tab.scroll_pos = row - content_height + 1
+            elif key in (10, 13, curses.KEY_ENTER) and tab.focus is not None:  # Open the focused link
+                open_item = ('l', tab.focus + 1)
 
-                # Switch back to blocking mode
-                self.stdscr.nodelay(0)
-                self.stdscr.timeout(100)  # Restore timeout
+            if jump is not None:
+                # Matches map to rows through their text offsets, so the jump is a binary search
+                row = tab.layout.row_for_offset(find.starts[find.step(*jump)])
+                if not tab.scroll_pos <= row < tab.scroll_pos + content_height:
+                    tab.scroll_pos = row
 
-                try:
-                    if num_str:
-                        num = int(num_str)
-                        if key == ord('l'):  # Link
-                            if 1 <= num <= len(self.links):
-                                new_url = self.links[num - 1]
-                                if self.current_url != self.history[-1]:
-                                    self.history.append(self.current_url)
-                                url = self.normalize_url(new_url)
-                                scroll_pos = 0  # Reset scroll on link click
-                            else:
-                                msg = f"Invalid link number: {num}. Valid range: 1-{len(self.links)}."
-                                self.stdscr.addstr(curses.LINES - 3, 0, msg[:curses.COLS - 1],
-                                                   curses.color_pair(1) | curses.A_REVERSE)
-                                self.stdscr.clrtoeol()
-                                self.stdscr.refresh()
-                                self.stdscr.getch()
-                        elif key == ord('i'):  # Image
-                            if 1 <= num <= len(self.images):
-                                img_url = self.images[num - 1]
-                                self.open_image(img_url)
-                            else:
-                                msg = f"Invalid image number: {num}. Valid range: 1-{len(self.images)}."
-                                self.stdscr.addstr(curses.LINES - 3, 0, msg[:curses.COLS - 1],
-                                                   curses.color_pair(1) | curses.A_REVERSE)
-                                self.stdscr.clrtoeol()
-                                self.stdscr.refresh()
-                                self.stdscr.getch()
+            if open_item is not None:
+                kind, num = open_item
+                if kind in ('l', 't'):  # Link
+                    if 1 <= num <= len(self.links):
+                        new_url = self.normalize_url(self.links[num - 1].url)
+                        if kind == 't':
+                            self.open_background_tab(new_url, tab)
+                        else:
+                            tab.url = new_url
+                            tab.history.visit(tab.url, here)
                     else:
-                        # No valid number was entered after 'l' or 'i'
-                        msg = f"Command '{chr(key)}' requires a number. Press '{chr(key)}' followed by link/image number."
-                        self.stdscr.addstr(curses.LINES - 3, 0, msg[:curses.COLS - 1],
-                                           curses.color_pair(1) | curses.A_REVERSE)
-                        self.stdscr.clrtoeol()
-                        self.stdscr.refresh()
-                        self.stdscr.getch()
-                except ValueError:
-                    # Should not happen if num_str is checked correctly, but just in case
-                    msg = f"Invalid number format: {num_str}"
-                    self.stdscr.addstr(curses.LINES - 3, 0, msg[:curses.COLS - 1],
-                                       curses.color_pair(1) | curses.A_REVERSE)
-                    self.stdscr.clrtoeol()
-                    self.stdscr.refresh()
-                    self.stdscr.getch()
+                        msg = f"Invalid link number: {num}. Valid range: 1-{len(self.links)}."
+                        self.show_message(msg)
+                elif 1 <= num <= len(self.images):  # Image
+                    img_url = self.images[num - 1].url
+                    if image_job is not None:
+                        image_job.cancel()
+                        image_job = None
+                    # Inline preview sized to the content area; decoded grids are cached
+                    preview_key = (img_url, max_x, content_height, self.image_mode)
+                    cells = self.thumbnail_cache.get(preview_key)
+                    if cells is not None:
+                        if self.show_image_preview(img_url, cells, self.image_mode) == ord('o'):
+                            image_job = self.submit_download(img_url)
+                    else:
+                        image_job = self.loader.submit(
+                            'preview', img_url, self.load_image_preview, img_url, max_x,
+                            content_height, self.image_mode, curses.COLORS)
+                else:
+                    msg = f"Invalid image number: {num}. Valid range: 1-{len(self.images)}."
+                    self.show_message(msg)
             # Add a default case to handle unrecognized keys if needed
             # elif key != -1: # -1 is returned by getch in nodelay mode if no key is pressed
             #     # Optionally handle other keys or ignore them
@@ -729,7 +4268,7 @@ class AlternetBrowser:
         input_str = ""
         y, x = 1, 2
         while True:
-            char = self.stdscr.getch()
+            char = self.read_key()
             if char == 10 or char == 13:  # Enter key
                 break
             elif char == 27:  # ESC key